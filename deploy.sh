@@ -4,10 +4,26 @@
 #   kill $DJANGOPID
 # fi
 
-ps -aux | grep 'runserver 0.0.0.0:8080' | awk '{print $2}' | xargs kill -9
+ps -aux | grep -E 'runserver 0.0.0.0:8080|inftrack.wsgi:application|inftrack.asgi:application|advance_contact_graph|refresh_risk_scores' | grep -v grep | awk '{print $2}' | xargs -r kill -9
 
 git pull
 
-nohup python manage.py runserver 0.0.0.0:8080 > api.log 2>&1 &
+# the response and heatmap caches are shared between workers through the database
+python manage.py createcachetable
 
-# export DJANGOPID=$(echo $!)
\ No newline at end of file
+# the people version shared by every worker lives in memcached (CACHES['versions'])
+pgrep -x memcached > /dev/null || memcached -d -l 127.0.0.1 -p 11211 -m 64
+
+# the HTTP API: synchronous views on a pool of WSGI workers and threads
+nohup gunicorn inftrack.wsgi:application --bind 0.0.0.0:8080 --workers 4 --threads 8 > api.log 2>&1 &
+
+# gateways stream positions over websockets on /v1/ws/positions
+nohup uvicorn inftrack.asgi:application --host 0.0.0.0 --port 8081 --workers 2 > ws.log 2>&1 &
+
+# keeps the contact graph up to date off the request path
+nohup python manage.py advance_contact_graph --interval 10 > contact_graph.log 2>&1 &
+
+# recomputes everyone's risk score from the contact graph
+nohup python manage.py refresh_risk_scores --interval 300 > risk.log 2>&1 &
+
+# export DJANGOPID=$(echo $!)
@@ -2,6 +2,12 @@
 ASGI config for inftrack project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Only websocket connections (gateway position streaming) are served here, by
+inftrackapp.streaming. The HTTP API is served by the WSGI entry point
+(inftrack.wsgi) under gunicorn, see deploy.sh: its views are synchronous
+and stream responses out of the database, so a pool of WSGI worker threads
+runs them in parallel, where an ASGI adapter in one process would run them
+one after another on its single sync thread.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
@@ -9,8 +15,29 @@ https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'inftrack.settings')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+# imported after Django is set up, it needs the app registry
+from inftrackapp.streaming import websocket_application
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        await websocket_application(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    else:
+        await send({'type': 'http.response.start', 'status': 404,
+                    'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body',
+                    'body': b'only websockets are served here, the HTTP API is on the WSGI server'})
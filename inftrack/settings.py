@@ -55,10 +55,11 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'corsheaders',
-    'inftrackapp'
+    'inftrackapp.apps.InftrackappConfig'
 ]
 
 MIDDLEWARE = [
+    'inftrackapp.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -139,3 +140,222 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.0/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Contact detection
+# A contact is any other person within CONTACT_DISTANCE_METERS of the index person
+# for at least CONTACT_MIN_DWELL_SECONDS, looking back CONTACT_LOOKBACK_DAYS.
+# Positions are compared in time buckets of CONTACT_SAMPLE_SECONDS.
+
+CONTACT_DISTANCE_METERS = 2.0
+CONTACT_MIN_DWELL_SECONDS = 15 * 60
+CONTACT_SAMPLE_SECONDS = 10
+CONTACT_LOOKBACK_DAYS = 14
+
+# Exposure intervals
+# Proximity hits closer together than EXPOSURE_GAP_SECONDS are merged into one interval,
+# intervals shorter than EXPOSURE_MIN_DURATION_SECONDS are dropped.
+# Zones are rasterised onto a grid of ZONE_INDEX_CELL_METERS cells for lookups.
+
+EXPOSURE_GAP_SECONDS = 60
+EXPOSURE_MIN_DURATION_SECONDS = 60
+ZONE_INDEX_CELL_METERS = 2.0
+
+# Position ingestion
+# Readings are written with bulk_create in chunks of INGEST_BULK_CHUNK_SIZE rows.
+# At most INGEST_MAX_ERRORS rejected readings are itemised in a batch response.
+
+INGEST_BULK_CHUNK_SIZE = 5000
+INGEST_MAX_ERRORS = 100
+
+# Streaming ingestion (websocket /v1/ws/positions, served by inftrack.asgi on port 8081)
+# Buffered readings are flushed once STREAM_FLUSH_READINGS have arrived or
+# STREAM_FLUSH_SECONDS have passed. Gateways are no longer read from while
+# STREAM_MAX_BUFFERED_READINGS are waiting to be written.
+
+STREAM_FLUSH_READINGS = 20000
+STREAM_FLUSH_SECONDS = 1.0
+STREAM_MAX_BUFFERED_READINGS = 200000
+
+# Sealed position segments (see inftrackapp/segments.py)
+# Set POSITION_SEGMENT_DIR, e.g. os.path.join(BASE_DIR, 'segments'), to enable the engine.
+# `manage.py seal_positions` moves complete hours older than POSITION_SEGMENT_SEAL_DELAY_HOURS
+# out of the database into segments.
+
+POSITION_SEGMENT_DIR = None
+POSITION_SEGMENT_SEAL_DELAY_HOURS = 2
+
+# Trajectory compression (see inftrackapp/compression.py)
+# Ingest only stores a reading when it is more than POSITION_COMPRESSION_ERROR_METERS from the
+# person's last stored position, or POSITION_COMPRESSION_MAX_INTERVAL_SECONDS after it. Readers
+# hold the last stored position in between, so leave this on for as long as compressed data is kept.
+
+POSITION_COMPRESSION_ENABLED = True
+POSITION_COMPRESSION_ERROR_METERS = 0.25
+POSITION_COMPRESSION_MAX_INTERVAL_SECONDS = 60
+
+# Live positions (v1/people/id/<id>/nearby, see inftrackapp/live.py)
+# The latest reading of every person is held in memory in a spatial hash of LIVE_CELL_METERS cells;
+# readings older than LIVE_STALE_SECONDS no longer count as where someone is now.
+# v1/people/id/<id>/nearby accepts distances up to LIVE_MAX_DISTANCE_METERS.
+
+LIVE_POSITIONS_ENABLED = True
+LIVE_CELL_METERS = 2.0
+LIVE_STALE_SECONDS = 120
+LIVE_MAX_DISTANCE_METERS = 100.0
+
+# Person traces (v1/people/id/<id>/trace)
+# Pages hold TRACE_PAGE_SIZE positions unless ?limit= asks for fewer or more, up to TRACE_MAX_PAGE_SIZE.
+
+TRACE_PAGE_SIZE = 10000
+TRACE_MAX_PAGE_SIZE = 100000
+
+# Exports (v1/export/<positions|contacts>, manage.py export_data)
+# Rows are read, encoded and sent EXPORT_CHUNK_ROWS at a time.
+
+EXPORT_CHUNK_ROWS = 20000
+
+# People listings stream every match unless ?limit= is given, up to PEOPLE_MAX_PAGE_SIZE.
+
+PEOPLE_MAX_PAGE_SIZE = 10000
+
+# Cache
+# People endpoints are cached per URL and invalidated by a version bump on every person write.
+# The version lives in its own 'versions' alias, read on every people request and bumped on every
+# person write; the alias also holds the tag assignment version, read on every assignment lookup
+# and bumped on every assignment write (see assignments.py). It has to be shared by every worker
+# and management command, answer without a database round trip and increment atomically, which
+# memcached does (incr is atomic and a hot counter is never the least recently used entry). A per-process backend such as LocMemCache
+# serves stale 304s. Response bodies stay in the database cache (run `manage.py createcachetable`).
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'ethermed_cache',
+    },
+    'versions': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': '127.0.0.1:11211',
+        'TIMEOUT': None,
+    },
+    # heatmap tiles (see HEATMAP_* below); room for many full-size heatmap requests, so one
+    # long request does not cull the tiles it has just written
+    'heatmap': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'ethermed_heatmap_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+            'CULL_FREQUENCY': 10,
+        },
+    },
+}
+
+RESPONSE_CACHE_TIMEOUT = 300
+RESPONSE_CACHE_MAX_BYTES = 5 * 1024 * 1024
+
+# Bulk status updates (v1/status/bulk) accept at most STATUS_BULK_MAX_UPDATES per request, and
+# as-of status lookups (v1/people/status-at) at most STATUS_AT_MAX_QUERIES.
+
+STATUS_BULK_MAX_UPDATES = 10000
+STATUS_AT_MAX_QUERIES = 10000
+
+# Shift-change tag reassignment (v1/tags/assign) accepts at most TAG_ASSIGN_BULK_MAX_ASSIGNMENTS per request.
+
+TAG_ASSIGN_BULK_MAX_ASSIGNMENTS = 10000
+
+# Contact graph (see inftrackapp/contact_graph.py)
+# Edges aggregate contact time per pair of people per CONTACT_GRAPH_BUCKET_SECONDS.
+# `manage.py advance_contact_graph --interval N` advances the graph to now minus
+# CONTACT_GRAPH_LAG_SECONDS every N seconds, in steps of at least CONTACT_GRAPH_MIN_STEP_SECONDS
+# and at most CONTACT_GRAPH_MAX_STEP_SECONDS.
+
+CONTACT_GRAPH_ENABLED = True
+CONTACT_GRAPH_BUCKET_SECONDS = 3600
+CONTACT_GRAPH_LAG_SECONDS = 30
+CONTACT_GRAPH_MIN_STEP_SECONDS = 10
+CONTACT_GRAPH_MAX_STEP_SECONDS = 3600
+
+# Multi-hop exposure tracing (v1/trace-exposure/id/<id>/)
+# An infected person is taken to be infectious from TRACE_INFECTIOUS_DAYS_BEFORE days before they
+# were marked infected; exposure is followed for TRACE_HORIZON_DAYS from then, over up to
+# TRACE_MAX_DEPTH hops (requests may ask for fewer or more, up to TRACE_DEPTH_LIMIT).
+
+TRACE_INFECTIOUS_DAYS_BEFORE = 2
+TRACE_HORIZON_DAYS = 14
+TRACE_MAX_DEPTH = 3
+TRACE_DEPTH_LIMIT = 6
+
+# Parallel recompute of contact graph history (manage.py recompute_contacts, see inftrackapp/recompute.py)
+# History is cut into windows of RECOMPUTE_WINDOW_HOURS; each worker also reads RECOMPUTE_MARGIN_SECONDS
+# of positions either side of its window.
+
+RECOMPUTE_WINDOW_HOURS = 24
+RECOMPUTE_MARGIN_SECONDS = 120
+
+# Risk scoring (see inftrackapp/risk.py)
+# dose = contact seconds * exp(-distance / RISK_DISTANCE_SCALE_METERS) * weight of the other person's
+# status at the time of contact; score = 1 - exp(-dose / RISK_DOSE_SCALE_SECONDS).
+# Scores are refreshed by `manage.py refresh_risk_scores --interval N` every N seconds and, when
+# RISK_REFRESH_ON_STATUS_CHANGE is set, for the contacts of the people concerned on a background
+# thread after every status change.
+
+RISK_STATUS_WEIGHTS = {
+    'infected': 1.0,
+    'being_tested': 0.5,
+    'at_risk': 0.1,
+    'ok': 0.0,
+}
+RISK_DISTANCE_SCALE_METERS = 1.0
+RISK_DOSE_SCALE_SECONDS = 900
+RISK_REFRESH_ON_STATUS_CHANGE = True
+
+# Outbreak clusters (v1/clusters, manage.py detect_clusters, see inftrackapp/clusters.py)
+# People with a status in CLUSTER_STATUSES are clustered; sharing a zone counts when both spent the
+# contact dwell time in it within the same CLUSTER_ZONE_BUCKET_SECONDS. Each cluster lists its
+# CLUSTER_HOTSPOTS busiest CLUSTER_HOTSPOT_CELL_METERS cells.
+
+CLUSTER_STATUSES = ['infected', 'at_risk']
+CLUSTER_ZONE_BUCKET_SECONDS = 3600
+CLUSTER_HOTSPOT_CELL_METERS = 2.0
+CLUSTER_HOTSPOTS = 3
+
+# Request metrics (see inftrackapp/metrics.py), scraped from v1/metrics
+# METRICS_TRACE_SAMPLE_RATE of requests keep their SQL; those slower than METRICS_SLOW_REQUEST_SECONDS
+# are listed, slowest queries first, at v1/metrics/traces (the last METRICS_TRACE_KEEP of them).
+# METRICS_ALLOWED_IPS limits who may read either endpoint; None allows anyone.
+
+METRICS_ENABLED = True
+METRICS_TRACE_SAMPLE_RATE = 0.0
+METRICS_SLOW_REQUEST_SECONDS = 1.0
+METRICS_TRACE_KEEP = 50
+METRICS_TRACE_MAX_QUERIES = 20
+METRICS_ALLOWED_IPS = None
+
+# Occupancy heatmaps (v1/heatmap, see inftrackapp/heatmap.py)
+# Positions are binned into HEATMAP_CELL_METERS cells per HEATMAP_BUCKET_SECONDS unless the request
+# asks otherwise; a request may cover at most HEATMAP_MAX_BUCKETS buckets. Buckets that end before the
+# sealed or compacted history (see positions.database_from) can no longer change and are cached as tiles
+# for HEATMAP_TILE_TIMEOUT seconds in CACHES['heatmap']; until seal_positions or compact_positions has
+# run, every bucket is computed.
+
+HEATMAP_BUCKET_SECONDS = 15 * 60
+HEATMAP_CELL_METERS = 1.0
+HEATMAP_MAX_BUCKETS = 2000
+HEATMAP_TILE_TIMEOUT = 7 * 24 * 3600
+
+# Dwell-segment rollups and retention (see inftrackapp/rollups.py)
+# compact_positions collapses positions older than DWELL_COMPACT_AFTER_HOURS into dwell segments:
+# consecutive positions of a person in the same DWELL_CELL_METERS grid cell, with no gap longer
+# than DWELL_MAX_GAP_SECONDS. Raw positions older than POSITION_RAW_RETENTION_DAYS that have been
+# compacted are then deleted, from the database and from sealed segment files.
+
+DWELL_COMPACT_AFTER_HOURS = 24
+DWELL_CELL_METERS = 1.0
+DWELL_MAX_GAP_SECONDS = 60
+POSITION_RAW_RETENTION_DAYS = 7
+
+# Roster import (v1/roster/<people|tags> and import_roster, see inftrackapp/roster.py)
+# Rows are upserted on unique_id ROSTER_BATCH_SIZE at a time, one existence query per batch.
+# As with ingestion, at most INGEST_MAX_ERRORS rejected rows are itemised in the result.
+
+ROSTER_BATCH_SIZE = 1000
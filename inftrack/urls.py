@@ -26,13 +26,43 @@ urlpatterns = [
 
     path(r'v1/people/status/<str:status>/', views.show_people_by_status),
 
+    path(r'v1/people/id/<str:identifier>/trace', views.show_person_trace),
+
+    path(r'v1/people/id/<str:identifier>/nearby', views.show_people_nearby),
+
+    path(r'v1/people/id/<str:identifier>/status', views.show_person_status_at),
+
     path(r'v1/people/id/<str:identifier>', views.show_person_by_id),
 
+    path(r'v1/people/status-at', views.show_people_status_at),
+
     path(r'v1/people', views.show_all_people),
 
+    path(r'v1/status/bulk', views.update_status_bulk),
+
+    path(r'v1/tags/assign', views.assign_tags_bulk),
+
     path(r'v1/status/<str:status>/id/<str:identifier>/', views.update_status),
 
     path(r'v1/analyze-at-risk/id/<str:identifier>/', views.analyze_at_risk),
 
-    path(r'v1/analyze-at-risk-details', views.analyze_at_risk_details)
+    path(r'v1/trace-exposure/id/<str:identifier>/', views.trace_exposure),
+
+    path(r'v1/risk-scores', views.show_risk_scores),
+
+    path(r'v1/clusters', views.show_clusters),
+
+    path(r'v1/analyze-at-risk-details', views.analyze_at_risk_details),
+
+    path(r'v1/positions', views.ingest_positions),
+
+    path(r'v1/export/<str:kind>', views.export_data),
+
+    path(r'v1/roster/<str:kind>', views.import_roster),
+
+    path(r'v1/heatmap', views.show_heatmap),
+
+    path(r'v1/metrics/traces', views.show_metrics_traces),
+
+    path(r'v1/metrics', views.show_metrics)
 ]
@@ -7,3 +7,9 @@ admin.site.register(models.TrackingTag)
 admin.site.register(models.TagAssignmentEvent)
 admin.site.register(models.StatusChangeEvent)
 admin.site.register(models.TagPosition)
+admin.site.register(models.Zone)
+admin.site.register(models.ContactEdge)
+admin.site.register(models.ContactGraphState)
+admin.site.register(models.RiskScore)
+admin.site.register(models.DwellSegment)
+admin.site.register(models.RollupState)
@@ -1,8 +1,11 @@
 import json
+import time
 
 from uuid import UUID
 
-from django.http import HttpResponse, HttpResponseNotFound, HttpResponseForbidden
+from django.http import HttpResponse, HttpResponseNotFound, HttpResponseForbidden, StreamingHttpResponse
+
+import inftrackapp.metrics as metrics
 
 KEY_CODE ='code'
 KEY_MESSAGE = 'msg'
@@ -21,26 +24,65 @@ def fallback_decoder(obj):
     else:
         raise TypeError('Object of type %s with value of %s is not JSON serializable' % (type(obj), repr(obj)))
 
+def dumps(obj):
+    # json.dumps, with the time it takes reported to the request metrics
+    started = time.perf_counter()
+    text = json.dumps(obj, default=fallback_decoder)
+    metrics.add_serialize_time(time.perf_counter() - started)
+    return text
+
 ###########################
 # success handlers
 ###########################
 def response_json(dict_in):
-    return HttpResponse(json.dumps(dict_in, default=fallback_decoder), content_type='application/json')
+    return HttpResponse(dumps(dict_in), content_type='application/json')
 
 def response_success_with_dict(dict_in):
-    return HttpResponse(json.dumps(dict_in, default=fallback_decoder), content_type='application/json')
+    return HttpResponse(dumps(dict_in), content_type='application/json')
 
-def response_success_with_list(list_in,limit=0,offset=0,total=0):
+def response_success_with_list(list_in,limit=0,offset=0,total=None):
     cnt=len(list_in)
+    if total is None:
+        # the list is complete
+        total=offset+cnt
     thedict={
         "count": cnt,
-        "has_more": False,
+        "has_more": offset+cnt < total,
         "limit": limit,
         "offset": offset,
         "total": total,
         "results": list_in
     }
-    return HttpResponse(json.dumps(thedict, default=fallback_decoder), content_type='application/json')
+    return HttpResponse(dumps(thedict), content_type='application/json')
+
+def response_streaming_list(items,trailer=None,chunk_size=1000):
+    #
+    # streams {"results": [...], <trailer fields>} without holding the list in memory
+    # trailer is called once every item has been sent, so it can report counts and cursors
+    #
+    def generate():
+        yield '{"results": ['
+        sep = ''
+        buf = []
+        encoding = 0.0
+        clock = time.perf_counter
+        for item in items:
+            started = clock()
+            buf.append(json.dumps(item, default=fallback_decoder))
+            encoding += clock() - started
+            if len(buf) >= chunk_size:
+                yield sep + ', '.join(buf)
+                sep = ', '
+                buf = []
+        if buf:
+            yield sep + ', '.join(buf)
+        yield ']'
+        if trailer is not None:
+            for key, value in trailer().items():
+                yield ', %s: %s' % (json.dumps(key), json.dumps(value, default=fallback_decoder))
+        metrics.add_serialize_time(encoding)
+        yield '}'
+    return StreamingHttpResponse(generate(), content_type='application/json')
 
 class HttpResponseDeleteSuccessful(HttpResponse):
     status_code = 204
@@ -67,16 +109,16 @@ class HttpResponseUnauthorized(HttpResponse):
 # response_json functions
 #
 def response_json_forbidden(dict_in):
-    return HttpResponseForbidden(json.dumps(dict_in, default=fallback_decoder), content_type='application/json')
+    return HttpResponseForbidden(dumps(dict_in), content_type='application/json')
 
 def response_json_not_found(dict_in):
-    return HttpResponseNotFound(json.dumps(dict_in, default=fallback_decoder), content_type='application/json')
+    return HttpResponseNotFound(dumps(dict_in), content_type='application/json')
 
 def response_json_unprocessable_entity(dict_in):
-    return HttpResponseUnprocessableEntity(json.dumps(dict_in, default=fallback_decoder), content_type='application/json')
+    return HttpResponseUnprocessableEntity(dumps(dict_in), content_type='application/json')
 
 def response_json_unauthorized(dict_in):
-    return HttpResponseUnauthorized(json.dumps(dict_in, default=fallback_decoder), content_type='application/json')
+    return HttpResponseUnauthorized(dumps(dict_in), content_type='application/json')
 
 #
 # response_error functions  (these call the response_json functions)
@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class InftrackappConfig(AppConfig):
     name = 'inftrackapp'
+
+    def ready(self):
+        import inftrackapp.assignments as assignments
+        import inftrackapp.response_cache as response_cache
+        response_cache.connect_signals()
+        assignments.connect_signals()
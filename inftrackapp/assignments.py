@@ -0,0 +1,185 @@
+#######################################################################
+# assignments.py
+# In-memory index of tag assignments
+#
+# Answers "who wore tag T at time t" (and "which tag did person P wear
+# at time t") by binary search over each tag's and each person's event
+# timeline, built once from TagAssignmentEvent. Lookups work for any
+# point in time, so late readings and re-analysis resolve to whoever
+# held the tag when the reading was taken.
+#
+# The index is kept current by the dao writes in this process and by
+# refresh(), which picks up events written elsewhere (other workers, the
+# admin, management commands) with one query for ids it has not seen.
+# Every write also bumps a shared assignment version in the versions
+# cache (see response_cache.py): get_assignment_index() only refreshes
+# when that version has moved, so a lookup costs a cache read, not a query.
+#######################################################################
+import bisect
+import threading
+
+import numpy as np
+
+from django.db import transaction
+from django.db.models.signals import post_save
+
+import inftrackapp.models as models
+import inftrackapp.response_cache as response_cache
+
+ASSIGNMENTS_VERSION_KEY = 'inftrack:assignments:version'
+
+class Timeline(object):
+    #
+    # values[i] holds from times[i] until times[i + 1]; None means nothing held
+    #
+    __slots__ = ('times', 'values')
+
+    def __init__(self):
+        self.times = []
+        self.values = []
+
+    def add(self, t, value):
+        i = bisect.bisect_right(self.times, t)
+        self.times.insert(i, t)
+        self.values.insert(i, value)
+
+    def at(self, t):
+        i = bisect.bisect_right(self.times, t) - 1
+        if i < 0:
+            return None
+        return self.values[i]
+
+    def at_many(self, ts):
+        #
+        # vectorised at() for a numpy array of times, None entries come back as -1
+        #
+        if not self.times:
+            return np.full(len(ts), -1, dtype=np.int64)
+        values = np.array([-1 if v is None else v for v in self.values], dtype=np.int64)
+        idx = np.searchsorted(np.asarray(self.times), ts, side='right') - 1
+        result = np.where(idx >= 0, values[np.maximum(idx, 0)], -1)
+        return result
+
+class TagAssignmentIndex(object):
+
+    def __init__(self):
+        self.by_tag = {}
+        self.by_person = {}
+        self.last_event_id = 0
+        #
+        # events above last_event_id that were applied directly, so refresh() skips them
+        #
+        self.applied = set()
+        # assignment version the index was last refreshed at
+        self.version = None
+        self.lock = threading.RLock()
+
+    def _apply(self, tag_id, person_id, event_type, t):
+        assigned = event_type == models.ASSIGN_EVENT_ASSIGNED
+        self.by_tag.setdefault(tag_id, Timeline()).add(t, person_id if assigned else None)
+        self.by_person.setdefault(person_id, Timeline()).add(t, tag_id if assigned else None)
+
+    def add_event(self, evt):
+        with self.lock:
+            if evt.id is not None:
+                if evt.id <= self.last_event_id or evt.id in self.applied:
+                    return
+                self.applied.add(evt.id)
+            self._apply(evt.tag_id, evt.person_id, evt.event_type, evt.timestamp.timestamp())
+
+    def refresh(self, version=None):
+        # version, when given, is the assignment version read before refreshing
+        with self.lock:
+            events = models.TagAssignmentEvent.objects.filter(id__gt=self.last_event_id).order_by('id') \
+                .values_list('id', 'tag_id', 'person_id', 'event_type', 'timestamp')
+            for event_id, tag_id, person_id, event_type, ts in events.iterator():
+                if event_id not in self.applied:
+                    self._apply(tag_id, person_id, event_type, ts.timestamp())
+                self.last_event_id = event_id
+            self.applied = set(i for i in self.applied if i > self.last_event_id)
+            if version is not None:
+                self.version = version
+
+    ###########################
+    # lookups, t in epoch seconds
+    ###########################
+    def person_at(self, tag_id, t):
+        with self.lock:
+            timeline = self.by_tag.get(tag_id)
+            return timeline.at(t) if timeline is not None else None
+
+    def tag_at(self, person_id, t):
+        with self.lock:
+            timeline = self.by_person.get(person_id)
+            return timeline.at(t) if timeline is not None else None
+
+    def persons_at(self, tag_ids, ts):
+        #
+        # holder of tag_ids[i] at ts[i] for every reading, -1 where the tag was not assigned
+        # one binary search per reading, grouped by tag
+        #
+        return self._lookup_many(self.by_tag, tag_ids, ts)
+
+    def tags_at(self, person_ids, ts):
+        # tag worn by person_ids[i] at ts[i], -1 where they wore none
+        return self._lookup_many(self.by_person, person_ids, ts)
+
+    def _lookup_many(self, timelines, keys, ts):
+        keys = np.asarray(keys, dtype=np.int64)
+        ts = np.asarray(ts, dtype=np.float64)
+        result = np.full(len(keys), -1, dtype=np.int64)
+        if not len(keys):
+            return result
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+        with self.lock:
+            for s, e in zip(starts, ends):
+                timeline = timelines.get(int(sorted_keys[s]))
+                if timeline is None:
+                    continue
+                idx = order[s:e]
+                result[idx] = timeline.at_many(ts[idx])
+        return result
+
+###########################
+# process wide index
+###########################
+_lock = threading.Lock()
+_index = None
+
+def get_assignment_index(refresh=True):
+    #
+    # built on first use; refresh pulls in events written by other processes once the
+    # assignment version has moved since the index last looked
+    #
+    global _index
+    version = response_cache.get_version(ASSIGNMENTS_VERSION_KEY) if refresh or _index is None else None
+    with _lock:
+        if _index is None:
+            _index = TagAssignmentIndex()
+            _index.refresh(version)
+            return _index
+    if refresh and version != _index.version:
+        _index.refresh(version)
+    return _index
+
+def record_event(evt):
+    # keep an already built index in step with an event this process just saved
+    if _index is not None:
+        _index.add_event(evt)
+
+def bump_assignments_version():
+    #
+    # tell every process to refresh its index, once the events are committed; saves bump it
+    # through a signal, bulk_create skips signals so bulk writers call this themselves
+    #
+    transaction.on_commit(lambda: response_cache.bump_version(ASSIGNMENTS_VERSION_KEY))
+
+def _event_saved(sender, **kwargs):
+    bump_assignments_version()
+
+def connect_signals():
+    # called from InftrackappConfig.ready()
+    post_save.connect(_event_saved, sender=models.TagAssignmentEvent, dispatch_uid='assignments.event_saved')
@@ -0,0 +1,209 @@
+#######################################################################
+# benchmarks.py
+# Benchmark suite over a generated workload (see workload.py)
+#
+# Each benchmark is a function taking a BenchmarkContext and returning
+# how many items it processed (readings, positions, people...). The
+# runner times repeated calls and reports min/median/p95/max seconds,
+# items per second and database queries per run, as JSON that can be
+# kept and compared between commits.
+#
+# Views are called through the URL resolver with a RequestFactory
+# request, so routing, parameter handling and serialization are timed
+# but middleware is not.
+#######################################################################
+import datetime
+import platform
+import subprocess
+import time
+
+import numpy as np
+
+import django
+from django.conf import settings
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+
+import inftrackapp.assignments as assignments
+import inftrackapp.contacts as contacts
+import inftrackapp.ingest as ingest
+import inftrackapp.models as models
+import inftrackapp.response_cache as response_cache
+
+BENCHMARKS = []
+
+def benchmark(name, writes=False):
+    # register a benchmark; writes marks the ones that add rows to the database
+    def register(fn):
+        BENCHMARKS.append((name, fn, writes))
+        return fn
+    return register
+
+class BenchmarkContext(object):
+
+    def __init__(self, prefix='syn', batch_size=10000, seed=0):
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+        self.factory = RequestFactory()
+        people = models.TrackablePerson.objects.filter(unique_id__startswith='%s-p' % prefix)
+        self.person_ids = list(people.values_list('unique_id', flat=True))
+        if not self.person_ids:
+            raise ValueError("no generated people with prefix %s, run generate_workload first" % prefix)
+        self.tag_ids = list(models.TrackingTag.objects.filter(unique_id__startswith='%s-t' % prefix).values_list('unique_id', flat=True))
+        self.positions = models.TagPosition.objects.filter(person__unique_id__startswith='%s-p' % prefix).count()
+        self.last_timestamp = models.TagPosition.objects.filter(person__unique_id__startswith='%s-p' % prefix) \
+            .order_by('-timestamp').values_list('timestamp', flat=True).first() or timezone.now()
+        #
+        # spare tags are not worn by anyone, readings from them would only be rejected
+        #
+        index = assignments.get_assignment_index()
+        tags = models.TrackingTag.objects.filter(unique_id__startswith='%s-t' % prefix).values_list('unique_id', 'id')
+        self.worn_tags = [uid for uid, tag_id in tags if index.person_at(tag_id, self.last_timestamp.timestamp()) is not None]
+
+    def random_person(self):
+        return self.person_ids[self.rng.integers(len(self.person_ids))]
+
+    def get(self, path, data=None):
+        #
+        # call the view for path and consume the body, as a client would
+        # returns the body size in bytes
+        #
+        request = self.factory.get(path, data or {})
+        match = resolve(request.path_info)
+        response = match.func(request, *match.args, **match.kwargs)
+        if response.status_code != 200:
+            raise RuntimeError("%s returned %d" % (path, response.status_code))
+        if response.streaming:
+            return sum(len(chunk) for chunk in response.streaming_content)
+        return len(response.content)
+
+    def readings(self):
+        #
+        # a gateway batch for the currently assigned tags, just after the newest stored position
+        #
+        tags = self.worn_tags
+        n = self.batch_size
+        tag_index = self.rng.integers(len(tags), size=n)
+        start = self.last_timestamp.timestamp() + 1
+        self.last_timestamp += datetime.timedelta(seconds=10)
+        return tags, tag_index, self.rng.uniform(0, 100, n), self.rng.uniform(0, 100, n), start + self.rng.uniform(0, 10, n)
+
+###########################
+# benchmarks
+###########################
+@benchmark('ingest_ndjson', writes=True)
+def bench_ingest_ndjson(ctx):
+    tags, tag_index, x, y, t = ctx.readings()
+    lines = ['["%s", %.3f, %.3f, %.3f]' % (tags[i], xi, yi, ti) for i, xi, yi, ti in zip(tag_index.tolist(), x.tolist(), y.tolist(), t.tolist())]
+    ingest.ingest(ingest.parse_ndjson(lines))
+    return len(lines)
+
+@benchmark('ingest_binary', writes=True)
+def bench_ingest_binary(ctx):
+    body = ingest.encode_binary(*ctx.readings())
+    batch = ingest.parse_binary(body)
+    ingest.ingest(batch)
+    return len(batch)
+
+@benchmark('trace')
+def bench_trace(ctx):
+    # one page of a random person's trace over the whole dataset
+    ctx.get('/v1/people/id/%s/trace' % ctx.random_person(), {'from': '2000-01-01T00:00:00Z'})
+    return 1
+
+@benchmark('people_list')
+def bench_people_list(ctx):
+    # a fresh version each run, so the listing is built rather than served from the response cache
+    response_cache.bump_people_version()
+    ctx.get('/v1/people')
+    return len(ctx.person_ids)
+
+@benchmark('people_list_cached')
+def bench_people_list_cached(ctx):
+    ctx.get('/v1/people')
+    return len(ctx.person_ids)
+
+@benchmark('people_page')
+def bench_people_page(ctx):
+    response_cache.bump_people_version()
+    ctx.get('/v1/people', {'limit': 100, 'offset': int(ctx.rng.integers(max(1, len(ctx.person_ids) - 100)))})
+    return 100
+
+@benchmark('analyze_at_risk')
+def bench_analyze_at_risk(ctx):
+    ctx.get('/v1/analyze-at-risk/id/%s/' % ctx.random_person())
+    return 1
+
+@benchmark('find_contacts')
+def bench_find_contacts(ctx):
+    # the raw grid join, without the contact graph
+    person = models.TrackablePerson.objects.get(unique_id=ctx.random_person())
+    fromdt, todt = contacts.contact_window()
+    contacts.find_contacts(person, fromdt, todt)
+    return 1
+
+###########################
+# runner
+###########################
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(ctx, names=None, repeat=5, warmup=1, include_writes=True, progress=None):
+    results = []
+    for name, fn, writes in BENCHMARKS:
+        if names and name not in names:
+            continue
+        if writes and not include_writes:
+            continue
+        for i in range(warmup):
+            fn(ctx)
+        timings = []
+        items = 0
+        queries = 0
+        for i in range(repeat):
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                items += fn(ctx)
+                timings.append(time.perf_counter() - started)
+            queries += len(captured.captured_queries)
+        timings = np.array(timings)
+        result = {
+            "name": name,
+            "runs": repeat,
+            "min_s": float(timings.min()),
+            "median_s": float(np.median(timings)),
+            "p95_s": float(np.percentile(timings, 95)),
+            "max_s": float(timings.max()),
+            "items_per_s": float(items / timings.sum()) if timings.sum() > 0 else None,
+            "queries_per_run": queries / repeat
+        }
+        results.append(result)
+        if progress is not None:
+            progress(result)
+
+    return {
+        "generated_at": timezone.now(),
+        "commit": _git_commit(),
+        "environment": {
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "numpy": np.__version__,
+            "database": settings.DATABASES['default']['ENGINE'],
+            "machine": platform.machine()
+        },
+        "dataset": {
+            "prefix": ctx.prefix,
+            "people": len(ctx.person_ids),
+            "tags": len(ctx.tag_ids),
+            "positions": ctx.positions,
+            "ingest_batch": ctx.batch_size
+        },
+        "benchmarks": results
+    }
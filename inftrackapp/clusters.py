@@ -0,0 +1,228 @@
+#######################################################################
+# clusters.py
+# Outbreak cluster detection
+#
+# Only people whose status is in CLUSTER_STATUSES (infected and at risk by
+# default) are clustered. Two of them are linked when, within the window:
+#   - they were in contact with each other (contact graph edges adding
+#     up to at least the minimum dwell),
+#   - they were both in contact with the same third person, whatever that
+#     person's status (reported as a bridge), or
+#   - each spent at least the minimum dwell in the same zone during the
+#     same CLUSTER_ZONE_BUCKET_SECONDS.
+# Clusters are the connected components of these links, found by a
+# vectorised union-find (hook every link onto the smaller root, then
+# pointer-jump until nothing moves).
+#
+# Hotspots are the CLUSTER_HOTSPOT_CELL_METERS cells where members spent
+# the most time together (two or more of them in the cell in the same
+# contact sample), falling back to where they spent the most time at all.
+#######################################################################
+import numpy as np
+
+from django.conf import settings
+from django.db.models import Q
+
+import inftrackapp.contacts as contacts
+import inftrackapp.models as models
+import inftrackapp.positions as positions
+import inftrackapp.zones as zones
+
+def components(n, a, b):
+    #
+    # connected component label of each of n nodes given links a[i] - b[i];
+    # every component is labelled with its smallest node
+    #
+    parent = np.arange(n)
+    a = np.asarray(a, dtype=np.int64)
+    b = np.asarray(b, dtype=np.int64)
+    while True:
+        ra = parent[a]
+        rb = parent[b]
+        low = np.minimum(ra, rb)
+        before = parent.copy()
+        np.minimum.at(parent, ra, low)
+        np.minimum.at(parent, rb, low)
+        while True:
+            jumped = parent[parent]
+            if np.array_equal(jumped, parent):
+                break
+            parent = jumped
+        if np.array_equal(parent, before):
+            return parent
+
+def _link_groups(node, group):
+    # links joining every node to the first node of its group
+    if not len(node):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    order = np.lexsort((node, group))
+    node = node[order]
+    group = group[order]
+    starts = np.r_[True, group[1:] != group[:-1]]
+    first = node[np.flatnonzero(starts)][np.cumsum(starts) - 1]
+    return first, node
+
+class Cluster(object):
+    __slots__ = ('members', 'bridges', 'hotspots')
+
+    def __init__(self, members, bridges, hotspots):
+        self.members = members
+        self.bridges = bridges
+        self.hotspots = hotspots
+
+class Hotspot(object):
+    __slots__ = ('x', 'y', 'zone', 'shared_seconds', 'person_seconds')
+
+    def __init__(self, x, y, zone, shared_seconds, person_seconds):
+        self.x = x
+        self.y = y
+        self.zone = zone
+        self.shared_seconds = shared_seconds
+        self.person_seconds = person_seconds
+
+def contact_links(nodes, fromdt, todt, min_dwell_seconds):
+    #
+    # (a, b) node links from contact graph edges in [fromdt, todt), plus for each
+    # link made through a third person that person's id, else -1
+    #
+    qs = models.ContactEdge.objects.filter(bucket_start__gte=fromdt, bucket_start__lt=todt) \
+        .filter(Q(person_a_id__in=nodes.tolist()) | Q(person_b_id__in=nodes.tolist())) \
+        .values_list('person_a_id', 'person_b_id', 'duration_seconds')
+    rows = list(qs.iterator())
+    empty = np.zeros(0, dtype=np.int64)
+    if not rows:
+        return empty, empty, empty
+    a, b, duration = (np.asarray(column) for column in zip(*rows))
+    pairs, inverse = np.unique(np.stack([a, b], axis=1), axis=0, return_inverse=True)
+    total = np.bincount(inverse.reshape(-1), weights=duration)
+    pairs = pairs[total >= min_dwell_seconds]
+    a, b = pairs[:, 0], pairs[:, 1]
+    ia = np.searchsorted(nodes, a)
+    ib = np.searchsorted(nodes, b)
+    in_a = (ia < len(nodes)) & (nodes[np.minimum(ia, len(nodes) - 1)] == a)
+    in_b = (ib < len(nodes)) & (nodes[np.minimum(ib, len(nodes) - 1)] == b)
+
+    direct = in_a & in_b
+    links_a = [ia[direct]]
+    links_b = [ib[direct]]
+    via = [np.full(int(direct.sum()), -1, dtype=np.int64)]
+    #
+    # flagged people who share a contact: group the flagged end by the other end
+    #
+    flagged = np.r_[ia[in_a & ~in_b], ib[in_b & ~in_a]]
+    other = np.r_[b[in_a & ~in_b], a[in_b & ~in_a]]
+    first, node = _link_groups(flagged, other)
+    shared = first != node
+    links_a.append(first[shared])
+    links_b.append(node[shared])
+    #
+    # the third person of every bridge link, found again by its group
+    #
+    order = np.lexsort((flagged, other))
+    via.append(other[order][shared])
+    return np.concatenate(links_a), np.concatenate(links_b), np.concatenate(via)
+
+def zone_links(nodes, person, bucket, x, y, sample_seconds, min_dwell_seconds):
+    # node links between people who spent min_dwell_seconds in one zone in the same CLUSTER_ZONE_BUCKET_SECONDS
+    zone = zones.get_zone_index().lookup_many(x, y).astype(np.int64)
+    inside = zone >= 0
+    if not inside.any():
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    node = np.searchsorted(nodes, person[inside])
+    window = (bucket[inside] * sample_seconds) // settings.CLUSTER_ZONE_BUCKET_SECONDS
+    zone = zone[inside]
+    keys, counts = np.unique(np.stack([node, zone, window], axis=1), axis=0, return_counts=True)
+    keys = keys[counts * sample_seconds >= min_dwell_seconds]
+    if not len(keys):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    span = int(keys[:, 2].max()) + 1
+    return _link_groups(keys[:, 0], keys[:, 1] * span + keys[:, 2])
+
+def hotspots(label, node, bucket, x, y, sample_seconds):
+    #
+    # {cluster label: [Hotspot, ...]} best first, from the bucketized positions of clustered nodes
+    #
+    if not len(node):
+        return {}
+    cell = settings.CLUSTER_HOTSPOT_CELL_METERS
+    cx = np.floor(x / cell).astype(np.int64)
+    cy = np.floor(y / cell).astype(np.int64)
+    cluster = label[node]
+    # members in the same cell in the same sample
+    _, inverse, together = np.unique(np.stack([cluster, bucket, cx, cy], axis=1), axis=0,
+                                     return_inverse=True, return_counts=True)
+    shared = together[inverse.reshape(-1)] > 1
+    keys, inverse = np.unique(np.stack([cluster, cx, cy], axis=1), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    person_seconds = np.bincount(inverse) * sample_seconds
+    shared_seconds = np.bincount(inverse, weights=shared) * sample_seconds
+    centre_x = (keys[:, 1] + 0.5) * cell
+    centre_y = (keys[:, 2] + 0.5) * cell
+    zone_index = zones.get_zone_index()
+    names = zone_index.lookup_many(centre_x, centre_y)
+
+    result = {}
+    order = np.lexsort((-person_seconds, -shared_seconds, keys[:, 0]))
+    for i in order.tolist():
+        found = result.setdefault(int(keys[i, 0]), [])
+        if len(found) < settings.CLUSTER_HOTSPOTS:
+            found.append(Hotspot(float(centre_x[i]), float(centre_y[i]),
+                                 zone_index.names[names[i]] if names[i] >= 0 else None,
+                                 float(shared_seconds[i]), float(person_seconds[i])))
+    return result
+
+def detect(fromdt, todt, statuses=None, min_dwell_seconds=None, min_size=2):
+    #
+    # clusters of people with one of statuses between fromdt and todt, largest first
+    #
+    if statuses is None:
+        statuses = settings.CLUSTER_STATUSES
+    if min_dwell_seconds is None:
+        min_dwell_seconds = settings.CONTACT_MIN_DWELL_SECONDS
+    sample_seconds = settings.CONTACT_SAMPLE_SECONDS
+    nodes = np.asarray(sorted(models.TrackablePerson.objects.filter(status__in=list(statuses))
+                              .values_list('id', flat=True)), dtype=np.int64)
+    if len(nodes) < min_size:
+        return []
+
+    a, b, via = contact_links(nodes, fromdt, todt, min_dwell_seconds)
+    frame = positions.load_positions(fromdt, todt, person_ids=nodes.tolist())
+    person, bucket, x, y = contacts.bucketize(frame, sample_seconds)
+    za, zb = zone_links(nodes, person, bucket, x, y, sample_seconds, min_dwell_seconds)
+    label = components(len(nodes), np.r_[a, za], np.r_[b, zb])
+
+    sizes = np.bincount(label, minlength=len(nodes))
+    clustered = np.flatnonzero(sizes >= min_size)
+    if not len(clustered):
+        return []
+    node = np.searchsorted(nodes, person)
+    keep = sizes[label[node]] >= min_size
+    spots = hotspots(label, node[keep], bucket[keep], x[keep], y[keep], sample_seconds)
+
+    bridged = via >= 0
+    bridge_label = label[a[bridged]]
+    bridge_ids = via[bridged]
+    clusters = []
+    for root in clustered.tolist():
+        members = nodes[label == root].tolist()
+        bridges = sorted(set(bridge_ids[bridge_label == root].tolist()))
+        clusters.append(Cluster(members, bridges, spots.get(root, [])))
+    clusters.sort(key=lambda c: len(c.members), reverse=True)
+    return clusters
+
+def as_dicts(found):
+    # clusters as JSON-ready dicts, people by unique id
+    people = models.TrackablePerson.objects.in_bulk(set(i for c in found for i in c.members + c.bridges))
+    result = []
+    for cluster in found:
+        result.append({
+            "size": len(cluster.members),
+            "members": [{"id": people[i].unique_id, "firstname": people[i].firstname, "lastname": people[i].lastname,
+                         "status": people[i].status} for i in cluster.members],
+            "bridges": [people[i].unique_id for i in cluster.bridges],
+            "hotspots": [{"x": spot.x, "y": spot.y, "zone": spot.zone, "shared_seconds": spot.shared_seconds,
+                          "person_seconds": spot.person_seconds} for spot in cluster.hotspots]
+        })
+    return result
@@ -0,0 +1,116 @@
+#######################################################################
+# compression.py
+# Trajectory compression at ingest
+#
+# A dead-reckoning filter in front of dao.save_positions. A person's
+# path is reconstructed by holding their last stored position, so a new
+# reading only needs storing when it is further than
+# POSITION_COMPRESSION_ERROR_METERS from that position, or when
+# POSITION_COMPRESSION_MAX_INTERVAL_SECONDS have passed since it (a
+# heartbeat, which is how readers tell a still person from a silent
+# tag). Every dropped reading is within the error bound of the path
+# readers rebuild with fill_gaps, so contact detection sees the same
+# people at the same places, give or take the bound.
+#
+# State is the last stored reading per person, per process. Readings
+# arriving out of order are always stored. A process that restarts, or
+# a person whose readings are spread over several workers, only means
+# more readings are stored than strictly needed.
+#######################################################################
+import threading
+
+import numpy as np
+
+from django.conf import settings
+
+class TrajectoryCompressor(object):
+
+    def __init__(self, error_meters, max_interval_seconds):
+        self.error_meters = error_meters
+        self.max_interval_seconds = max_interval_seconds
+        # person id -> (t, x, y) of the last stored reading
+        self.last = {}
+        self.lock = threading.Lock()
+
+    def filter(self, person_ids, x, y, t):
+        #
+        # boolean mask of the readings to store; the readings of one person are judged in time order
+        #
+        person_ids = np.asarray(person_ids, dtype=np.int64)
+        keep = np.zeros(len(person_ids), dtype=bool)
+        if not len(person_ids):
+            return keep
+        order = np.lexsort((t, person_ids))
+        error_sq = self.error_meters * self.error_meters
+        max_interval = self.max_interval_seconds
+        with self.lock:
+            last = self.last
+            for i, p, xi, yi, ti in zip(order.tolist(), person_ids[order].tolist(), np.asarray(x)[order].tolist(),
+                                        np.asarray(y)[order].tolist(), np.asarray(t)[order].tolist()):
+                previous = last.get(p)
+                if previous is not None:
+                    pt, px, py = previous
+                    if ti < pt:
+                        # late reading: store it, but keep predicting from the newer one
+                        keep[i] = True
+                        continue
+                    if ti - pt < max_interval and (xi - px) * (xi - px) + (yi - py) * (yi - py) <= error_sq:
+                        continue
+                keep[i] = True
+                last[p] = (ti, xi, yi)
+        return keep
+
+_lock = threading.Lock()
+_compressor = None
+
+def get_compressor():
+    # None when compression is turned off
+    global _compressor
+    if not settings.POSITION_COMPRESSION_ENABLED:
+        return None
+    with _lock:
+        if _compressor is None:
+            _compressor = TrajectoryCompressor(settings.POSITION_COMPRESSION_ERROR_METERS,
+                                               settings.POSITION_COMPRESSION_MAX_INTERVAL_SECONDS)
+        return _compressor
+
+###########################
+# reconstruction
+###########################
+def fill_gaps(person, x, y, t, step, max_interval, until=None):
+    #
+    # rebuild the path between stored readings: after each reading, repeat its position every
+    # step seconds until the person's next reading, for at most max_interval seconds (and not
+    # past until); a longer gap means the tag went silent and stays empty
+    # returns person, x, y, t with the filled-in positions added, sorted by person and time
+    #
+    person = np.asarray(person, dtype=np.int64)
+    t = np.asarray(t, dtype=np.float64)
+    if not len(t):
+        return person, np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64), t
+    order = np.lexsort((t, person))
+    person = person[order]
+    x = np.asarray(x, dtype=np.float64)[order]
+    y = np.asarray(y, dtype=np.float64)[order]
+    t = t[order]
+
+    same = np.r_[person[1:] == person[:-1], False]
+    next_t = np.r_[t[1:], np.inf]
+    limit = np.minimum(t + max_interval, np.where(same, next_t, np.inf))
+    if until is not None:
+        limit = np.minimum(limit, until)
+    # positions at t + k * step for k >= 1 while strictly before limit
+    counts = np.maximum(np.ceil((limit - t) / step).astype(np.int64) - 1, 0)
+    counts[~np.isfinite(limit)] = 0
+    if not counts.any():
+        return person, x, y, t
+    owner = np.repeat(np.arange(len(t)), counts)
+    k = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    fill_t = t[owner] + k * step
+
+    person = np.concatenate([person, person[owner]])
+    x = np.concatenate([x, x[owner]])
+    y = np.concatenate([y, y[owner]])
+    t = np.concatenate([t, fill_t])
+    order = np.lexsort((t, person))
+    return person[order], x[order], y[order], t[order]
@@ -0,0 +1,351 @@
+#######################################################################
+# contact_graph.py
+# Incrementally maintained contact graph
+#
+# ContactEdge rows hold, per pair of people and per time bucket
+# (CONTACT_GRAPH_BUCKET_SECONDS), how long they were within contact
+# distance of each other and how close they came. The graph is advanced
+# off the request path, by `manage.py advance_contact_graph` (run with
+# --interval it keeps going): each call claims the slice of time between
+# the watermark in ContactGraphState and "now minus
+# CONTACT_GRAPH_LAG_SECONDS", runs the grid join over just that slice and
+# folds the result into the edges. Every position is therefore joined once,
+# and "who was near X" becomes an indexed lookup over X's edges; the few
+# seconds past the watermark are joined from raw positions at query time.
+#
+# Readings that arrive more than CONTACT_GRAPH_LAG_SECONDS late land below
+# the watermark, after their slice was joined. Like dwell compaction (see
+# rollups.py), the state remembers the last position id the graph has
+# seen; every step also finds the buckets below the watermark that received
+# newer rows and recomputes them whole. rebuild() recomputes a range from
+# raw positions.
+#######################################################################
+import datetime
+import logging
+
+import numpy as np
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+import inftrackapp.contacts as contacts
+import inftrackapp.models as models
+import inftrackapp.positions as positions
+
+logger = logging.getLogger(__name__)
+
+def _floor(dt, seconds):
+    return positions.epoch_to_datetime((dt.timestamp() // seconds) * seconds)
+
+def _ceil(dt, seconds):
+    return positions.epoch_to_datetime(-(-dt.timestamp() // seconds) * seconds)
+
+###########################
+# building edges
+###########################
+def edges_for_frame(frame, distance, sample_seconds, bucket_seconds):
+    #
+    # every pair in contact within the frame, aggregated per (person_a, person_b, bucket)
+    # returns parallel arrays: a, b, bucket start (epoch), samples, min distance, first and last sample (epoch)
+    #
+    pid, bucket, x, y = contacts.bucketize(frame, sample_seconds)
+    i, j, dist = contacts.grid_join(pid, bucket, x, y, distance)
+    if not len(i):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, empty, np.zeros(0), np.zeros(0), np.zeros(0)
+    a = np.minimum(pid[i], pid[j])
+    b = np.maximum(pid[i], pid[j])
+    sample = bucket[i]
+    edge_bucket = (sample * sample_seconds) // bucket_seconds
+
+    keys = np.stack([a, b, edge_bucket], axis=1)
+    ukeys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    samples = np.bincount(inverse)
+    min_dist = np.full(len(ukeys), np.inf)
+    np.minimum.at(min_dist, inverse, dist)
+    first = np.full(len(ukeys), np.iinfo(np.int64).max)
+    np.minimum.at(first, inverse, sample)
+    last = np.full(len(ukeys), np.iinfo(np.int64).min)
+    np.maximum.at(last, inverse, sample)
+    return (ukeys[:, 0], ukeys[:, 1], ukeys[:, 2] * bucket_seconds, samples,
+            min_dist, first * sample_seconds, (last + 1) * sample_seconds)
+
+def merge_edges(a, b, bucket_start, samples, min_dist, first, last, sample_seconds):
+    #
+    # fold freshly computed edges into ContactEdge: one query for the existing rows,
+    # then a bulk update and a bulk insert in one transaction
+    #
+    if not len(a):
+        return 0
+    to_dt = positions.epoch_to_datetime
+    starts = sorted(set(bucket_start.tolist()))
+    existing = {}
+    qs = models.ContactEdge.objects.filter(bucket_start__in=[to_dt(s) for s in starts], person_a_id__in=list(set(a.tolist())))
+    for edge in qs:
+        existing[(edge.person_a_id, edge.person_b_id, edge.bucket_start.timestamp())] = edge
+
+    updated = []
+    created = []
+    for pa, pb, start, n, dist, t0, t1 in zip(a.tolist(), b.tolist(), bucket_start.tolist(), samples.tolist(),
+                                              min_dist.tolist(), first.tolist(), last.tolist()):
+        edge = existing.get((pa, pb, float(start)))
+        if edge is None:
+            created.append(models.ContactEdge(person_a_id=pa, person_b_id=pb, bucket_start=to_dt(start),
+                                              duration_seconds=n * sample_seconds, min_distance=dist,
+                                              first_contact=to_dt(t0), last_contact=to_dt(t1)))
+        else:
+            edge.duration_seconds += n * sample_seconds
+            edge.min_distance = min(edge.min_distance, dist)
+            edge.first_contact = min(edge.first_contact, to_dt(t0))
+            edge.last_contact = max(edge.last_contact, to_dt(t1))
+            updated.append(edge)
+    with transaction.atomic():
+        if updated:
+            models.ContactEdge.objects.bulk_update(updated, ['duration_seconds', 'min_distance', 'first_contact', 'last_contact'], batch_size=1000)
+        if created:
+            models.ContactEdge.objects.bulk_create(created, batch_size=1000)
+    return len(updated) + len(created)
+
+def replace_edges(fromdt, todt, a, b, bucket_start, samples, min_dist, first, last, sample_seconds):
+    #
+    # swap every edge with a bucket in [fromdt, todt) for the given ones in one transaction,
+    # so writing the same edges twice leaves the graph as writing them once
+    #
+    to_dt = positions.epoch_to_datetime
+    created = [models.ContactEdge(person_a_id=pa, person_b_id=pb, bucket_start=to_dt(start),
+                                  duration_seconds=n * sample_seconds, min_distance=dist,
+                                  first_contact=to_dt(t0), last_contact=to_dt(t1))
+               for pa, pb, start, n, dist, t0, t1 in zip(a.tolist(), b.tolist(), bucket_start.tolist(), samples.tolist(),
+                                                         min_dist.tolist(), first.tolist(), last.tolist())]
+    with transaction.atomic():
+        models.ContactEdge.objects.filter(bucket_start__gte=fromdt, bucket_start__lt=todt).delete()
+        models.ContactEdge.objects.bulk_create(created, batch_size=1000)
+    return len(created)
+
+def compute_edges(fromdt, todt, distance=None, reassign=False):
+    # edges_for_frame over the positions in [fromdt, todt), see positions.load_positions for reassign
+    if distance is None:
+        distance = settings.CONTACT_DISTANCE_METERS
+    frame = positions.load_positions(fromdt, todt - datetime.timedelta(microseconds=1), reassign=reassign)
+    return edges_for_frame(frame, distance, settings.CONTACT_SAMPLE_SECONDS, settings.CONTACT_GRAPH_BUCKET_SECONDS)
+
+def process_range(fromdt, todt):
+    #
+    # join the positions in [fromdt, todt) and fold them into the graph
+    # both ends must fall on sample boundaries so no sample is split between calls
+    #
+    return merge_edges(*compute_edges(fromdt, todt), sample_seconds=settings.CONTACT_SAMPLE_SECONDS)
+
+def late_buckets(state, until):
+    #
+    # starts of the buckets in [covered_from, until) that received positions after the
+    # previous step; none before the first step has recorded a position id
+    #
+    if state.processed_position_id is None:
+        return []
+    bucket_seconds = settings.CONTACT_GRAPH_BUCKET_SECONDS
+    qs = models.TagPosition.objects.filter(timestamp__gte=state.covered_from, timestamp__lt=until,
+                                           id__gt=state.processed_position_id)
+    # whole hours are cheap to find; an hour can span several shorter buckets
+    buckets = set()
+    for hour in qs.datetimes('timestamp', 'hour', tzinfo=datetime.timezone.utc):
+        start = max(_floor(hour, bucket_seconds), _floor(state.covered_from, bucket_seconds))
+        end = min(hour + datetime.timedelta(hours=1), until)
+        while start < end:
+            buckets.add(start)
+            start += datetime.timedelta(seconds=bucket_seconds)
+    return sorted(buckets)
+
+def refresh_buckets(starts, until):
+    #
+    # recompute the given buckets from raw positions, replacing their edges; the bucket
+    # holding until is only recomputed up to it, the rest is joined by later steps
+    #
+    written = 0
+    for start in starts:
+        end = min(start + datetime.timedelta(seconds=settings.CONTACT_GRAPH_BUCKET_SECONDS), until)
+        written += replace_edges(start, end, *compute_edges(start, end), sample_seconds=settings.CONTACT_SAMPLE_SECONDS)
+    return written
+
+###########################
+# watermark
+###########################
+def get_state():
+    return models.ContactGraphState.objects.order_by('id').first()
+
+def _create_state(at):
+    #
+    # the single state row has a fixed id, so two processes starting the graph at
+    # the same time end up with one row; returns (state, created)
+    #
+    return models.ContactGraphState.objects.get_or_create(pk=1, defaults={'covered_from': at, 'processed_until': at})
+
+def _claim(state, start, end):
+    # compare-and-set, so two workers never join the same slice
+    return models.ContactGraphState.objects.filter(pk=state.pk, processed_until=start).update(processed_until=end) == 1
+
+def advance(now=None):
+    #
+    # bring the graph up to now - lag; cheap no-op when there is not yet a whole step to do
+    # returns the number of edges written
+    #
+    if not settings.CONTACT_GRAPH_ENABLED:
+        return 0
+    sample_seconds = settings.CONTACT_SAMPLE_SECONDS
+    if now is None:
+        now = timezone.now()
+    end = _floor(now - datetime.timedelta(seconds=settings.CONTACT_GRAPH_LAG_SECONDS), sample_seconds)
+    # taken before reading anything, rows written from here on are looked at by the next step
+    last_id = models.TagPosition.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+
+    state = get_state()
+    if state is None:
+        #
+        # the graph starts from here; earlier history is built with rebuild()
+        #
+        state, created = _create_state(end)
+        if created:
+            return 0
+
+    start = state.processed_until
+    if (end - start).total_seconds() < settings.CONTACT_GRAPH_MIN_STEP_SECONDS:
+        return 0
+    end = min(end, start + datetime.timedelta(seconds=settings.CONTACT_GRAPH_MAX_STEP_SECONDS))
+    if not _claim(state, start, end):
+        return 0
+    try:
+        #
+        # late rows below the old watermark first: the bucket holding start is replaced
+        # up to start, then the new slice is merged into it
+        #
+        written = 0
+        late = late_buckets(state, start)
+        if late:
+            written += refresh_buckets(late, start)
+            logger.info("recomputed %d contact graph buckets that received late positions", len(late))
+        written += process_range(start, end)
+    except Exception:
+        #
+        # hand the slice back so the next call retries it
+        #
+        models.ContactGraphState.objects.filter(pk=state.pk, processed_until=end).update(processed_until=start)
+        logger.exception("contact graph update for %s - %s failed", start, end)
+        return 0
+    models.ContactGraphState.objects.filter(pk=state.pk).update(processed_position_id=last_id)
+    return written
+
+def rebuild(fromdt, todt=None, step_seconds=None):
+    #
+    # recompute the graph from raw positions for [fromdt, now - lag) (or up to todt),
+    # replacing any edges already in that range
+    # returns the number of edges written
+    #
+    bucket_seconds = settings.CONTACT_GRAPH_BUCKET_SECONDS
+    fromdt = _floor(fromdt, bucket_seconds)
+    if todt is None:
+        todt = timezone.now() - datetime.timedelta(seconds=settings.CONTACT_GRAPH_LAG_SECONDS)
+    todt = _floor(todt, settings.CONTACT_SAMPLE_SECONDS)
+    if step_seconds is None:
+        step_seconds = bucket_seconds
+
+    state = get_state()
+    if state is None:
+        state, created = _create_state(fromdt)
+    if todt < state.processed_until:
+        #
+        # edges are replaced whole, so finish the bucket todt falls in
+        #
+        bucket_end = _floor(todt, bucket_seconds)
+        if bucket_end < todt:
+            bucket_end += datetime.timedelta(seconds=bucket_seconds)
+        todt = min(bucket_end, state.processed_until)
+    models.ContactEdge.objects.filter(bucket_start__gte=fromdt, bucket_start__lt=todt).delete()
+    written = 0
+    start = fromdt
+    while start < todt:
+        end = min(todt, start + datetime.timedelta(seconds=step_seconds))
+        written += process_range(start, end)
+        start = end
+    state.covered_from = min(state.covered_from, fromdt)
+    state.processed_until = max(state.processed_until, todt)
+    state.save()
+    return written
+
+###########################
+# lookups
+###########################
+class EdgeContact(object):
+    #
+    # a contact summed over graph edges; same reporting attributes as contacts.Contact
+    #
+    __slots__ = ('other_id', 'duration_seconds', 'min_distance', 'first_seen', 'last_seen')
+
+    def __init__(self, other_id, duration_seconds, min_distance, first_seen, last_seen):
+        self.other_id = other_id
+        self.duration_seconds = duration_seconds
+        self.min_distance = min_distance
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+
+    def add(self, duration_seconds, min_distance, first_seen, last_seen):
+        self.duration_seconds += duration_seconds
+        self.min_distance = min(self.min_distance, min_distance)
+        self.first_seen = min(self.first_seen, first_seen)
+        self.last_seen = max(self.last_seen, last_seen)
+
+def covers(fromdt):
+    # True when the graph holds every contact from fromdt onwards (up to its watermark)
+    if not settings.CONTACT_GRAPH_ENABLED:
+        return False
+    state = get_state()
+    return state is not None and state.covered_from <= fromdt
+
+def contacts_of(person, fromdt, todt, min_dwell_seconds=None):
+    #
+    # everyone with at least min_dwell_seconds of contact with person in [fromdt, todt), longest
+    # first; reads person's own edges for the buckets that lie wholly inside the window, and
+    # joins raw positions for the rest: the part of a bucket cut by fromdt or todt, and the few
+    # seconds past the watermark the graph has not caught up with yet
+    #
+    if min_dwell_seconds is None:
+        min_dwell_seconds = settings.CONTACT_MIN_DWELL_SECONDS
+    bucket_seconds = settings.CONTACT_GRAPH_BUCKET_SECONDS
+    processed_until = get_state().processed_until
+    edges_from = _ceil(fromdt, bucket_seconds)
+    if todt <= processed_until:
+        edges_to = _floor(todt, bucket_seconds)
+    else:
+        # the bucket holding the watermark only has edges up to it
+        edges_to = processed_until
+    found = {}
+
+    def add(other, duration, dist, first, last):
+        if other not in found:
+            found[other] = EdgeContact(other, duration, dist, first, last)
+        else:
+            found[other].add(duration, dist, first, last)
+
+    def add_raw(start, end):
+        # find_contacts includes its end, the edges after it do not
+        for c in contacts.find_contacts(person, start, end - datetime.timedelta(microseconds=1), min_dwell_seconds=0):
+            add(c.other_id, c.duration_seconds, c.min_distance, c.first_seen, c.last_seen)
+
+    if edges_from >= edges_to:
+        add_raw(fromdt, todt)
+    else:
+        edges = models.ContactEdge.objects.filter(Q(person_a=person) | Q(person_b=person),
+                                                  bucket_start__gte=edges_from, bucket_start__lt=edges_to) \
+            .values_list('person_a_id', 'person_b_id', 'duration_seconds', 'min_distance', 'first_contact', 'last_contact')
+        for pa, pb, duration, dist, first, last in edges.iterator():
+            add(pb if pa == person.id else pa, duration, dist, first, last)
+        if fromdt < edges_from:
+            add_raw(fromdt, edges_from)
+        if edges_to < todt:
+            add_raw(edges_to, todt)
+
+    result = [c for c in found.values() if c.duration_seconds >= min_dwell_seconds]
+    result.sort(key=lambda c: c.duration_seconds, reverse=True)
+    return result
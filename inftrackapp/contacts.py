@@ -0,0 +1,266 @@
+#######################################################################
+# contacts.py
+# Spatio-temporal contact detection
+#
+# Positions are reduced to one point per (person, time bucket) and then
+# hash-joined on (time bucket, grid cell), where a grid cell is as wide
+# as the contact distance. Only points in the same or a neighbouring
+# cell of the same bucket are ever compared, so the cost is linear in
+# the number of positions rather than quadratic.
+#
+# find_contacts does not load everyone's positions over the index
+# person's window: per LOAD_CHUNK of the index person's trace it first
+# asks the stores for the ids of the people seen within the contact
+# distance of the box the index person moved in, then loads only their
+# positions, and only for the time the index person was seen.
+#######################################################################
+import datetime
+
+import numpy as np
+
+from django.conf import settings
+from django.utils import timezone
+
+import inftrackapp.positions as positions
+
+# the four "forward" neighbours plus the cell itself: enough to see every
+# unordered pair of adjacent cells exactly once
+HALF_NEIGHBOURS = ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1))
+ALL_NEIGHBOURS = tuple((dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1))
+
+# find_contacts narrows down the other people per this much of the index person's trace
+LOAD_CHUNK_SECONDS = 3600
+
+###########################
+# bucketing and grid join
+###########################
+def bucketize(frame, sample_seconds):
+    #
+    # collapse to one (mean) point per person per time bucket
+    # returns (person, bucket, x, y) arrays sorted by person then bucket
+    #
+    if not len(frame):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0), np.zeros(0)
+    bucket = np.floor(frame.t / sample_seconds).astype(np.int64)
+    base = bucket.min()
+    span = bucket.max() - base + 1
+    key = frame.person * span + (bucket - base)
+    ukey, inverse = np.unique(key, return_inverse=True)
+    counts = np.bincount(inverse)
+    x = np.bincount(inverse, weights=frame.x) / counts
+    y = np.bincount(inverse, weights=frame.y) / counts
+    return ukey // span, ukey % span + base, x, y
+
+def _expand_ranges(lo, hi):
+    # for ranges [lo[i], hi[i]) return (owner index, position) for every element
+    counts = hi - lo
+    total = int(counts.sum())
+    owner = np.repeat(np.arange(len(lo)), counts)
+    starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+    return owner, starts + np.arange(total)
+
+def grid_join(person, bucket, x, y, distance, left=None):
+    #
+    # all pairs (i, j) of bucketed points in the same bucket within distance of each other
+    # with left=None every unordered pair is returned once, otherwise only pairs with
+    # i taken from the left index array
+    #
+    if not len(person):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0)
+    cx = np.floor(x / distance).astype(np.int64)
+    cy = np.floor(y / distance).astype(np.int64)
+    cx -= cx.min() - 1
+    cy -= cy.min() - 1
+    width = cx.max() + 2
+    height = cy.max() + 2
+    key = (bucket * width + cx) * height + cy
+    order = np.argsort(key, kind='stable')
+    skey = key[order]
+
+    if left is None:
+        left = order
+        offsets = HALF_NEIGHBOURS
+    else:
+        left = np.asarray(left, dtype=np.int64)
+        left = left[np.argsort(key[left], kind='stable')]
+        offsets = ALL_NEIGHBOURS
+
+    #
+    # a neighbouring cell's key is the point's own key plus a constant, so probing
+    # in key order keeps the binary searches cache friendly
+    #
+    lkey = key[left]
+    pairs_i = []
+    pairs_j = []
+    for dx, dy in offsets:
+        nkey = lkey + (dx * height + dy)
+        lo = np.searchsorted(skey, nkey, side='left')
+        hi = np.searchsorted(skey, nkey, side='right')
+        owner, pos = _expand_ranges(lo, hi)
+        i = left[owner]
+        j = order[pos]
+        keep = person[i] != person[j]
+        if offsets is HALF_NEIGHBOURS and (dx, dy) == (0, 0):
+            keep &= i < j
+        pairs_i.append(i[keep])
+        pairs_j.append(j[keep])
+
+    i = np.concatenate(pairs_i)
+    j = np.concatenate(pairs_j)
+    dist = np.hypot(x[i] - x[j], y[i] - y[j])
+    close = dist <= distance
+    return i[close], j[close], dist[close]
+
+###########################
+# contacts
+###########################
+class Contact(object):
+    #
+    # buckets are the sorted time buckets the two were in range; x and y hold the
+    # index person's position in each of those buckets
+    #
+    __slots__ = ('person_id', 'other_id', 'buckets', 'x', 'y', 'min_distance', 'sample_seconds')
+
+    def __init__(self, person_id, other_id, buckets, x, y, min_distance, sample_seconds):
+        self.person_id = person_id
+        self.other_id = other_id
+        self.buckets = buckets
+        self.x = x
+        self.y = y
+        self.min_distance = min_distance
+        self.sample_seconds = sample_seconds
+
+    @property
+    def duration_seconds(self):
+        return len(self.buckets) * self.sample_seconds
+
+    @property
+    def first_seen(self):
+        return positions.epoch_to_datetime(self.buckets[0] * self.sample_seconds)
+
+    @property
+    def last_seen(self):
+        return positions.epoch_to_datetime((self.buckets[-1] + 1) * self.sample_seconds)
+
+def contact_window(days=None, todt=None):
+    if todt is None:
+        todt = timezone.now()
+    if days is None:
+        days = settings.CONTACT_LOOKBACK_DAYS
+    return todt - datetime.timedelta(days=days), todt
+
+def find_contacts(person, fromdt, todt, distance=None, min_dwell_seconds=None, sample_seconds=None):
+    #
+    # everyone who spent at least min_dwell_seconds within distance of person between fromdt and todt
+    # returns Contact objects, longest exposure first
+    #
+    if distance is None:
+        distance = settings.CONTACT_DISTANCE_METERS
+    if min_dwell_seconds is None:
+        min_dwell_seconds = settings.CONTACT_MIN_DWELL_SECONDS
+    if sample_seconds is None:
+        sample_seconds = settings.CONTACT_SAMPLE_SECONDS
+
+    trace = positions.load_positions(fromdt, todt, person_ids=[person.id])
+    if not len(trace):
+        return []
+    trace = trace.select(np.argsort(trace.t, kind='stable'))
+    frames = [trace]
+    # gap filling holds a stored position this long, so people may be near from a reading before the chunk
+    held = settings.POSITION_COMPRESSION_MAX_INTERVAL_SECONDS if settings.POSITION_COMPRESSION_ENABLED else 0
+    chunk = np.floor(trace.t / LOAD_CHUNK_SECONDS)
+    starts = np.flatnonzero(np.r_[True, chunk[1:] != chunk[:-1]])
+    ends = np.r_[starts[1:], len(trace)]
+    for s, e in zip(starts, ends):
+        #
+        # only the part of the chunk the index person was actually seen in, and only people
+        # with a position within distance of where they went, can produce contacts
+        #
+        t, x, y = trace.t[s:e], trace.x[s:e], trace.y[s:e]
+        tmin = max(fromdt, positions.epoch_to_datetime(np.floor(t.min() / sample_seconds) * sample_seconds))
+        tmax = min(todt, positions.epoch_to_datetime((np.floor(t.max() / sample_seconds) + 1) * sample_seconds))
+        bounds = (x.min() - distance, y.min() - distance, x.max() + distance, y.max() + distance)
+        near = positions.people_within(tmin - datetime.timedelta(seconds=held), tmax, bounds, exclude_person_ids=[person.id])
+        if near:
+            frames.append(positions.load_positions(tmin, tmax, person_ids=near))
+    return contacts_from_frame(positions.PositionFrame.concat(frames), person.id,
+                               distance, min_dwell_seconds, sample_seconds)
+
+def contacts_from_frame(frame, person_id, distance, min_dwell_seconds, sample_seconds):
+    pid, bucket, x, y = bucketize(frame, sample_seconds)
+    left = np.flatnonzero(pid == person_id)
+    if not len(left):
+        return []
+    i, j, dist = grid_join(pid, bucket, x, y, distance, left=left)
+    if not len(i):
+        return []
+
+    other = pid[j]
+    order = np.lexsort((bucket[j], other))
+    other = other[order]
+    buckets = bucket[j][order]
+    hit_x = x[i][order]
+    hit_y = y[i][order]
+    dist = dist[order]
+    starts = np.flatnonzero(np.r_[True, other[1:] != other[:-1]])
+    ends = np.r_[starts[1:], len(other)]
+
+    contacts = []
+    for s, e in zip(starts, ends):
+        if (e - s) * sample_seconds < min_dwell_seconds:
+            continue
+        contacts.append(Contact(person_id, int(other[s]), buckets[s:e], hit_x[s:e], hit_y[s:e],
+                                float(dist[s:e].min()), sample_seconds))
+    contacts.sort(key=lambda c: c.duration_seconds, reverse=True)
+    return contacts
+
+###########################
+# exposure intervals
+###########################
+class ExposureInterval(object):
+    __slots__ = ('other_id', 'start', 'end', 'zone')
+
+    def __init__(self, other_id, start, end, zone):
+        self.other_id = other_id
+        self.start = start
+        self.end = end
+        self.zone = zone
+
+    @property
+    def duration_seconds(self):
+        return (self.end - self.start).total_seconds()
+
+def exposure_intervals(contact, zone_index, gap_seconds=None, min_duration_seconds=None):
+    #
+    # merge the contact's proximity hits into contiguous intervals, bridging gaps of up to
+    # gap_seconds, and label each with the zone most of its hits fell in
+    #
+    if gap_seconds is None:
+        gap_seconds = settings.EXPOSURE_GAP_SECONDS
+    if min_duration_seconds is None:
+        min_duration_seconds = settings.EXPOSURE_MIN_DURATION_SECONDS
+    buckets = contact.buckets
+    if not len(buckets):
+        return []
+    sample_seconds = contact.sample_seconds
+    max_step = max(1, int(gap_seconds // sample_seconds) + 1)
+    breaks = np.flatnonzero(np.diff(buckets) > max_step) + 1
+    starts = np.r_[0, breaks]
+    ends = np.r_[breaks, len(buckets)]
+
+    zone_ids = zone_index.lookup_many(contact.x, contact.y)
+    intervals = []
+    for s, e in zip(starts, ends):
+        start = buckets[s] * sample_seconds
+        end = (buckets[e - 1] + 1) * sample_seconds
+        if end - start < min_duration_seconds:
+            continue
+        in_zone = zone_ids[s:e]
+        in_zone = in_zone[in_zone >= 0]
+        zone = None
+        if len(in_zone):
+            zone = zone_index.names[int(np.bincount(in_zone).argmax())]
+        intervals.append(ExposureInterval(contact.other_id, positions.epoch_to_datetime(start), positions.epoch_to_datetime(end), zone))
+    return intervals
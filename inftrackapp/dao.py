@@ -3,9 +3,14 @@
 # Database helper functions
 #######################################################################
 import datetime
-from django.utils.timezone import make_aware
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.timezone import is_aware, make_aware
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 import inftrackapp.models as models
+import inftrackapp.assignments as assignments
+import inftrackapp.response_cache as response_cache
 
 def add_secs_to_datetime(dtobj,secs=1):
     return dtobj + datetime.timedelta(seconds=secs)
@@ -48,32 +53,62 @@ def add_tag(unique_id=None):
     return tag
 
 def unassign_tag(tag,dt):
-    current_person = tag.current_person
-    if current_person:
+    aware_dt = to_aware(dt)
+    current_person_id = assignments.get_assignment_index().person_at(tag.id,aware_dt.timestamp())
+    if current_person_id is not None:
         evt = models.TagAssignmentEvent()
         evt.tag=tag
-        evt.person=current_person
+        evt.person_id=current_person_id
         evt.event_type=models.ASSIGN_EVENT_UNASSIGNED
-        evt.timestamp = make_aware(dt)
-        evt.save() 
+        evt.timestamp = aware_dt
+        evt.save()
+        assignments.record_event(evt)
 
 def assign_tag(tag,person,dt):
+    # a tag already held at dt is unassigned first
+    assign_tags([(tag,person,dt)])
+
+def assign_tags(assignments_in):
     #
-    # is this tag assigned to anyone right now?
+    # assignments_in: (tag, person, dt) triples, applied as assign_tag would in time order
+    # the holders of every tag come from the assignment index (refreshed with one query), and all
+    # unassign/assign TagAssignmentEvents are written with bulk_create in a single transaction
+    # returns the id of the person each tag was taken from (None if it was free), in input order
     #
-    current_person = tag.current_person
-    if current_person:
-        # make sure this dt is before assignment dt?
-        unassign_tag(tag,current_person,dt)
-    evt = models.TagAssignmentEvent()
-    evt.tag=tag
-    evt.person=person
-    evt.event_type=models.ASSIGN_EVENT_ASSIGNED
-
-    newdt = add_secs_to_datetime(dt,secs=1)
-
-    evt.timestamp = make_aware(newdt)
-    evt.save() 
+    index = assignments.get_assignment_index()
+    order = sorted(range(len(assignments_in)), key=lambda i: to_aware(assignments_in[i][2]))
+    # tag id -> (person id, epoch seconds) of an assignment earlier in this batch
+    assigned = {}
+    holders = [None] * len(assignments_in)
+    events = []
+    for i in order:
+        tag, person, dt = assignments_in[i]
+        aware_dt = to_aware(dt)
+        t = aware_dt.timestamp()
+        earlier = assigned.get(tag.id)
+        holder = earlier[0] if earlier is not None and earlier[1] <= t else index.person_at(tag.id,t)
+        if holder is not None:
+            events.append(models.TagAssignmentEvent(tag=tag,person_id=holder,event_type=models.ASSIGN_EVENT_UNASSIGNED,timestamp=aware_dt))
+        newdt = add_secs_to_datetime(aware_dt,secs=1)
+        events.append(models.TagAssignmentEvent(tag=tag,person=person,event_type=models.ASSIGN_EVENT_ASSIGNED,timestamp=newdt))
+        assigned[tag.id] = (person.id,newdt.timestamp())
+        holders[i] = holder
+    with transaction.atomic():
+        models.TagAssignmentEvent.objects.bulk_create(events,batch_size=1000)
+        assignments.bump_assignments_version()
+    # bulk_create leaves primary keys unset on some backends, so the index picks the events up by id
+    index.refresh()
+    return holders
+
+def get_tag_holder(tag,dt):
+    # id of the person wearing tag at dt (aware), or None
+    return assignments.get_assignment_index().person_at(tag.id,dt.timestamp())
+
+def to_aware(dt):
+    # callers pass naive UTC datetimes, but aware ones are fine too
+    if is_aware(dt):
+        return dt
+    return make_aware(dt)
 
 def change_person_status(person,status,dt):
     prior_status=person.status
@@ -83,21 +118,79 @@ def change_person_status(person,status,dt):
     evt=models.StatusChangeEvent()
     evt.person=person
     evt.prior_status=prior_status
-    evt.status=person.status
-    evt.timestamp=make_aware(dt)
+    evt.new_status=person.status
+    evt.timestamp=to_aware(dt)
     evt.save()
+    return evt
+
+STATUS_RESULT_UPDATED = "updated"
+STATUS_RESULT_UNCHANGED = "unchanged"
+STATUS_RESULT_NOT_FOUND = "not_found"
+STATUS_RESULT_INVALID = "invalid_status"
+
+def change_people_status(updates,dt):
+    #
+    # updates: (unique_id, status) pairs
+    # people are looked up in one query, and the status updates and their StatusChangeEvents
+    # are written in bulk in a single transaction; a person listed twice keeps the last status
+    # returns one result dict per input pair, in order
+    #
+    aware_dt = to_aware(dt)
+    unique_ids = set(unique_id for unique_id, status in updates)
+    people = dict((p.unique_id, p) for p in models.TrackablePerson.objects.filter(unique_id__in=list(unique_ids)).only('id','unique_id','status'))
+
+    results = []
+    changed = {}
+    prior = {}
+    for unique_id, status in updates:
+        person = people.get(unique_id)
+        if status not in models.STATUS_CHECK:
+            results.append({"id": unique_id, "result": STATUS_RESULT_INVALID, "status": status})
+            continue
+        if person is None:
+            results.append({"id": unique_id, "result": STATUS_RESULT_NOT_FOUND, "status": status})
+            continue
+        prior.setdefault(unique_id, person.status)
+        result = STATUS_RESULT_UPDATED if status != person.status else STATUS_RESULT_UNCHANGED
+        results.append({"id": unique_id, "result": result, "prior_status": person.status, "status": status})
+        person.status = status
+        changed[unique_id] = person
+
+    events = []
+    for unique_id, person in changed.items():
+        if person.status == prior[unique_id]:
+            continue
+        person.modified = timezone.now()
+        events.append(models.StatusChangeEvent(person=person, prior_status=prior[unique_id], new_status=person.status, timestamp=aware_dt))
+    if events:
+        with transaction.atomic():
+            models.TrackablePerson.objects.bulk_update([e.person for e in events], ['status','modified'], batch_size=1000)
+            models.StatusChangeEvent.objects.bulk_create(events, batch_size=1000)
+        response_cache.bump_people_version()
+    return results
 
 def make_position(tag,person,x,y,timestamp):
-    tagpos = models.TagPosition(tag=tag,person=person,x=x,y=y,timestamp=make_aware(timestamp))
+    tagpos = models.TagPosition(tag=tag,person=person,x=x,y=y,timestamp=to_aware(timestamp))
     return tagpos
 
 def save_position(tag,person,x,y,timestamp):
-    tagpos = models.TagPosition(tag=tag,person=person,x=x,y=y,timestamp=make_aware(timestamp))
+    tagpos = models.TagPosition(tag=tag,person=person,x=x,y=y,timestamp=to_aware(timestamp))
     return tagpos
 
 def save_positions(tagpos_list):
-    models.TagPosition.objects.bulk_create(tagpos_list)
+    models.TagPosition.objects.bulk_create(tagpos_list,batch_size=settings.INGEST_BULK_CHUNK_SIZE)
 
 def get_person_position_trace(person,fromdt,todt):
-    return models.TagPosition.objects.filter(timestamp__gte=fromdt, timestamp__lte=todt)
-
+    # served by the (person, timestamp) index
+    return models.TagPosition.objects.filter(person=person, timestamp__gte=fromdt, timestamp__lte=todt).order_by('timestamp','id')
+
+def add_zone(name,points):
+    zone = models.Zone()
+    zone.name = name
+    zone.points = points
+    zone.full_clean()
+    zone.save()
+    return zone
+
+def get_zone(name):
+    return models.Zone.objects.get_or_none(name=name)
@@ -0,0 +1,253 @@
+#######################################################################
+# export.py
+# Streaming bulk export of positions and contacts
+#
+# Investigators get a person's trace, or every position in a time window,
+# and the contact graph edges for the same person or window, as files.
+# Rows are read with server-side cursors EXPORT_CHUNK_ROWS at a time and
+# each chunk is encoded and sent before the next is read, so memory stays
+# bounded however large the export and the first bytes go out at once.
+#
+# Positions are exported as stored: readings dropped by compression at
+# ingest are not filled back in, and compacted history comes out as
+# dwell segment centroids.
+#
+# Two formats:
+#
+# CSV, with a header row and ISO 8601 UTC times.
+#
+# Columnar binary (little endian), a sequence of blocks:
+#     magic         4 bytes, b'ITXP' (positions) or b'ITXC' (contacts)
+#     then per block:
+#     npeople       uint32, people first referenced in this block
+#     npeople x     int32 person id, uint8 length, utf-8 unique_id
+#     nrows         uint32
+#     one column after another, nrows values each (see COLUMNS)
+# A block with npeople == nrows == 0 ends the file, so a truncated
+# download is detected. decode_binary reads it back into numpy arrays.
+#######################################################################
+import csv
+import datetime
+import io
+import itertools
+import struct
+
+import numpy as np
+
+from django.conf import settings
+from django.db.models import Q
+
+import inftrackapp.models as models
+import inftrackapp.positions as positions
+import inftrackapp.segments as segments
+
+POSITIONS = 'positions'
+CONTACTS = 'contacts'
+KINDS = (POSITIONS, CONTACTS)
+
+FORMAT_CSV = 'csv'
+FORMAT_BINARY = 'binary'
+FORMATS = (FORMAT_CSV, FORMAT_BINARY)
+CONTENT_TYPES = {FORMAT_CSV: 'text/csv', FORMAT_BINARY: 'application/octet-stream'}
+EXTENSIONS = {FORMAT_CSV: 'csv', FORMAT_BINARY: 'bin'}
+
+MAGIC = {POSITIONS: b'ITXP', CONTACTS: b'ITXC'}
+# times are epoch microseconds; person columns hold person ids, resolved through the people table
+COLUMNS = {
+    POSITIONS: (('timestamp', '<i8'), ('person', '<i4'), ('x', '<f4'), ('y', '<f4')),
+    CONTACTS: (('bucket_start', '<i8'), ('person_a', '<i4'), ('person_b', '<i4'), ('first_contact', '<i8'),
+               ('last_contact', '<i8'), ('duration_seconds', '<f4'), ('min_distance', '<f4')),
+}
+PERSON_COLUMNS = {POSITIONS: ('person',), CONTACTS: ('person_a', 'person_b')}
+TIME_COLUMNS = {POSITIONS: ('timestamp',), CONTACTS: ('bucket_start', 'first_contact', 'last_contact')}
+
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+def _micros(dt):
+    return int(round(dt.timestamp() * segments.MICROS))
+
+def _batches(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+def _chunk(kind, rows):
+    # list of row tuples in COLUMNS order -> dict of column arrays
+    columns = zip(*rows)
+    return {name: np.asarray(values) for (name, _), values in zip(COLUMNS[kind], columns)}
+
+def _split(kind, chunk, size):
+    # re-cut a large chunk (a whole sealed hour, say) into pieces of at most size rows
+    n = len(chunk[COLUMNS[kind][0][0]])
+    for start in range(0, n, size):
+        yield {name: values[start:start + size] for name, values in chunk.items()}
+
+###########################
+# reading
+###########################
+def position_chunks(fromdt, todt, person=None, chunk_rows=None):
+    #
+    # positions with fromdt <= timestamp <= todt in time order, as dicts of column arrays;
+    # one person's trace, or everyone's positions when person is None
+    #
+    if chunk_rows is None:
+        chunk_rows = settings.EXPORT_CHUNK_ROWS
+    if person is not None:
+        rows = ((micros, person.id, x, y) for micros, _, x, y in positions.iter_trace(person, fromdt, todt))
+        for batch in _batches(rows, chunk_rows):
+            yield _chunk(POSITIONS, batch)
+        return
+
+    compacted = positions.compacted_until()
+    store = segments.get_segment_store()
+    sealed = store.sealed_until() if store is not None else None
+    hour = segments.floor_hour(fromdt)
+    #
+    # history that no longer has database rows is read an hour at a time
+    #
+    while hour <= todt and ((compacted is not None and hour < compacted) or (sealed is not None and hour < sealed)):
+        lo = max(fromdt, hour)
+        hi = min(todt, hour + segments.HOUR - MICROSECOND)
+        if compacted is not None and hour < compacted:
+            frame = positions.load_dwell_positions(lo, hi + MICROSECOND)
+            micros = np.round(frame.t * segments.MICROS).astype(np.int64)
+            person_ids, x, y = frame.person, frame.x, frame.y
+        else:
+            data = store.load(lo, hi + MICROSECOND)
+            micros, person_ids, x, y = data['timestamp'], data['person'], data['x'], data['y']
+        order = np.lexsort((person_ids, micros))
+        chunk = {'timestamp': micros[order], 'person': person_ids[order], 'x': x[order], 'y': y[order]}
+        yield from _split(POSITIONS, chunk, chunk_rows)
+        hour += segments.HOUR
+    if hour > todt:
+        return
+
+    qs = models.TagPosition.objects.filter(timestamp__gte=max(fromdt, hour), timestamp__lte=todt).order_by('timestamp', 'id')
+    rows = ((_micros(ts), person_id, x, y) for ts, person_id, x, y in
+            qs.values_list('timestamp', 'person_id', 'x', 'y').iterator(chunk_size=chunk_rows))
+    for batch in _batches(rows, chunk_rows):
+        yield _chunk(POSITIONS, batch)
+
+def contact_chunks(fromdt, todt, person=None, chunk_rows=None):
+    #
+    # contact graph edges with fromdt <= bucket_start <= todt in time order, as dicts of
+    # column arrays; only the edges of person when given
+    #
+    if chunk_rows is None:
+        chunk_rows = settings.EXPORT_CHUNK_ROWS
+    qs = models.ContactEdge.objects.filter(bucket_start__gte=fromdt, bucket_start__lte=todt)
+    if person is not None:
+        qs = qs.filter(Q(person_a=person) | Q(person_b=person))
+    qs = qs.order_by('bucket_start', 'id').values_list('bucket_start', 'person_a_id', 'person_b_id', 'first_contact',
+                                                        'last_contact', 'duration_seconds', 'min_distance')
+    rows = ((_micros(bucket), a, b, _micros(first), _micros(last), duration, distance)
+            for bucket, a, b, first, last, duration, distance in qs.iterator(chunk_size=chunk_rows))
+    for batch in _batches(rows, chunk_rows):
+        yield _chunk(CONTACTS, batch)
+
+def chunks(kind, fromdt, todt, person=None, chunk_rows=None):
+    if kind == POSITIONS:
+        return position_chunks(fromdt, todt, person=person, chunk_rows=chunk_rows)
+    return contact_chunks(fromdt, todt, person=person, chunk_rows=chunk_rows)
+
+class PeopleTable(object):
+    #
+    # person id -> unique_id, looked up one query per chunk for the ids not seen before
+    #
+    def __init__(self):
+        self.unique_ids = {}
+
+    def add(self, kind, chunk):
+        # returns the (id, unique_id) pairs that are new in this chunk
+        ids = np.unique(np.concatenate([chunk[name] for name in PERSON_COLUMNS[kind]])).tolist()
+        missing = [i for i in ids if i not in self.unique_ids]
+        if not missing:
+            return []
+        found = dict(models.TrackablePerson.objects.filter(id__in=missing).values_list('id', 'unique_id'))
+        added = [(i, found.get(i, '')) for i in missing]
+        self.unique_ids.update(added)
+        return added
+
+###########################
+# encoding
+###########################
+def iter_csv(kind, chunks):
+    people = PeopleTable()
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([name for name, _ in COLUMNS[kind]])
+    yield buf.getvalue()
+    for chunk in chunks:
+        people.add(kind, chunk)
+        columns = []
+        for name, _ in COLUMNS[kind]:
+            values = chunk[name]
+            if name in TIME_COLUMNS[kind]:
+                values = np.datetime_as_string(values.astype('datetime64[us]'), timezone='UTC')
+            elif name in PERSON_COLUMNS[kind]:
+                values = [people.unique_ids[i] for i in values.tolist()]
+            else:
+                values = values.tolist()
+            columns.append(values)
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows(zip(*columns))
+        yield buf.getvalue()
+
+def iter_binary(kind, chunks):
+    people = PeopleTable()
+    yield MAGIC[kind]
+    for chunk in chunks:
+        added = people.add(kind, chunk)
+        parts = [struct.pack('<I', len(added))]
+        for person_id, unique_id in added:
+            encoded = unique_id.encode('utf-8')[:255]
+            parts.append(struct.pack('<iB', person_id, len(encoded)) + encoded)
+        parts.append(struct.pack('<I', len(chunk[COLUMNS[kind][0][0]])))
+        for name, dtype in COLUMNS[kind]:
+            parts.append(np.ascontiguousarray(chunk[name], dtype=dtype).tobytes())
+        yield b''.join(parts)
+    yield struct.pack('<II', 0, 0)
+
+def encode(kind, fmt, chunks):
+    if fmt == FORMAT_CSV:
+        return iter_csv(kind, chunks)
+    return iter_binary(kind, chunks)
+
+def decode_binary(data):
+    #
+    # the inverse of iter_binary: returns (kind, {person id: unique_id}, {column: array})
+    # raises ValueError on a malformed or truncated export
+    #
+    kinds = dict((magic, kind) for kind, magic in MAGIC.items())
+    if data[:4] not in kinds:
+        raise ValueError("export must start with one of %s" % ', '.join(repr(m) for m in kinds))
+    kind = kinds[data[:4]]
+    offset = 4
+    people = {}
+    parts = dict((name, []) for name, _ in COLUMNS[kind])
+    try:
+        while True:
+            (npeople,) = struct.unpack_from('<I', data, offset)
+            offset += 4
+            for _ in range(npeople):
+                person_id, length = struct.unpack_from('<iB', data, offset)
+                offset += 5
+                people[person_id] = data[offset:offset + length].decode('utf-8')
+                offset += length
+            (nrows,) = struct.unpack_from('<I', data, offset)
+            offset += 4
+            if npeople == 0 and nrows == 0:
+                break
+            for name, dtype in COLUMNS[kind]:
+                column = np.frombuffer(data, dtype=dtype, count=nrows, offset=offset)
+                offset += column.nbytes
+                parts[name].append(column)
+    except (struct.error, UnicodeDecodeError) as ex:
+        raise ValueError("export is malformed or truncated: %s" % ex)
+    columns = dict((name, np.concatenate(values) if values else np.zeros(0, dtype=dtype))
+                   for (name, dtype), values in zip(COLUMNS[kind], parts.values()))
+    return kind, people, columns
@@ -0,0 +1,167 @@
+#######################################################################
+# heatmap.py
+# Occupancy heatmaps in time-bucket tiles
+#
+# Positions are reduced to one point per person per CONTACT_SAMPLE_SECONDS
+# (so a tag that reports more often does not count for more) and binned
+# with a 2-D histogram onto a grid of cell_meters squares aligned to the
+# origin. A tile holds the sample counts of one time bucket over the
+# cells that saw anyone; occupancy is the mean number of people in a cell
+# over the bucket.
+#
+# Once a bucket ends before positions.database_from() ingestion rejects
+# readings for it and readers no longer take it from the raw table, so
+# its tile never changes. Such sealed tiles are cached in the 'heatmap'
+# cache alias by (bucket, size, cell, filter); repeat and overlapping
+# queries then only compute the buckets that are still open. A role or
+# status filter is keyed by a digest of the people it currently matches,
+# so a person write only retires the tiles of the filters whose
+# membership it actually changed.
+#######################################################################
+import datetime
+import hashlib
+
+import numpy as np
+
+from django.conf import settings
+from django.core.cache import caches
+
+import inftrackapp.contacts as contacts
+import inftrackapp.models as models
+import inftrackapp.positions as positions
+
+# at most this much history is held in memory while computing tiles
+LOAD_SPAN = datetime.timedelta(hours=6)
+TILE_CACHE = 'heatmap'
+
+class Tile(object):
+    #
+    # sample counts for cells cx0 <= cx < cx0 + counts.shape[0], cy0 <= cy < cy0 + counts.shape[1]
+    #
+    __slots__ = ('start', 'seconds', 'cx0', 'cy0', 'counts', 'sample_seconds')
+
+    def __init__(self, start, seconds, cx0, cy0, counts, sample_seconds):
+        self.start = start
+        self.seconds = seconds
+        self.cx0 = cx0
+        self.cy0 = cy0
+        self.counts = counts
+        self.sample_seconds = sample_seconds
+
+    @property
+    def end(self):
+        return self.start + datetime.timedelta(seconds=self.seconds)
+
+    def cells(self, bounds=None):
+        #
+        # (cx, cy, mean occupancy) arrays for the occupied cells, restricted to
+        # bounds = (cx_min, cy_min, cx_max, cy_max) inclusive when given
+        #
+        ix, iy = np.nonzero(self.counts)
+        cx = ix + self.cx0
+        cy = iy + self.cy0
+        occupancy = self.counts[ix, iy] * (self.sample_seconds / float(self.seconds))
+        if bounds is not None:
+            keep = (cx >= bounds[0]) & (cy >= bounds[1]) & (cx <= bounds[2]) & (cy <= bounds[3])
+            cx, cy, occupancy = cx[keep], cy[keep], occupancy[keep]
+        return cx, cy, occupancy
+
+def build_tile(start, seconds, cell_meters, x, y, sample_seconds):
+    # x/y are the bucketized points that fall in this time bucket
+    if not len(x):
+        return Tile(start, seconds, 0, 0, np.zeros((0, 0), dtype=np.int32), sample_seconds)
+    cx = np.floor(x / cell_meters).astype(np.int64)
+    cy = np.floor(y / cell_meters).astype(np.int64)
+    cx0, cy0 = int(cx.min()), int(cy.min())
+    nx, ny = int(cx.max()) - cx0 + 1, int(cy.max()) - cy0 + 1
+    counts, _, _ = np.histogram2d(cx, cy, bins=[nx, ny], range=[[cx0, cx0 + nx], [cy0, cy0 + ny]])
+    return Tile(start, seconds, cx0, cy0, counts.astype(np.int32), sample_seconds)
+
+def compute_tiles(starts, seconds, cell_meters, person_ids=None):
+    #
+    # tiles for consecutive bucket starts, read in spans of at most LOAD_SPAN
+    #
+    sample_seconds = settings.CONTACT_SAMPLE_SECONDS
+    step = datetime.timedelta(seconds=seconds)
+    per_load = max(1, int(LOAD_SPAN.total_seconds() // seconds))
+    tiles = []
+    for i in range(0, len(starts), per_load):
+        span = starts[i:i + per_load]
+        frame = positions.load_positions(span[0], span[-1] + step - datetime.timedelta(microseconds=1), person_ids=person_ids)
+        _, bucket, x, y = contacts.bucketize(frame, sample_seconds)
+        order = np.argsort(bucket, kind='stable')
+        x, y = x[order], y[order]
+        t = bucket[order] * sample_seconds
+        for start in span:
+            lo, hi = np.searchsorted(t, [start.timestamp(), (start + step).timestamp()], side='left')
+            tiles.append(build_tile(start, seconds, cell_meters, x[lo:hi], y[lo:hi], sample_seconds))
+    return tiles
+
+###########################
+# cached tiles
+###########################
+def bucket_starts(fromdt, todt, seconds):
+    # starts of the buckets overlapping [fromdt, todt), aligned to multiples of seconds since the epoch
+    first = (fromdt.timestamp() // seconds) * seconds
+    return [positions.epoch_to_datetime(t) for t in np.arange(first, todt.timestamp(), seconds)]
+
+def _cache_key(start, seconds, cell_meters, members):
+    # members is the digest of the filtered people, None without a filter
+    key = 'inftrack:heatmap:%d:%d:%s' % (start.timestamp(), seconds, cell_meters)
+    if members is not None:
+        key += ':' + members
+    return key
+
+def _members_digest(person_ids):
+    if person_ids is None:
+        return None
+    return hashlib.md5(','.join(str(i) for i in sorted(person_ids)).encode('ascii')).hexdigest()
+
+def filtered_people(role=None, status=None):
+    # person ids matching the filter, None for everyone
+    if not role and not status:
+        return None
+    qs = models.TrackablePerson.objects.all()
+    if role:
+        qs = qs.filter(role=role)
+    if status:
+        qs = qs.filter(status=status)
+    return list(qs.values_list('id', flat=True))
+
+def get_tiles(fromdt, todt, seconds=None, cell_meters=None, role=None, status=None):
+    #
+    # one Tile per bucket overlapping [fromdt, todt), oldest first
+    # sealed tiles come from the cache when they can; only the rest are computed
+    #
+    if seconds is None:
+        seconds = settings.HEATMAP_BUCKET_SECONDS
+    if cell_meters is None:
+        cell_meters = settings.HEATMAP_CELL_METERS
+    sealed_before = positions.database_from()
+    step = datetime.timedelta(seconds=seconds)
+    tiles = caches[TILE_CACHE]
+
+    starts = bucket_starts(fromdt, todt, seconds)
+    person_ids = filtered_people(role, status)
+    members = _members_digest(person_ids)
+    keys = [_cache_key(start, seconds, cell_meters, members) for start in starts]
+    sealed = set(start for start in starts if sealed_before is not None and start + step <= sealed_before)
+    cached = tiles.get_many([key for start, key in zip(starts, keys) if start in sealed])
+    missing = [start for start, key in zip(starts, keys) if key not in cached]
+    computed = {}
+    if missing:
+        #
+        # contiguous runs of missing buckets are read together
+        #
+        runs = []
+        for start in missing:
+            if runs and runs[-1][-1] + step == start:
+                runs[-1].append(start)
+            else:
+                runs.append([start])
+        for run in runs:
+            for tile in compute_tiles(run, seconds, cell_meters, person_ids=person_ids):
+                computed[tile.start] = tile
+        tiles.set_many(dict((key, computed[start]) for start, key in zip(starts, keys)
+                            if start in computed and start in sealed), settings.HEATMAP_TILE_TIMEOUT)
+    return [cached[key] if key in cached else computed[start] for start, key in zip(starts, keys)]
@@ -0,0 +1,295 @@
+#######################################################################
+# ingest.py
+# Batched position ingestion from RTLS gateways
+#
+# Two wire formats are accepted:
+#
+# NDJSON, one reading per line, either as an object or a 4-element array:
+#     {"tag": "T-100", "x": 12.5, "y": 3.25, "timestamp": 1585420000.5}
+#     ["T-100", 12.5, 3.25, "2020-03-28T18:26:40.500Z"]
+# timestamp is epoch seconds or an ISO 8601 string.
+# Readings with non-finite coordinates or a timestamp outside
+# [MIN_TIMESTAMP, MAX_TIMESTAMP) are rejected individually, as are readings
+# for history that has already been sealed or compacted (see
+# positions.database_from).
+#
+# Packed binary (little endian):
+#     b"ITP1"
+#     uint16 tag count, then per tag: uint8 length + utf-8 tag unique_id
+#     uint32 reading count, then per reading:
+#         uint16 tag index, float32 x, float32 y, float64 epoch seconds
+#######################################################################
+import datetime
+import json
+import math
+import struct
+
+import numpy as np
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_aware, make_aware
+
+import inftrackapp.assignments as assignments
+import inftrackapp.compression as compression
+import inftrackapp.dao as dao
+import inftrackapp.live as live
+import inftrackapp.models as models
+import inftrackapp.positions as positions
+
+CONTENT_TYPE_NDJSON = 'application/x-ndjson'
+CONTENT_TYPE_BINARY = 'application/octet-stream'
+
+BINARY_MAGIC = b'ITP1'
+READING_DTYPE = np.dtype([('tag', '<u2'), ('x', '<f4'), ('y', '<f4'), ('timestamp', '<f8')])
+
+# epoch seconds, 2000-01-01 to 2100-01-01 UTC; millisecond epochs fall above the range
+MIN_TIMESTAMP = 946684800.0
+MAX_TIMESTAMP = 4102444800.0
+
+class IngestError(ValueError):
+    # the body as a whole could not be parsed
+    pass
+
+###########################
+# parsed batches
+###########################
+class ReadingBatch(object):
+    #
+    # columnar readings: tags holds the distinct tag unique_ids, tag_index points into it
+    # index is each reading's position in the original body, errors holds (index, message)
+    # for readings that were rejected while parsing
+    #
+    def __init__(self, tags, tag_index, x, y, t, index=None, errors=None, size=None):
+        self.tags = tags
+        self.tag_index = np.asarray(tag_index, dtype=np.int64)
+        self.index = np.arange(len(self.tag_index)) if index is None else np.asarray(index, dtype=np.int64)
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.t = np.asarray(t, dtype=np.float64)
+        self.errors = errors or []
+        self.size = len(self.t) + len(self.errors) if size is None else size
+
+    def __len__(self):
+        return len(self.t)
+
+    @classmethod
+    def concat(cls, batches):
+        #
+        # merge already validated batches into one, sharing a single tag table
+        # parse errors are not carried over, they belong to the batch they came from
+        #
+        tags = []
+        tag_lookup = {}
+        tag_index = []
+        for batch in batches:
+            remap = np.zeros(len(batch.tags), dtype=np.int64)
+            for i, tag in enumerate(batch.tags):
+                if tag not in tag_lookup:
+                    tag_lookup[tag] = len(tags)
+                    tags.append(tag)
+                remap[i] = tag_lookup[tag]
+            tag_index.append(remap[batch.tag_index])
+        if not batches:
+            return cls([], [], [], [], [])
+        return cls(tags, np.concatenate(tag_index),
+                   np.concatenate([b.x for b in batches]),
+                   np.concatenate([b.y for b in batches]),
+                   np.concatenate([b.t for b in batches]))
+
+def _parse_timestamp(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    dt = parse_datetime(value) if isinstance(value, str) else None
+    if dt is None:
+        raise ValueError("timestamp must be epoch seconds or an ISO 8601 string")
+    if not is_aware(dt):
+        dt = make_aware(dt)
+    return dt.timestamp()
+
+def _check_reading(x, y, timestamp):
+    if not (math.isfinite(x) and math.isfinite(y)):
+        raise ValueError("x and y must be finite")
+    # written so that NaN fails it too
+    if not (MIN_TIMESTAMP <= timestamp < MAX_TIMESTAMP):
+        raise ValueError("timestamp %r is not epoch seconds between 2000 and 2100" % timestamp)
+
+def parse_ndjson(lines):
+    tags = []
+    tag_lookup = {}
+    tag_index, xs, ys, ts, indexes = [], [], [], [], []
+    errors = []
+    index = -1
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        index += 1
+        try:
+            reading = json.loads(line)
+            if isinstance(reading, dict):
+                tag, x, y, timestamp = reading['tag'], reading['x'], reading['y'], reading['timestamp']
+            else:
+                tag, x, y, timestamp = reading
+            tag = str(tag)
+            x = float(x)
+            y = float(y)
+            timestamp = _parse_timestamp(timestamp)
+            _check_reading(x, y, timestamp)
+        except (ValueError, TypeError, KeyError) as ex:
+            errors.append((index, "malformed reading: %s" % ex))
+            continue
+        if tag not in tag_lookup:
+            tag_lookup[tag] = len(tags)
+            tags.append(tag)
+        tag_index.append(tag_lookup[tag])
+        xs.append(x)
+        ys.append(y)
+        ts.append(timestamp)
+        indexes.append(index)
+    return ReadingBatch(tags, tag_index, xs, ys, ts, index=indexes, errors=errors, size=index + 1)
+
+def parse_binary(data):
+    try:
+        if data[:4] != BINARY_MAGIC:
+            raise IngestError("binary body must start with %r" % BINARY_MAGIC)
+        offset = 4
+        (ntags,) = struct.unpack_from('<H', data, offset)
+        offset += 2
+        tags = []
+        for i in range(ntags):
+            (length,) = struct.unpack_from('<B', data, offset)
+            offset += 1
+            tags.append(data[offset:offset + length].decode('utf-8'))
+            offset += length
+        (nreadings,) = struct.unpack_from('<I', data, offset)
+        offset += 4
+    except (struct.error, UnicodeDecodeError) as ex:
+        raise IngestError("malformed binary header: %s" % ex)
+    if len(data) - offset != nreadings * READING_DTYPE.itemsize:
+        raise IngestError("binary body holds %d bytes of readings, expected %d" % (len(data) - offset, nreadings * READING_DTYPE.itemsize))
+
+    readings = np.frombuffer(data, dtype=READING_DTYPE, count=nreadings, offset=offset)
+    timestamps = readings['timestamp']
+    valid = (readings['tag'] < ntags) & np.isfinite(readings['x']) & np.isfinite(readings['y']) & \
+        (timestamps >= MIN_TIMESTAMP) & (timestamps < MAX_TIMESTAMP)
+    errors = [(int(i), "unknown tag index, non-finite coordinate or timestamp out of range") for i in np.flatnonzero(~valid)]
+    readings = readings[valid]
+    return ReadingBatch(tags, readings['tag'], readings['x'], readings['y'], readings['timestamp'],
+                        index=np.flatnonzero(valid), errors=errors, size=nreadings)
+
+def encode_binary(tags, tag_index, x, y, t):
+    # the inverse of parse_binary, for gateways and load generators written in Python
+    header = [BINARY_MAGIC, struct.pack('<H', len(tags))]
+    for tag in tags:
+        encoded = tag.encode('utf-8')
+        header.append(struct.pack('<B', len(encoded)) + encoded)
+    readings = np.zeros(len(t), dtype=READING_DTYPE)
+    readings['tag'] = tag_index
+    readings['x'] = x
+    readings['y'] = y
+    readings['timestamp'] = t
+    header.append(struct.pack('<I', len(readings)))
+    return b''.join(header) + readings.tobytes()
+
+###########################
+# tag and holder resolution
+###########################
+def resolve_tags(unique_ids):
+    # unique_id -> tag id, one query for the whole batch
+    return dict(models.TrackingTag.objects.filter(unique_id__in=list(unique_ids)).values_list('unique_id', 'id'))
+
+###########################
+# ingestion
+###########################
+class IngestResult(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.accepted = 0
+        # accepted readings that were written; the rest were within the compression error bound
+        self.stored = 0
+        self.errors = []
+        self.error_count = 0
+        # per reading of the ingested batch, whether it was accepted
+        self.accepted_mask = None
+
+    @property
+    def rejected(self):
+        return self.size - self.accepted
+
+    def reject(self, index, message):
+        self.error_count += 1
+        if len(self.errors) < settings.INGEST_MAX_ERRORS:
+            self.errors.append({"index": index, "msg": message})
+
+    def as_dict(self):
+        return {
+            "accepted": self.accepted,
+            "stored": self.stored,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "errors_truncated": self.error_count > len(self.errors)
+        }
+
+def ingest(batch):
+    result = IngestResult(batch.size)
+    for index, message in batch.errors:
+        result.reject(index, message)
+    if not len(batch):
+        return result
+
+    tag_ids = resolve_tags(batch.tags)
+    #
+    # tag id per reading (-1 for unknown tags), then whoever wore it when the reading was taken
+    #
+    tag_table = np.array([tag_ids.get(uid, -1) for uid in batch.tags], dtype=np.int64)
+    reading_tags = tag_table[batch.tag_index]
+    holders = assignments.get_assignment_index().persons_at(reading_tags, batch.t)
+    #
+    # readings older than what readers take from the database would be stored but never read
+    #
+    cutoff = positions.database_from()
+    cutoff = cutoff.timestamp() if cutoff is not None else -np.inf
+    #
+    # drop the readings the reconstructed path does not need (see compression.py)
+    #
+    compressor = compression.get_compressor()
+    valid = (reading_tags >= 0) & (holders >= 0) & (batch.t >= cutoff)
+    store = valid.copy()
+    if compressor is not None:
+        store[valid] = compressor.filter(holders[valid], batch.x[valid], batch.y[valid], batch.t[valid])
+
+    rows = []
+    utc = datetime.timezone.utc
+    fromtimestamp = datetime.datetime.fromtimestamp
+    for i, tag_idx, tag_id, person_id, x, y, t, keep in zip(batch.index.tolist(), batch.tag_index.tolist(), reading_tags.tolist(),
+                                                            holders.tolist(), batch.x.tolist(), batch.y.tolist(), batch.t.tolist(),
+                                                            store.tolist()):
+        if tag_id < 0:
+            result.reject(i, "unknown tag %s" % batch.tags[tag_idx])
+            continue
+        if person_id < 0:
+            result.reject(i, "tag %s was not assigned to anyone at %s" % (batch.tags[tag_idx], fromtimestamp(t, utc).isoformat()))
+            continue
+        if t < cutoff:
+            result.reject(i, "reading at %s arrived too late, history before %s has been sealed or compacted" %
+                          (fromtimestamp(t, utc).isoformat(), fromtimestamp(cutoff, utc).isoformat()))
+            continue
+        if not keep:
+            continue
+        #
+        # positional construction skips the keyword handling in Model.__init__,
+        # which dominates at these volumes: (id, tag_id, person_id, x, y, timestamp)
+        #
+        rows.append(models.TagPosition(None, tag_id, person_id, x, y, fromtimestamp(t, utc)))
+
+    dao.save_positions(rows)
+    result.accepted_mask = valid
+    result.accepted = int(valid.sum())
+    result.stored = len(rows)
+    table = live.get_live_positions()
+    if table is not None:
+        table.update(holders[valid], batch.x[valid], batch.y[valid], batch.t[valid])
+        table.maybe_evict()
+    return result
@@ -0,0 +1,180 @@
+#######################################################################
+# live.py
+# In-memory table of where everyone is right now
+#
+# Every ingested reading (including the ones compression does not store)
+# updates the latest position of its person. Positions are also filed in
+# a spatial hash of LIVE_CELL_METERS cells, so "who is within d of P right
+# now" only looks at the cells around P instead of at everyone.
+#
+# A position older than LIVE_STALE_SECONDS no longer counts as current:
+# queries skip it and evict() drops it, which ingest does every so often.
+# The table is per process, like the assignment index. It is warmed from
+# the last LIVE_STALE_SECONDS of stored positions when first used, so a
+# worker that ingests nothing still answers from what others stored.
+#######################################################################
+import datetime
+import math
+import threading
+import time
+
+import numpy as np
+
+from django.conf import settings
+from django.utils import timezone
+
+import inftrackapp.positions as positions
+
+class LivePosition(object):
+    __slots__ = ('person_id', 'x', 'y', 't', 'cell')
+
+    def __init__(self, person_id, x, y, t, cell):
+        self.person_id = person_id
+        self.x = x
+        self.y = y
+        self.t = t
+        self.cell = cell
+
+    @property
+    def seen_at(self):
+        return positions.epoch_to_datetime(self.t)
+
+class Neighbour(object):
+    __slots__ = ('person_id', 'distance', 'position')
+
+    def __init__(self, person_id, distance, position):
+        self.person_id = person_id
+        self.distance = distance
+        self.position = position
+
+class LivePositions(object):
+
+    def __init__(self, cell_meters, stale_seconds):
+        self.cell_meters = cell_meters
+        self.stale_seconds = stale_seconds
+        # person id -> LivePosition
+        self.latest = {}
+        # (cx, cy) -> set of person ids
+        self.cells = {}
+        self.evicted_at = 0.0
+        self.lock = threading.Lock()
+
+    def _cell(self, x, y):
+        return int(math.floor(x / self.cell_meters)), int(math.floor(y / self.cell_meters))
+
+    def _move(self, entry, cell):
+        if entry.cell is not None:
+            members = self.cells[entry.cell]
+            members.discard(entry.person_id)
+            if not members:
+                del self.cells[entry.cell]
+        entry.cell = cell
+        if cell is not None:
+            self.cells.setdefault(cell, set()).add(entry.person_id)
+
+    def update(self, person_ids, x, y, t):
+        #
+        # take the newest reading of each person in a batch; older than what is held is ignored
+        #
+        person_ids = np.asarray(person_ids, dtype=np.int64)
+        if not len(person_ids):
+            return
+        t = np.asarray(t, dtype=np.float64)
+        order = np.lexsort((t, person_ids))
+        last = order[np.r_[person_ids[order][1:] != person_ids[order][:-1], True]]
+        with self.lock:
+            latest = self.latest
+            for p, xi, yi, ti in zip(person_ids[last].tolist(), np.asarray(x)[last].tolist(),
+                                     np.asarray(y)[last].tolist(), t[last].tolist()):
+                entry = latest.get(p)
+                if entry is None:
+                    entry = latest[p] = LivePosition(p, xi, yi, ti, None)
+                elif ti < entry.t:
+                    continue
+                entry.x, entry.y, entry.t = xi, yi, ti
+                cell = self._cell(xi, yi)
+                if cell != entry.cell:
+                    self._move(entry, cell)
+
+    def evict(self, now=None):
+        # drop positions gone stale, returns how many
+        if now is None:
+            now = time.time()
+        cutoff = now - self.stale_seconds
+        with self.lock:
+            stale = [entry for entry in self.latest.values() if entry.t < cutoff]
+            for entry in stale:
+                self._move(entry, None)
+                del self.latest[entry.person_id]
+            self.evicted_at = now
+        return len(stale)
+
+    def maybe_evict(self, now=None):
+        if now is None:
+            now = time.time()
+        if now - self.evicted_at >= self.stale_seconds / 2.0:
+            self.evict(now)
+
+    def position(self, person_id, now=None):
+        # current position of person_id, None when unknown or stale
+        if now is None:
+            now = time.time()
+        entry = self.latest.get(person_id)
+        if entry is None or entry.t < now - self.stale_seconds:
+            return None
+        return entry
+
+    def near(self, person_id, distance, now=None):
+        #
+        # (person_id's current LivePosition, Neighbours within distance of it nearest first),
+        # or None when person_id has no current position
+        #
+        if now is None:
+            now = time.time()
+        cutoff = now - self.stale_seconds
+        with self.lock:
+            centre = self.position(person_id, now)
+            if centre is None:
+                return None
+            reach = distance / self.cell_meters
+            reach = int(math.ceil(reach)) if reach < len(self.latest) else len(self.latest)
+            cx, cy = centre.cell
+            if (2 * reach + 1) ** 2 > len(self.latest):
+                # more cells to look at than people, scanning everyone is cheaper
+                candidates = list(self.latest)
+            else:
+                candidates = [other_id for dx in range(-reach, reach + 1) for dy in range(-reach, reach + 1)
+                              for other_id in self.cells.get((cx + dx, cy + dy), ())]
+            found = []
+            for other_id in candidates:
+                if other_id == person_id:
+                    continue
+                other = self.latest[other_id]
+                if other.t < cutoff:
+                    continue
+                d = math.hypot(other.x - centre.x, other.y - centre.y)
+                if d <= distance:
+                    found.append(Neighbour(other_id, d, other))
+        found.sort(key=lambda n: n.distance)
+        return centre, found
+
+    def warm(self, now=None):
+        # load the positions stored within the last stale_seconds
+        if now is None:
+            now = timezone.now()
+        frame = positions.load_positions(now - datetime.timedelta(seconds=self.stale_seconds), now)
+        self.update(frame.person, frame.x, frame.y, frame.t)
+
+_lock = threading.Lock()
+_live = None
+
+def get_live_positions():
+    # None when the live table is turned off
+    global _live
+    if not settings.LIVE_POSITIONS_ENABLED:
+        return None
+    with _lock:
+        if _live is None:
+            _live = LivePositions(settings.LIVE_CELL_METERS, settings.LIVE_STALE_SECONDS)
+            _live.warm()
+        return _live
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+import inftrackapp.contact_graph as contact_graph
+
+class Command(BaseCommand):
+    help = 'Fold the positions stored since the last run into the contact graph'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, help='keep running, advancing the graph every this many seconds')
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            written = contact_graph.advance()
+            state = contact_graph.get_state()
+            if state is None:
+                self.stdout.write('the contact graph is disabled (CONTACT_GRAPH_ENABLED)')
+                return
+            if written or interval is None:
+                self.stdout.write('wrote %d edges, graph covers %s - %s' % (written, state.covered_from, state.processed_until))
+            if interval is None:
+                return
+            close_old_connections()
+            time.sleep(interval)
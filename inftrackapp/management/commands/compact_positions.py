@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+import inftrackapp.rollups as rollups
+from inftrackapp.management.commands.rebuild_contact_graph import parse_aware
+
+class Command(BaseCommand):
+    help = 'Collapse old positions into dwell segments, then delete raw positions past the retention period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--until', help='compact hours before this ISO 8601 time (default: now minus DWELL_COMPACT_AFTER_HOURS)')
+        parser.add_argument('--purge-until', help='delete compacted raw positions before this ISO 8601 time '
+                                                  '(default: now minus POSITION_RAW_RETENTION_DAYS)')
+        parser.add_argument('--no-purge', action='store_true', help='compact only, keep every raw position')
+
+    def handle(self, *args, **options):
+        until = parse_aware(options['until'], '--until') if options['until'] else None
+        hours, read, written = rollups.compact(until)
+        self.stdout.write('compacted %d hours: %d positions into %d dwell segments' % (hours, read, written))
+        if not options['no_purge']:
+            purge_until = parse_aware(options['purge_until'], '--purge-until') if options['purge_until'] else None
+            deleted = rollups.purge(purge_until)
+            self.stdout.write('deleted %d raw positions from the database' % deleted)
+        state = rollups.get_state()
+        if state is not None:
+            self.stdout.write('compacted until %s, raw positions purged until %s' % (state.compacted_until, state.purged_until))
@@ -0,0 +1,37 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+
+import inftrackapp.clusters as clusters
+import inftrackapp.contacts as contacts
+import inftrackapp.models as models
+
+class Command(BaseCommand):
+    help = 'Find clusters of infected and at-risk people linked by contacts, shared contacts or shared zones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, help='length of the window ending now (default: CONTACT_LOOKBACK_DAYS)')
+        parser.add_argument('--statuses', nargs='+', metavar='STATUS', help='statuses to cluster (default: CLUSTER_STATUSES)')
+        parser.add_argument('--dwell', type=float, help='minimum contact or zone time in seconds (default: CONTACT_MIN_DWELL_SECONDS)')
+        parser.add_argument('--min-size', type=int, default=2)
+        parser.add_argument('--output', help='write the clusters to this file as JSON')
+
+    def handle(self, *args, **options):
+        if options['statuses'] and any(status not in models.STATUS_CHECK for status in options['statuses']):
+            raise CommandError('statuses must be among %s' % ', '.join(models.STATUS_CHECK))
+        fromdt, todt = contacts.contact_window(days=options['days'])
+        started = time.perf_counter()
+        found = clusters.detect(fromdt, todt, statuses=options['statuses'], min_dwell_seconds=options['dwell'],
+                                min_size=options['min_size'])
+        elapsed = time.perf_counter() - started
+        result = clusters.as_dicts(found)
+        for cluster in result:
+            hotspot = cluster['hotspots'][0] if cluster['hotspots'] else None
+            self.stdout.write('%3d people  %s%s' % (cluster['size'], ' '.join(m['id'] for m in cluster['members'][:10]),
+                                                   '  hotspot %(x).1f,%(y).1f %(zone)s' % hotspot if hotspot else ''))
+        self.stdout.write('%d clusters from %s to %s in %.2fs' % (len(result), fromdt, todt, elapsed))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({"from": fromdt, "to": todt, "clusters": result}, f, cls=DjangoJSONEncoder, indent=2)
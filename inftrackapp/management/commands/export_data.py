@@ -0,0 +1,55 @@
+import datetime
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_aware, make_aware
+
+import inftrackapp.export as export
+import inftrackapp.models as models
+
+def _datetime(value, name):
+    dt = parse_datetime(value)
+    if dt is None:
+        raise CommandError('--%s must be an ISO 8601 datetime' % name)
+    return dt if is_aware(dt) else make_aware(dt)
+
+class Command(BaseCommand):
+    help = 'Stream positions or contact graph edges for a person or a time window to a CSV or binary file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=export.KINDS)
+        parser.add_argument('--id', help='unique id of the person to export (default: everyone)')
+        parser.add_argument('--from', dest='fromdt', help='ISO 8601 start of the window (default: --days before --to)')
+        parser.add_argument('--to', dest='todt', help='ISO 8601 end of the window (default: now)')
+        parser.add_argument('--days', type=float, help='length of the window (default: CONTACT_LOOKBACK_DAYS)')
+        parser.add_argument('--format', choices=export.FORMATS, default=export.FORMAT_CSV)
+        parser.add_argument('--output', default='-', help='file to write (default: standard output)')
+
+    def handle(self, *args, **options):
+        person = None
+        if options['id']:
+            person = models.TrackablePerson.objects.get_or_none(unique_id=options['id'])
+            if person is None:
+                raise CommandError('no person with id %s' % options['id'])
+        todt = _datetime(options['todt'], 'to') if options['todt'] else timezone.now()
+        days = options['days'] if options['days'] is not None else settings.CONTACT_LOOKBACK_DAYS
+        fromdt = _datetime(options['fromdt'], 'from') if options['fromdt'] else todt - datetime.timedelta(days=days)
+
+        kind = options['kind']
+        fmt = options['format']
+        body = export.encode(kind, fmt, export.chunks(kind, fromdt, todt, person=person))
+        binary = fmt == export.FORMAT_BINARY
+        if options['output'] == '-':
+            out = sys.stdout.buffer if binary else sys.stdout
+            for part in body:
+                out.write(part)
+            out.flush()
+            return
+        with open(options['output'], 'wb' if binary else 'w', newline=None if binary else '') as f:
+            for part in body:
+                f.write(part)
+            written = f.tell()
+        self.stderr.write('wrote %d bytes to %s' % (written, options['output']))
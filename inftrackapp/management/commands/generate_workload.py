@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_aware, make_aware
+
+import inftrackapp.workload as workload
+
+class Command(BaseCommand):
+    help = 'Generate a synthetic facility: people, tags with reassignments, and random-walk positions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--people', type=int, default=1000)
+        parser.add_argument('--hours', type=float, default=1.0, help='length of the position streams')
+        parser.add_argument('--positions', type=int, help='generate about this many positions instead of --hours worth')
+        parser.add_argument('--interval', type=float, default=10, help='seconds between readings per person')
+        parser.add_argument('--start', help='time of the first reading, ISO 8601 (default: so the last reading is now)')
+        parser.add_argument('--rooms', type=int, help='number of rooms (default: one per eight people)')
+        parser.add_argument('--reassignments-per-day', type=float, default=0.5, help='tag swaps per person per day')
+        parser.add_argument('--prefix', default='syn', help='unique_id prefix of generated people and tags')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--delete', action='store_true', help='delete the facility with this prefix instead')
+
+    def handle(self, *args, **options):
+        if options['delete']:
+            deleted = workload.delete(options['prefix'])
+            self.stdout.write('deleted %d rows (people, tags and their positions and events) with prefix %s' % (deleted, options['prefix']))
+            return
+
+        hours = options['hours']
+        if options['positions']:
+            hours = options['positions'] * options['interval'] / (options['people'] * 3600.0)
+        start = None
+        if options['start']:
+            start = parse_datetime(options['start'])
+            if start is None:
+                raise CommandError('--start must be an ISO 8601 datetime')
+            if not is_aware(start):
+                start = make_aware(start)
+
+        spec = workload.WorkloadSpec(people=options['people'], hours=hours, interval_seconds=options['interval'], start=start,
+                                     rooms=options['rooms'], reassignments_per_day=options['reassignments_per_day'],
+                                     prefix=options['prefix'], seed=options['seed'])
+
+        def progress(written, total):
+            self.stdout.write('%d / %d positions' % (written, total))
+
+        summary = workload.generate(spec, progress=progress)
+        self.stdout.write('generated %(people)d people, %(tags)d tags, %(assignment_events)d assignment events and '
+                          '%(positions)d positions from %(from)s to %(to)s' % summary)
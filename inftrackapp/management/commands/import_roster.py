@@ -0,0 +1,43 @@
+import os
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+import inftrackapp.roster as roster
+
+class Command(BaseCommand):
+    help = 'Upsert people or tags from a CSV (with a header row) or NDJSON file, reporting bad rows without stopping'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=roster.KINDS)
+        parser.add_argument('file', help='roster file, - for stdin')
+        parser.add_argument('--format', choices=roster.FORMATS,
+                            help='file format (default: from the file extension, csv unless .ndjson/.jsonl/.json)')
+
+    def handle(self, *args, **options):
+        fmt = options['format']
+        if fmt is None:
+            extension = os.path.splitext(options['file'])[1].lower()
+            fmt = roster.FORMAT_NDJSON if extension in ('.ndjson', '.jsonl', '.json') else roster.FORMAT_CSV
+        started = time.perf_counter()
+        try:
+            #
+            # read bytes: lines are decoded one at a time, so a line that is not valid
+            # UTF-8 is reported as a bad row instead of aborting the whole file
+            #
+            if options['file'] == '-':
+                result = roster.import_stream(options['kind'], sys.stdin.buffer, fmt)
+            else:
+                with open(options['file'], 'rb') as f:
+                    result = roster.import_stream(options['kind'], f, fmt)
+        except (OSError, roster.RosterError) as ex:
+            raise CommandError(str(ex))
+        elapsed = time.perf_counter() - started
+        for error in result.errors:
+            self.stderr.write('row %(index)d: %(msg)s' % error)
+        if result.error_count > len(result.errors):
+            self.stderr.write('... and %d more bad rows' % (result.error_count - len(result.errors)))
+        self.stdout.write('%d rows: %d created, %d updated, %d unchanged, %d rejected in %.2fs'
+                          % (result.rows, result.created, result.updated, result.unchanged, result.error_count, elapsed))
+
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_aware, make_aware
+
+import inftrackapp.contact_graph as contact_graph
+
+def parse_aware(value, name):
+    dt = parse_datetime(value)
+    if dt is None:
+        raise CommandError('%s must be an ISO 8601 datetime' % name)
+    if not is_aware(dt):
+        dt = make_aware(dt)
+    return dt
+
+class Command(BaseCommand):
+    help = 'Recompute contact graph edges from raw positions for a time range'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='fromdt', required=True, help='start of the range, ISO 8601')
+        parser.add_argument('--to', dest='todt', help='end of the range, ISO 8601 (default: now minus CONTACT_GRAPH_LAG_SECONDS)')
+
+    def handle(self, *args, **options):
+        fromdt = parse_aware(options['fromdt'], '--from')
+        todt = parse_aware(options['todt'], '--to') if options['todt'] else None
+        written = contact_graph.rebuild(fromdt, todt)
+        state = contact_graph.get_state()
+        self.stdout.write('wrote %d edges, graph covers %s - %s' % (written, state.covered_from, state.processed_until))
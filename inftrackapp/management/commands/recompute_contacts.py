@@ -0,0 +1,46 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_aware, make_aware
+
+import inftrackapp.models as models
+import inftrackapp.recompute as recompute
+import inftrackapp.risk as risk
+
+def parse_aware(value, name):
+    dt = parse_datetime(value)
+    if dt is None:
+        raise CommandError('%s must be an ISO 8601 datetime' % name)
+    if not is_aware(dt):
+        dt = make_aware(dt)
+    return dt
+
+class Command(BaseCommand):
+    help = 'Recompute contact graph edges (and then risk scores) for a long range of history across all cores; resumable'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='fromdt', required=True, help='start of the range, ISO 8601')
+        parser.add_argument('--to', dest='todt', help='end of the range, ISO 8601 (default: as far as the live graph has got)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes (default: one per core)')
+        parser.add_argument('--window-hours', type=int, help='hours per window (default: RECOMPUTE_WINDOW_HOURS)')
+        parser.add_argument('--job', help='checkpoint name to resume (default: derived from the range, contact settings and assignment data)')
+        parser.add_argument('--restart', action='store_true', help='ignore the checkpoints of an earlier run of this job')
+        parser.add_argument('--no-risk', action='store_true', help='do not refresh risk scores afterwards')
+
+    def handle(self, *args, **options):
+        fromdt = parse_aware(options['fromdt'], '--from')
+        todt = parse_aware(options['todt'], '--to') if options['todt'] else None
+        window_seconds = options['window_hours'] * 3600 if options['window_hours'] else None
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+
+        def progress(start, end, edges, done, total):
+            self.stdout.write('[%d/%d] %s - %s: %d edges' % (done, total, start, end, edges))
+
+        job, computed, skipped, written = recompute.run(fromdt, todt, workers=options['workers'], window_seconds=window_seconds,
+                                                        job=options['job'], restart=options['restart'], progress=progress)
+        self.stdout.write('job %s: recomputed %d windows (%d already done), wrote %d edges' % (job, computed, skipped, written))
+        if not options['no_risk']:
+            scores = risk.refresh_scores()
+            self.stdout.write('refreshed %d risk scores, %d above zero' % (scores, models.RiskScore.objects.filter(score__gt=0).count()))
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+import inftrackapp.models as models
+import inftrackapp.risk as risk
+
+class Command(BaseCommand):
+    help = 'Recompute every person\'s risk score from the contact graph'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, help='keep running, recomputing the scores every this many seconds')
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            written = risk.refresh_scores()
+            at_risk = models.RiskScore.objects.filter(score__gt=0).count()
+            self.stdout.write('wrote %d risk scores, %d above zero' % (written, at_risk))
+            if interval is None:
+                return
+            close_old_connections()
+            time.sleep(interval)
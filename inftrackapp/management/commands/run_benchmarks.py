@@ -0,0 +1,33 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+
+import inftrackapp.benchmarks as benchmarks
+
+class Command(BaseCommand):
+    help = 'Time ingestion, traces, people listings and contact analysis against a generated workload'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefix', default='syn', help='prefix the workload was generated with')
+        parser.add_argument('--only', nargs='+', metavar='NAME', help='run just these benchmarks: %s' % ', '.join(b[0] for b in benchmarks.BENCHMARKS))
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--warmup', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, default=10000, help='readings per ingestion batch')
+        parser.add_argument('--read-only', action='store_true', help='skip the benchmarks that write positions')
+        parser.add_argument('--output', default='benchmark-results.json', help='where to write the JSON results')
+
+    def handle(self, *args, **options):
+        try:
+            ctx = benchmarks.BenchmarkContext(prefix=options['prefix'], batch_size=options['batch_size'])
+        except ValueError as ex:
+            raise CommandError(str(ex))
+
+        def progress(result):
+            self.stdout.write('%(name)-18s median %(median_s)9.4fs  p95 %(p95_s)9.4fs  %(queries_per_run)7.1f queries' % result)
+
+        results = benchmarks.run(ctx, names=options['only'], repeat=options['repeat'], warmup=options['warmup'],
+                                 include_writes=not options['read_only'], progress=progress)
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, cls=DjangoJSONEncoder, indent=2)
+        self.stdout.write('results written to %s' % options['output'])
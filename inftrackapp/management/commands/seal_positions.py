@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_aware, make_aware
+
+import inftrackapp.segments as segments
+
+class Command(BaseCommand):
+    help = 'Move complete hours of tag positions out of the database into columnar segments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--until', help='seal hours before this ISO 8601 time (default: now minus POSITION_SEGMENT_SEAL_DELAY_HOURS)')
+
+    def handle(self, *args, **options):
+        store = segments.get_segment_store()
+        if store is None:
+            raise CommandError('POSITION_SEGMENT_DIR is not set, the segment store is disabled')
+
+        if options['until']:
+            until = parse_datetime(options['until'])
+            if until is None:
+                raise CommandError('--until must be an ISO 8601 datetime')
+            if not is_aware(until):
+                until = make_aware(until)
+        else:
+            until = segments.seal_until_default()
+
+        hours, moved = store.seal(until)
+        self.stdout.write('sealed %d hours, moved %d positions, database now holds positions from %s' % (hours, moved, store.sealed_until()))
@@ -0,0 +1,227 @@
+#######################################################################
+# metrics.py
+# Per-endpoint request metrics, exposed in Prometheus text format
+#
+# MetricsMiddleware records, for every request, labelled by URL route:
+#   - latency, until the last byte of a streamed body has been produced
+#   - number of database queries and the time spent in them
+#   - time spent serializing JSON (reported by api_json)
+#   - response size in bytes
+# into histograms held in process memory. Each worker process keeps its
+# own numbers; Prometheus scrapes and sums them per instance.
+#
+# The cost per request is a few perf_counter calls, one execute_wrapper
+# around each query and a bisect per histogram. SQL text is only kept
+# for the sampled share of requests (METRICS_TRACE_SAMPLE_RATE), and
+# only when such a request turns out slower than
+# METRICS_SLOW_REQUEST_SECONDS is its trace stored, in a ring buffer of
+# the last METRICS_TRACE_KEEP.
+#######################################################################
+import bisect
+import collections
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+UNMATCHED_ROUTE = '<unmatched>'
+
+class Histogram(object):
+    #
+    # per label set: count per bucket (not cumulative; summed when rendered), sum and count
+    #
+    def __init__(self, name, help_text, buckets, labelnames):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in sorted(self.series.items())]
+        for labels, counts, total in series:
+            label_text = ','.join('%s="%s"' % (name, _escape(value)) for name, value in zip(self.labelnames, labels))
+            sep = ',' if label_text else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append('%s_bucket{%s%sle="%s"} %d' % (self.name, label_text, sep, _format_bound(bound), cumulative))
+            cumulative += counts[-1]
+            lines.append('%s_bucket{%s%sle="+Inf"} %d' % (self.name, label_text, sep, cumulative))
+            lines.append('%s_sum{%s} %s' % (self.name, label_text, repr(float(total))))
+            lines.append('%s_count{%s} %d' % (self.name, label_text, cumulative))
+        return lines
+
+    def reset(self):
+        with self.lock:
+            self.series = {}
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_bound(bound):
+    return repr(float(bound)) if isinstance(bound, float) else str(bound)
+
+REQUEST_LABELS = ('route', 'method', 'status')
+ROUTE_LABELS = ('route',)
+
+REQUEST_SECONDS = Histogram('inftrack_http_request_duration_seconds', 'Time from request to last response byte.',
+                            LATENCY_BUCKETS, REQUEST_LABELS)
+DB_QUERIES = Histogram('inftrack_http_request_db_queries', 'Database queries per request.', QUERY_BUCKETS, ROUTE_LABELS)
+DB_SECONDS = Histogram('inftrack_http_request_db_seconds', 'Time per request spent waiting on the database.',
+                       LATENCY_BUCKETS, ROUTE_LABELS)
+SERIALIZE_SECONDS = Histogram('inftrack_http_request_serialize_seconds', 'Time per request spent encoding JSON.',
+                              LATENCY_BUCKETS, ROUTE_LABELS)
+RESPONSE_BYTES = Histogram('inftrack_http_response_bytes', 'Response body size.', BYTES_BUCKETS, ROUTE_LABELS)
+
+HISTOGRAMS = (REQUEST_SECONDS, DB_QUERIES, DB_SECONDS, SERIALIZE_SECONDS, RESPONSE_BYTES)
+
+###########################
+# per request accounting
+###########################
+_local = threading.local()
+_traces = collections.deque(maxlen=settings.METRICS_TRACE_KEEP)
+
+class RequestStats(object):
+    __slots__ = ('started', 'queries', 'db_seconds', 'serialize_seconds', 'bytes', 'trace', 'finished')
+
+    def __init__(self, sampled):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.bytes = 0
+        # (sql, seconds) of every query when this request was sampled
+        self.trace = [] if sampled else None
+        self.finished = False
+
+    def __call__(self, execute, sql, params, many, context):
+        #
+        # django execute_wrapper: time every query run on the connection
+        #
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.queries += 1
+            self.db_seconds += elapsed
+            if self.trace is not None:
+                self.trace.append((sql, elapsed))
+
+def add_serialize_time(seconds):
+    # called by api_json with the time spent encoding a response
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.serialize_seconds += seconds
+
+def recent_traces():
+    return list(_traces)
+
+###########################
+# middleware
+###########################
+class MetricsMiddleware(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+        stats = RequestStats(random.random() < settings.METRICS_TRACE_SAMPLE_RATE)
+        _local.stats = stats
+        wrappers = [conn.execute_wrappers for conn in connections.all()]
+        for execute_wrappers in wrappers:
+            execute_wrappers.append(stats)
+
+        def finish(response):
+            if stats.finished:
+                return
+            stats.finished = True
+            for execute_wrappers in wrappers:
+                if stats in execute_wrappers:
+                    execute_wrappers.remove(stats)
+            _local.stats = None
+            self.record(request, response, stats)
+
+        try:
+            response = self.get_response(request)
+        except Exception:
+            finish(None)
+            raise
+        if response.streaming:
+            #
+            # the body is produced after we return: account for it once it has been sent
+            #
+            response.streaming_content = self.counted(response.streaming_content, stats, finish, response)
+        else:
+            stats.bytes = len(response.content)
+            finish(response)
+        return response
+
+    def counted(self, chunks, stats, finish, response):
+        _local.stats = stats
+        try:
+            for chunk in chunks:
+                stats.bytes += len(chunk)
+                yield chunk
+        finally:
+            finish(response)
+
+    def record(self, request, response, stats):
+        elapsed = time.perf_counter() - stats.started
+        match = getattr(request, 'resolver_match', None)
+        route = match.route if match is not None and match.route else UNMATCHED_ROUTE
+        status = response.status_code if response is not None else 500
+        REQUEST_SECONDS.observe((route, request.method, str(status)), elapsed)
+        DB_QUERIES.observe((route,), stats.queries)
+        DB_SECONDS.observe((route,), stats.db_seconds)
+        SERIALIZE_SECONDS.observe((route,), stats.serialize_seconds)
+        RESPONSE_BYTES.observe((route,), stats.bytes)
+
+        if stats.trace is not None and elapsed >= settings.METRICS_SLOW_REQUEST_SECONDS:
+            slowest = sorted(stats.trace, key=lambda q: q[1], reverse=True)[:settings.METRICS_TRACE_MAX_QUERIES]
+            _traces.append({
+                "at": timezone.now(),
+                "method": request.method,
+                "path": request.get_full_path(),
+                "route": route,
+                "status": status,
+                "seconds": elapsed,
+                "db_seconds": stats.db_seconds,
+                "serialize_seconds": stats.serialize_seconds,
+                "queries": stats.queries,
+                "bytes": stats.bytes,
+                "slowest_queries": [{"sql": sql[:2000], "seconds": seconds} for sql, seconds in slowest]
+            })
+
+def render():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
+
+def reset():
+    for histogram in HISTOGRAMS:
+        histogram.reset()
+    _traces.clear()
@@ -0,0 +1,30 @@
+# Generated by Django 3.0.4 on 2026-10-17 15:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inftrackapp', '0002_auto_20200328_1854'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Zone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('polygon', models.TextField()),
+                ('min_x', models.FloatField(default=0.0)),
+                ('min_y', models.FloatField(default=0.0)),
+                ('max_x', models.FloatField(default=0.0)),
+                ('max_y', models.FloatField(default=0.0)),
+            ],
+            options={
+                'db_table': 'ethermed_zone',
+            },
+        ),
+    ]
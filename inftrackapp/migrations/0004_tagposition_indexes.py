@@ -0,0 +1,21 @@
+# Generated by Django 3.0.4 on 2026-10-17 15:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inftrackapp', '0003_zone'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tagposition',
+            index=models.Index(fields=['person', 'timestamp'], name='tagpos_person_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tagposition',
+            index=models.Index(fields=['tag', 'timestamp'], name='tagpos_tag_ts_idx'),
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 3.0.4 on 2026-10-17 15:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inftrackapp', '0004_tagposition_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContactEdge',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket_start', models.DateTimeField()),
+                ('duration_seconds', models.FloatField(default=0.0)),
+                ('min_distance', models.FloatField(default=0.0)),
+                ('first_contact', models.DateTimeField()),
+                ('last_contact', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'ethermed_contact_edge',
+            },
+        ),
+        migrations.CreateModel(
+            name='ContactGraphState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('covered_from', models.DateTimeField()),
+                ('processed_until', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'ethermed_contact_graph_state',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='tagposition',
+            index=models.Index(fields=['timestamp'], name='tagpos_ts_idx'),
+        ),
+        migrations.AddField(
+            model_name='contactedge',
+            name='person_a',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='contact_edges_a', to='inftrackapp.TrackablePerson'),
+        ),
+        migrations.AddField(
+            model_name='contactedge',
+            name='person_b',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='contact_edges_b', to='inftrackapp.TrackablePerson'),
+        ),
+        migrations.AddIndex(
+            model_name='contactedge',
+            index=models.Index(fields=['person_a', 'bucket_start'], name='contact_a_bucket_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='contactedge',
+            index=models.Index(fields=['person_b', 'bucket_start'], name='contact_b_bucket_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='contactedge',
+            index=models.Index(fields=['bucket_start'], name='contact_bucket_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='contactedge',
+            unique_together={('person_a', 'person_b', 'bucket_start')},
+        ),
+    ]
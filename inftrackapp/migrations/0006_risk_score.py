@@ -0,0 +1,33 @@
+# Generated by Django 3.0.4 on 2026-10-17 15:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inftrackapp', '0005_contact_graph'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RiskScore',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField(default=0.0)),
+                ('dose', models.FloatField(default=0.0)),
+                ('sources', models.IntegerField(default=0)),
+                ('computed_at', models.DateTimeField()),
+                ('person', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='risk_score', to='inftrackapp.TrackablePerson')),
+                ('top_source', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='inftrackapp.TrackablePerson')),
+            ],
+            options={
+                'db_table': 'ethermed_risk_score',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='riskscore',
+            index=models.Index(fields=['-score'], name='risk_score_idx'),
+        ),
+    ]
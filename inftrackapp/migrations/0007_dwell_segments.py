@@ -0,0 +1,52 @@
+# Generated by Django 3.0.4 on 2026-10-17 15:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inftrackapp', '0006_risk_score'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('compacted_until', models.DateTimeField()),
+                ('purged_until', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'ethermed_rollup_state',
+            },
+        ),
+        migrations.CreateModel(
+            name='DwellSegment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('x', models.FloatField(default=0.0)),
+                ('y', models.FloatField(default=0.0)),
+                ('radius', models.FloatField(default=0.0)),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('samples', models.IntegerField(default=0)),
+                ('person', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dwell_segments', to='inftrackapp.TrackablePerson')),
+                ('tag', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='dwell_segments', to='inftrackapp.TrackingTag')),
+            ],
+            options={
+                'db_table': 'ethermed_dwell_segment',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='dwellsegment',
+            index=models.Index(fields=['person', 'start'], name='dwell_person_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dwellsegment',
+            index=models.Index(fields=['start'], name='dwell_start_idx'),
+        ),
+    ]
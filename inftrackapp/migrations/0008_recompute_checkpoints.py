@@ -0,0 +1,29 @@
+# Generated by Django 3.0.4 on 2026-10-17 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inftrackapp', '0007_dwell_segments'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecomputeCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('job', models.CharField(max_length=64)),
+                ('window_start', models.DateTimeField()),
+                ('window_end', models.DateTimeField()),
+                ('edges', models.IntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'ethermed_recompute_checkpoint',
+                'unique_together': {('job', 'window_start')},
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.0.4 on 2026-10-17 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inftrackapp', '0008_recompute_checkpoints'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='statuschangeevent',
+            index=models.Index(fields=['person', 'timestamp'], name='status_person_ts_idx'),
+        ),
+    ]
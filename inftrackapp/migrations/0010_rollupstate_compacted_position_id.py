@@ -0,0 +1,18 @@
+# Generated by Django 3.0.4 on 2026-10-17 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inftrackapp', '0009_statuschangeevent_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rollupstate',
+            name='compacted_position_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
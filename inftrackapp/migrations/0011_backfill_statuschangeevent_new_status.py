@@ -0,0 +1,30 @@
+from django.db import migrations
+
+STATUSES = ['ok', 'at_risk', 'being_tested', 'infected']
+
+
+def backfill_new_status(apps, schema_editor):
+    #
+    # events written by the original change_person_status never set new_status; it is the
+    # prior_status of the person's next change, or their current status after the last one
+    #
+    StatusChangeEvent = apps.get_model('inftrackapp', 'StatusChangeEvent')
+    person_ids = StatusChangeEvent.objects.exclude(new_status__in=STATUSES).values_list('person_id', flat=True).distinct()
+    for person_id in list(person_ids):
+        events = list(StatusChangeEvent.objects.filter(person_id=person_id).select_related('person').order_by('timestamp', 'id'))
+        for i, evt in enumerate(events):
+            if evt.new_status in STATUSES:
+                continue
+            evt.new_status = events[i + 1].prior_status if i + 1 < len(events) else evt.person.status
+            evt.save(update_fields=['new_status'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inftrackapp', '0010_rollupstate_compacted_position_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_new_status, migrations.RunPython.noop),
+    ]
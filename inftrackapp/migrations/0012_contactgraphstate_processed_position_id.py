@@ -0,0 +1,18 @@
+# Generated by Django 3.0.4 on 2026-10-17 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inftrackapp', '0011_backfill_statuschangeevent_new_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contactgraphstate',
+            name='processed_position_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -125,14 +125,12 @@ class TrackablePerson(EthermedModel):
     #
     @property
     def current_tag(self):
-        try:
-            tag_assign_event = TagAssignmentEvent.objects.filter(person=self).order_by('-timestamp')[0]
-        except Exception as ex:
-            return None
-        if tag_assign_event.event_type ==  ASSIGN_EVENT_ASSIGNED:
-            return tag_assign_event.tag
-        else:
+        # the tag worn now, from the tag assignment index
+        import inftrackapp.assignments as assignments
+        tag_id = assignments.get_assignment_index().tag_at(self.id, time.time())
+        if tag_id is None:
             return None
+        return TrackingTag.objects.get_or_none(id=tag_id)
 
     def __str__(self):
         modelName="TrackablePerson"
@@ -159,14 +157,12 @@ class TrackingTag(EthermedModel):
     #
     @property
     def current_person(self):
-        try:
-            tag_assign_event = TagAssignmentEvent.objects.filter(tag=self).order_by('-timestamp')[0]
-        except Exception as ex:
-            return None
-        if tag_assign_event.event_type ==  ASSIGN_EVENT_ASSIGNED:
-            return tag_assign_event.person
-        else:
+        # the person wearing the tag now, from the tag assignment index
+        import inftrackapp.assignments as assignments
+        person_id = assignments.get_assignment_index().person_at(self.id, time.time())
+        if person_id is None:
             return None
+        return TrackablePerson.objects.get_or_none(id=person_id)
 
     def __str__(self):
         modelName="TrackingTag"
@@ -234,6 +230,70 @@ class StatusChangeEvent(EthermedModel):
 
     class Meta:
         db_table = 'ethermed_status_change_event'
+        indexes = [
+            models.Index(fields=['person', 'timestamp'], name='status_person_ts_idx'),
+        ]
+
+##########################################
+# Zone
+# A named polygon on the same x/y plane
+# as the tag positions
+##########################################
+class Zone(EthermedModel):
+    #
+    # override manager so we get custom behavior get_or_none
+    #
+    objects = EthermedQueryManager()
+
+    name = models.CharField(max_length=100,unique=True,null=False,blank=False)
+    #
+    # JSON list of [x, y] vertices, in order, without repeating the first one
+    #
+    polygon = models.TextField(null=False,blank=False)
+
+    #
+    # bounding box, kept in step with the polygon on save
+    #
+    min_x = models.FloatField(null=False,blank=False,default=0.0)
+    min_y = models.FloatField(null=False,blank=False,default=0.0)
+    max_x = models.FloatField(null=False,blank=False,default=0.0)
+    max_y = models.FloatField(null=False,blank=False,default=0.0)
+
+    ####################################
+    # custom methods
+    ####################################
+    #
+    @property
+    def points(self):
+        return [(float(x), float(y)) for x, y in json.loads(self.polygon)]
+
+    @points.setter
+    def points(self, value):
+        self.polygon = json.dumps([[float(x), float(y)] for x, y in value])
+
+    def clean(self):
+        try:
+            points = self.points
+        except (ValueError, TypeError) as ex:
+            raise ValidationError("polygon must be a JSON list of [x, y] pairs")
+        if len(points) < 3:
+            raise ValidationError("polygon needs at least 3 vertices")
+
+    def save(self, *args, **kwargs):
+        points = self.points
+        self.min_x = min(x for x, y in points)
+        self.min_y = min(y for x, y in points)
+        self.max_x = max(x for x, y in points)
+        self.max_y = max(y for x, y in points)
+        super(Zone, self).save(*args, **kwargs)
+
+    def __str__(self):
+        modelName="Zone"
+        vars=["name","min_x","min_y","max_x","max_y"]
+        return self._descr_string(modelName,vars)
+
+    class Meta:
+        db_table = 'ethermed_zone'
 
 ##########################################
 # TagPosition
@@ -253,3 +313,176 @@ class TagPosition(models.Model):
 
     class Meta:
         db_table = 'ethermed_tag_position'
+        indexes = [
+            models.Index(fields=['person', 'timestamp'], name='tagpos_person_ts_idx'),
+            models.Index(fields=['tag', 'timestamp'], name='tagpos_tag_ts_idx'),
+            models.Index(fields=['timestamp'], name='tagpos_ts_idx'),
+        ]
+
+##########################################
+# ContactEdge
+# Time two people spent within contact
+# distance of each other during one time
+# bucket; person_a always has the lower id
+##########################################
+class ContactEdge(models.Model):
+    person_a = models.ForeignKey('TrackablePerson',null=False,on_delete=models.CASCADE,related_name='contact_edges_a')
+    person_b = models.ForeignKey('TrackablePerson',null=False,on_delete=models.CASCADE,related_name='contact_edges_b')
+    bucket_start = models.DateTimeField()
+    duration_seconds = models.FloatField(null=False,blank=False,default=0.0)
+    min_distance = models.FloatField(null=False,blank=False,default=0.0)
+    first_contact = models.DateTimeField()
+    last_contact = models.DateTimeField()
+
+    def __str__(self):
+        return "ContactEdge [id=%s, person_a=%s, person_b=%s, bucket_start=%s, duration_seconds=%s, min_distance=%s]" % (
+            self.id, self.person_a_id, self.person_b_id, self.bucket_start, self.duration_seconds, self.min_distance)
+
+    class Meta:
+        db_table = 'ethermed_contact_edge'
+        unique_together = [['person_a', 'person_b', 'bucket_start']]
+        indexes = [
+            models.Index(fields=['person_a', 'bucket_start'], name='contact_a_bucket_idx'),
+            models.Index(fields=['person_b', 'bucket_start'], name='contact_b_bucket_idx'),
+            models.Index(fields=['bucket_start'], name='contact_bucket_idx'),
+        ]
+
+##########################################
+# ContactGraphState
+# Single row: how far the contact graph
+# has been built from raw positions
+##########################################
+class ContactGraphState(EthermedModel):
+    #
+    # override manager so we get custom behavior get_or_none
+    #
+    objects = EthermedQueryManager()
+
+    #
+    # edges are complete for positions in [covered_from, processed_until)
+    #
+    covered_from = models.DateTimeField()
+    processed_until = models.DateTimeField()
+    #
+    # the last position id the graph has seen; rows above it with timestamps below
+    # processed_until arrived late and their buckets are recomputed
+    #
+    processed_position_id = models.BigIntegerField(null=True,blank=True)
+
+    def __str__(self):
+        modelName="ContactGraphState"
+        vars=["covered_from","processed_until","processed_position_id"]
+        return self._descr_string(modelName,vars)
+
+    class Meta:
+        db_table = 'ethermed_contact_graph_state'
+
+##########################################
+# RiskScore
+# Materialized exposure risk per person,
+# written by risk.refresh_scores
+##########################################
+class RiskScore(models.Model):
+    person = models.OneToOneField('TrackablePerson',null=False,on_delete=models.CASCADE,related_name='risk_score')
+    score = models.FloatField(null=False,blank=False,default=0.0)
+    dose = models.FloatField(null=False,blank=False,default=0.0)
+    sources = models.IntegerField(null=False,blank=False,default=0)
+    top_source = models.ForeignKey('TrackablePerson',null=True,blank=True,on_delete=models.SET_NULL,related_name='+')
+    computed_at = models.DateTimeField()
+
+    def __str__(self):
+        return "RiskScore [id=%s, person=%s, score=%s, dose=%s, sources=%s, computed_at=%s]" % (
+            self.id, self.person_id, self.score, self.dose, self.sources, self.computed_at)
+
+    class Meta:
+        db_table = 'ethermed_risk_score'
+        indexes = [
+            models.Index(fields=['-score'], name='risk_score_idx'),
+        ]
+
+##########################################
+# DwellSegment
+# A run of positions of one person that
+# stayed within a small area, replacing the
+# raw positions once they are compacted
+##########################################
+class DwellSegment(models.Model):
+    tag = models.ForeignKey('TrackingTag',null=True,blank=True,on_delete=models.SET_NULL,related_name='dwell_segments')
+    person = models.ForeignKey('TrackablePerson',null=False,on_delete=models.CASCADE,related_name='dwell_segments')
+    #
+    # centroid of the positions, and the largest distance of any of them from it
+    #
+    x = models.FloatField(null=False,blank=False,default=0.0)
+    y = models.FloatField(null=False,blank=False,default=0.0)
+    radius = models.FloatField(null=False,blank=False,default=0.0)
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    samples = models.IntegerField(null=False,blank=False,default=0)
+
+    def __str__(self):
+        return "DwellSegment [id=%s, person=%s, tag=%s, x=%s, y=%s, radius=%s, start=%s, end=%s]" % (
+            self.id, self.person_id, self.tag_id, self.x, self.y, self.radius, self.start, self.end)
+
+    class Meta:
+        db_table = 'ethermed_dwell_segment'
+        indexes = [
+            models.Index(fields=['person', 'start'], name='dwell_person_start_idx'),
+            models.Index(fields=['start'], name='dwell_start_idx'),
+        ]
+
+##########################################
+# RollupState
+# Single row: how far raw positions have
+# been compacted into dwell segments, and
+# how far the raw positions have been purged
+##########################################
+class RollupState(EthermedModel):
+    #
+    # override manager so we get custom behavior get_or_none
+    #
+    objects = EthermedQueryManager()
+
+    #
+    # readers take positions before compacted_until from DwellSegment
+    #
+    compacted_until = models.DateTimeField()
+    purged_until = models.DateTimeField(null=True,blank=True)
+    #
+    # highest TagPosition id when compaction last ran; hours below compacted_until holding
+    # positions above it received readings since and are compacted again
+    #
+    compacted_position_id = models.BigIntegerField(null=True,blank=True)
+
+    def __str__(self):
+        modelName="RollupState"
+        vars=["compacted_until","purged_until","compacted_position_id"]
+        return self._descr_string(modelName,vars)
+
+    class Meta:
+        db_table = 'ethermed_rollup_state'
+
+##########################################
+# RecomputeCheckpoint
+# One row per time window finished by a
+# recompute job, so an interrupted job
+# resumes where it stopped
+##########################################
+class RecomputeCheckpoint(EthermedModel):
+    #
+    # override manager so we get custom behavior get_or_none
+    #
+    objects = EthermedQueryManager()
+
+    job = models.CharField(max_length=64)
+    window_start = models.DateTimeField()
+    window_end = models.DateTimeField()
+    edges = models.IntegerField(null=False,blank=False,default=0)
+
+    def __str__(self):
+        modelName="RecomputeCheckpoint"
+        vars=["job","window_start","window_end","edges"]
+        return self._descr_string(modelName,vars)
+
+    class Meta:
+        db_table = 'ethermed_recompute_checkpoint'
+        unique_together = [['job', 'window_start']]
@@ -0,0 +1,376 @@
+#######################################################################
+# positions.py
+# Columnar access to tag positions
+#
+# Analysis code works on parallel numpy arrays rather than TagPosition
+# instances. load_positions hides where a time window is stored, oldest
+# first: compacted history comes from dwell segments (see rollups.py),
+# sealed history from the segment store (see segments.py), recent data
+# from the database.
+#######################################################################
+import datetime
+
+import numpy as np
+
+from django.conf import settings
+from django.db.models import Q
+
+import inftrackapp.assignments as assignments
+import inftrackapp.compression as compression
+import inftrackapp.dao as dao
+import inftrackapp.models as models
+import inftrackapp.segments as segments
+
+###########################
+# columnar position data
+###########################
+class PositionFrame(object):
+    #
+    # parallel numpy arrays: person id, x, y and epoch seconds
+    #
+    __slots__ = ('person', 'x', 'y', 't')
+
+    def __init__(self, person, x, y, t):
+        self.person = np.asarray(person, dtype=np.int64)
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.t = np.asarray(t, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.t)
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], [], [])
+
+    @classmethod
+    def from_rows(cls, rows):
+        # rows are (person_id, x, y, timestamp) tuples as returned by values_list
+        rows = list(rows)
+        if not rows:
+            return cls.empty()
+        person, x, y, ts = zip(*rows)
+        return cls(person, x, y, [dt.timestamp() for dt in ts])
+
+    @classmethod
+    def concat(cls, frames):
+        frames = [f for f in frames if len(f)]
+        if not frames:
+            return cls.empty()
+        return cls(np.concatenate([f.person for f in frames]),
+                   np.concatenate([f.x for f in frames]),
+                   np.concatenate([f.y for f in frames]),
+                   np.concatenate([f.t for f in frames]))
+
+    def select(self, mask):
+        return PositionFrame(self.person[mask], self.x[mask], self.y[mask], self.t[mask])
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+def epoch_to_datetime(secs):
+    return datetime.datetime.fromtimestamp(float(secs), tz=datetime.timezone.utc)
+
+def micros_to_datetime(micros):
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+###########################
+# loading
+###########################
+def _filter_persons(frame, person_ids, exclude_person_ids):
+    if person_ids is not None:
+        frame = frame.select(np.isin(frame.person, np.asarray(list(person_ids), dtype=np.int64)))
+    if exclude_person_ids:
+        frame = frame.select(~np.isin(frame.person, np.asarray(list(exclude_person_ids), dtype=np.int64)))
+    return frame
+
+def _holders(tag_ids, ts):
+    #
+    # whoever the assignment data says wore tag_ids[i] at ts[i], -1 where nobody did;
+    # used instead of the person ids stored at ingest when positions are reassigned
+    #
+    return assignments.get_assignment_index().persons_at(tag_ids, ts)
+
+def load_db_positions(fromdt, todt, person_ids=None, exclude_person_ids=None, reassign=False):
+    qs = models.TagPosition.objects.filter(timestamp__gte=fromdt, timestamp__lte=todt)
+    if not reassign:
+        if person_ids is not None:
+            qs = qs.filter(person_id__in=list(person_ids))
+        if exclude_person_ids:
+            qs = qs.exclude(person_id__in=list(exclude_person_ids))
+        return PositionFrame.from_rows(qs.values_list('person_id', 'x', 'y', 'timestamp').iterator())
+    frame = PositionFrame.from_rows(qs.values_list('tag_id', 'x', 'y', 'timestamp').iterator())
+    frame.person = _holders(frame.person, frame.t)
+    return _filter_persons(frame.select(frame.person >= 0), person_ids, exclude_person_ids)
+
+def compacted_until():
+    # positions before this time are only held as dwell segments, None when nothing is compacted
+    state = models.RollupState.objects.order_by('id').first()
+    return state.compacted_until if state is not None else None
+
+def dwell_segments(fromdt, todt, person_ids=None, exclude_person_ids=None):
+    # dwell segments overlapping fromdt <= t < todt
+    qs = models.DwellSegment.objects.filter(start__lt=todt, end__gte=fromdt)
+    if person_ids is not None:
+        qs = qs.filter(person_id__in=list(person_ids))
+    if exclude_person_ids:
+        qs = qs.exclude(person_id__in=list(exclude_person_ids))
+    return qs
+
+def load_dwell_positions(fromdt, todt, person_ids=None, exclude_person_ids=None, reassign=False):
+    #
+    # dwell segments overlapping fromdt <= t < todt expanded back into positions, one
+    # at the centroid every CONTACT_SAMPLE_SECONDS, which is what contact detection samples
+    # reassign takes each segment's holder from its tag at the segment start; segments
+    # without a tag keep their person
+    #
+    qs = dwell_segments(fromdt, todt, None if reassign else person_ids, None if reassign else exclude_person_ids)
+    rows = list(qs.values_list('person_id', 'x', 'y', 'start', 'end', 'tag_id').iterator())
+    if not rows:
+        return PositionFrame.empty()
+    person, x, y, start, end, tag = zip(*rows)
+    step = float(settings.CONTACT_SAMPLE_SECONDS)
+    lo = fromdt.timestamp()
+    hi = todt.timestamp()
+    start = np.array([dt.timestamp() for dt in start])
+    person = np.asarray(person, dtype=np.int64)
+    if reassign:
+        tag = np.array([-1 if t is None else t for t in tag], dtype=np.int64)
+        person = np.where(tag >= 0, _holders(tag, start), person)
+    start = np.maximum(start, lo)
+    end = np.minimum([dt.timestamp() for dt in end], np.nextafter(hi, -np.inf))
+    counts = np.maximum(np.floor((end - start) / step).astype(np.int64) + 1, 0)
+    counts[person < 0] = 0
+    owner = np.repeat(np.arange(len(rows)), counts)
+    offsets = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts)
+    frame = PositionFrame(person[owner], np.asarray(x)[owner], np.asarray(y)[owner], start[owner] + offsets * step)
+    return _filter_persons(frame, person_ids, exclude_person_ids) if reassign else frame
+
+def database_from():
+    #
+    # readers only take positions from this time on from the database, None when they take
+    # all of them; ingestion rejects readings older than this, they would never be read
+    #
+    store = segments.get_segment_store()
+    cutoffs = [compacted_until(), store.sealed_until() if store is not None else None]
+    cutoffs = [cutoff for cutoff in cutoffs if cutoff is not None]
+    return max(cutoffs) if cutoffs else None
+
+def load_raw_positions(fromdt, todt):
+    #
+    # every raw position with fromdt <= timestamp < todt, wherever it is held, ignoring the
+    # compaction watermark; a seal of these hours that has journaled its rows is completed
+    # first, so none of them is read from both the database and a segment file
+    #
+    frames = []
+    store = segments.get_segment_store()
+    if store is not None:
+        hour = segments.floor_hour(fromdt)
+        while hour < todt:
+            store.finish_pending(hour)
+            hour += segments.HOUR
+        data = store.load(fromdt, todt)
+        frames.append(PositionFrame(data['person'], data['x'], data['y'], data['timestamp'] / float(segments.MICROS)))
+    frames.append(load_db_positions(fromdt, todt - datetime.timedelta(microseconds=1)))
+    return PositionFrame.concat(frames)
+
+def load_positions(fromdt, todt, person_ids=None, exclude_person_ids=None, reassign=False):
+    #
+    # positions with fromdt <= timestamp <= todt; with compression on, the readings dropped
+    # at ingest are filled back in every CONTACT_SAMPLE_SECONDS from the stored ones, which
+    # may lie up to POSITION_COMPRESSION_MAX_INTERVAL_SECONDS before the window
+    # reassign attributes each position to whoever the current assignment data says wore
+    # its tag at the time, instead of the person resolved at ingest (see recompute.py)
+    #
+    if not settings.POSITION_COMPRESSION_ENABLED:
+        return load_stored_positions(fromdt, todt, person_ids=person_ids, exclude_person_ids=exclude_person_ids, reassign=reassign)
+    max_interval = settings.POSITION_COMPRESSION_MAX_INTERVAL_SECONDS
+    frame = load_stored_positions(fromdt - datetime.timedelta(seconds=max_interval), todt,
+                                  person_ids=person_ids, exclude_person_ids=exclude_person_ids, reassign=reassign)
+    frame = PositionFrame(*compression.fill_gaps(frame.person, frame.x, frame.y, frame.t, settings.CONTACT_SAMPLE_SECONDS,
+                                                  max_interval, until=np.nextafter(todt.timestamp(), np.inf)))
+    return frame.select(frame.t >= fromdt.timestamp())
+
+def load_stored_positions(fromdt, todt, person_ids=None, exclude_person_ids=None, reassign=False):
+    #
+    # positions with fromdt <= timestamp <= todt as stored: from dwell segments before the
+    # compaction watermark, from sealed segments before the segment watermark and from
+    # the database for the rest
+    #
+    frames = []
+    compacted = compacted_until()
+    if compacted is not None and fromdt < compacted:
+        frames.append(load_dwell_positions(fromdt, min(todt + datetime.timedelta(microseconds=1), compacted),
+                                           person_ids=person_ids, exclude_person_ids=exclude_person_ids, reassign=reassign))
+        fromdt = compacted
+    store = segments.get_segment_store()
+    sealed = store.sealed_until() if store is not None else None
+    if sealed is not None and fromdt < sealed:
+        holders = (lambda tag_id, ts: _holders(np.full(len(ts), tag_id, dtype=np.int64), ts)) if reassign else None
+        data = store.load(fromdt, min(todt, sealed), person_ids=person_ids, exclude_person_ids=exclude_person_ids, holders=holders)
+        frames.append(PositionFrame(data['person'], data['x'], data['y'], data['timestamp'] / float(segments.MICROS)))
+        fromdt = sealed
+    if fromdt <= todt:
+        frames.append(load_db_positions(fromdt, todt, person_ids=person_ids, exclude_person_ids=exclude_person_ids, reassign=reassign))
+    return PositionFrame.concat(frames)
+
+def people_within(fromdt, todt, bounds, exclude_person_ids=None):
+    #
+    # ids of the people with a stored position inside bounds = (x0, y0, x1, y1) and
+    # fromdt <= timestamp <= todt, from the same stores as load_stored_positions; only ids
+    # are read from the database, no positions are built
+    #
+    x0, y0, x1, y1 = bounds
+    found = set()
+    compacted = compacted_until()
+    if compacted is not None and fromdt < compacted:
+        # a dwell segment stands for positions at its centroid
+        qs = dwell_segments(fromdt, min(todt + datetime.timedelta(microseconds=1), compacted), exclude_person_ids=exclude_person_ids)
+        found.update(qs.filter(x__gte=x0, x__lte=x1, y__gte=y0, y__lte=y1).values_list('person_id', flat=True).distinct())
+        fromdt = compacted
+    store = segments.get_segment_store()
+    sealed = store.sealed_until() if store is not None else None
+    if sealed is not None and fromdt < sealed:
+        data = store.load(fromdt, min(todt, sealed), exclude_person_ids=exclude_person_ids)
+        inside = (data['x'] >= x0) & (data['x'] <= x1) & (data['y'] >= y0) & (data['y'] <= y1)
+        found.update(np.unique(data['person'][inside]).tolist())
+        fromdt = sealed
+    if fromdt <= todt:
+        qs = models.TagPosition.objects.filter(timestamp__gte=fromdt, timestamp__lte=todt, x__gte=x0, x__lte=x1, y__gte=y0, y__lte=y1)
+        if exclude_person_ids:
+            qs = qs.exclude(person_id__in=list(exclude_person_ids))
+        found.update(qs.values_list('person_id', flat=True).distinct())
+    return found
+
+###########################
+# person traces
+###########################
+#
+# A cursor is (epoch microseconds, row id, seen) of the last row delivered. Rows from
+# dwell segments, sealed segments and interpolation have no database id and carry row id 0;
+# several of them can share a timestamp, so seen counts how many of those at that
+# timestamp have been delivered.
+#
+def encode_cursor(micros, row_id, seen=0):
+    return '%d-%d-%d' % (micros, row_id, seen)
+
+def decode_cursor(cursor):
+    # (epoch microseconds, row id, seen) of the last row already delivered; raises ValueError
+    parts = [int(part) for part in cursor.split('-')]
+    if len(parts) == 2:
+        # cursors issued before seen was added skip every id-less row at their timestamp
+        parts.append(int(np.iinfo(np.int64).max) if parts[1] == 0 else 0)
+    micros, row_id, seen = parts
+    return micros, row_id, seen
+
+def next_cursor(previous, micros, row_id):
+    # the cursor once (micros, row_id) has been delivered, previous being the cursor before it
+    if row_id == 0 and previous is not None and previous[0] == micros and previous[1] == 0:
+        return micros, 0, previous[2] + 1
+    return micros, row_id, 1 if row_id == 0 else 0
+
+def _delivered(after):
+    #
+    # predicate telling whether a row was delivered before the cursor after;
+    # it must see the rows in trace order, it counts down the id-less ones it skips
+    #
+    if after is None:
+        return lambda micros, row_id: False
+    after_micros, after_id, seen = after
+    remaining = [seen]
+
+    def delivered(micros, row_id):
+        if micros != after_micros:
+            return micros < after_micros
+        if row_id or after_id:
+            return row_id <= after_id
+        if remaining[0] > 0:
+            remaining[0] -= 1
+            return True
+        return False
+    return delivered
+
+def iter_trace(person, fromdt, todt, after=None):
+    #
+    # stream a person's positions in time order as (epoch microseconds, row id, x, y)
+    # after is a decoded cursor; rows up to and including it are skipped
+    # sealed rows have no database id and are reported with row id 0; compacted history is
+    # reported as the centroid of each dwell segment at its start and at its end
+    #
+    delivered = _delivered(after)
+    if after is not None:
+        after_micros, after_id = after[0], after[1]
+        after_dt = micros_to_datetime(after_micros)
+        fromdt = max(fromdt, after_dt)
+    compacted = compacted_until()
+    if compacted is not None and fromdt < compacted:
+        end = min(todt + datetime.timedelta(microseconds=1), compacted)
+        qs = dwell_segments(fromdt, end, person_ids=[person.id]).order_by('start')
+        lo = int(round(fromdt.timestamp() * segments.MICROS))
+        hi = int(round(end.timestamp() * segments.MICROS))
+        for start, stop, x, y in qs.values_list('start', 'end', 'x', 'y').iterator(chunk_size=2000):
+            for micros in sorted(set([int(round(start.timestamp() * segments.MICROS)), int(round(stop.timestamp() * segments.MICROS))])):
+                if lo <= micros < hi and not delivered(micros, 0):
+                    yield micros, 0, x, y
+        fromdt = compacted
+    store = segments.get_segment_store()
+    sealed = store.sealed_until() if store is not None else None
+    if sealed is not None and fromdt < sealed:
+        #
+        # only the tags this person has ever worn can hold their positions
+        #
+        tag_ids = sorted(set(models.TagAssignmentEvent.objects.filter(person=person).values_list('tag_id', flat=True)))
+        hour = segments.floor_hour(fromdt)
+        while hour < min(todt, sealed):
+            data = store.load(max(fromdt, hour), min(todt, sealed, hour + segments.HOUR),
+                              person_ids=[person.id], tag_ids=tag_ids)
+            data = data[np.argsort(data['timestamp'], kind='stable')]
+            for micros, x, y in zip(data['timestamp'].tolist(), data['x'].tolist(), data['y'].tolist()):
+                if not delivered(micros, 0):
+                    yield micros, 0, x, y
+            hour += segments.HOUR
+        fromdt = sealed
+    if fromdt > todt:
+        return
+
+    qs = dao.get_person_position_trace(person, fromdt, todt)
+    if after is not None:
+        qs = qs.filter(Q(timestamp__gt=after_dt) | Q(timestamp=after_dt, id__gt=after_id))
+    for row_id, ts, x, y in qs.values_list('id', 'timestamp', 'x', 'y').iterator(chunk_size=2000):
+        yield int(round(ts.timestamp() * segments.MICROS)), row_id, x, y
+
+def iter_filled_trace(person, fromdt, todt, step, after=None):
+    #
+    # iter_trace with the readings dropped by compression put back: after each stored position
+    # the same position every step seconds until the next one, for at most
+    # POSITION_COMPRESSION_MAX_INTERVAL_SECONDS; filled-in rows have row id 0
+    #
+    max_interval = settings.POSITION_COMPRESSION_MAX_INTERVAL_SECONDS
+    start = fromdt
+    if after is not None:
+        start = max(fromdt, micros_to_datetime(after[0]))
+    delivered = _delivered(after)
+    lo = int(round(fromdt.timestamp() * segments.MICROS))
+    hi = int(round(todt.timestamp() * segments.MICROS))
+    step_micros = int(round(step * segments.MICROS))
+    max_micros = int(round(max_interval * segments.MICROS))
+
+    def wanted(micros, row_id):
+        return lo <= micros <= hi and not delivered(micros, row_id)
+
+    def fill(micros, x, y, limit):
+        filled = micros + step_micros
+        while filled < limit:
+            if wanted(filled, 0):
+                yield filled, 0, x, y
+            filled += step_micros
+
+    previous = None
+    for row in iter_trace(person, start - datetime.timedelta(seconds=max_interval), todt):
+        micros, row_id, x, y = row
+        if previous is not None:
+            yield from fill(previous[0], previous[2], previous[3], min(micros, previous[0] + max_micros))
+        if wanted(micros, row_id):
+            yield row
+        previous = row
+    if previous is not None:
+        yield from fill(previous[0], previous[2], previous[3], min(hi + 1, previous[0] + max_micros))
@@ -0,0 +1,179 @@
+#######################################################################
+# recompute.py
+# Parallel recompute of contact graph history
+#
+# After the contact threshold changes, or tag assignments are corrected,
+# the edges for months of history have to be rebuilt from positions.
+# run() cuts the range into windows of RECOMPUTE_WINDOW_HOURS aligned to
+# graph buckets and joins them in a pool of worker processes. Each worker
+# reads RECOMPUTE_MARGIN_SECONDS of positions either side of its window,
+# so anything straddling the boundary (a contact sample, a reading held
+# by compression) is seen whole, but keeps only the edges whose bucket
+# starts inside the window: every edge has exactly one owner.
+#
+# Workers only read. The parent swaps each finished window's edges in
+# (contact_graph.replace_edges) and records a RecomputeCheckpoint in the
+# same transaction, so a window is either fully replaced and checkpointed
+# or untouched. Re-running the same job skips checkpointed windows, and
+# replaying a window gives the same edges, so an interrupted run just
+# resumes.
+#
+# Positions are attributed to whoever the assignment data says wore their
+# tag at the time (positions.load_positions(reassign=True)), not to the
+# person resolved at ingest, so corrected assignments take effect. The
+# job name is derived from the range, the contact settings and a version
+# of the assignment data, so changing the threshold or fixing assignments
+# starts a fresh job.
+#######################################################################
+import concurrent.futures
+import datetime
+import hashlib
+import logging
+import multiprocessing
+import os
+
+import django
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+
+import inftrackapp.contact_graph as contact_graph
+import inftrackapp.models as models
+import inftrackapp.positions as positions
+
+logger = logging.getLogger(__name__)
+
+def plan_windows(fromdt, todt, window_seconds):
+    # [start, end) windows covering [fromdt, todt), starting on graph bucket boundaries
+    bucket_seconds = settings.CONTACT_GRAPH_BUCKET_SECONDS
+    window_seconds = max(bucket_seconds, (window_seconds // bucket_seconds) * bucket_seconds)
+    start = contact_graph._floor(fromdt, bucket_seconds)
+    windows = []
+    while start < todt:
+        end = min(todt, start + datetime.timedelta(seconds=window_seconds))
+        windows.append((start, end))
+        start = end
+    return windows
+
+def assignment_version():
+    #
+    # changes whenever a tag assignment event is added, edited or deleted
+    #
+    version = models.TagAssignmentEvent.objects.aggregate(count=Count('id'), last_id=Max('id'), modified=Max('modified'))
+    modified = version['modified'].timestamp() if version['modified'] is not None else 0
+    return '%s:%s:%s' % (version['count'], version['last_id'] or 0, modified)
+
+def job_name(fromdt, todt, window_seconds):
+    key = '%s|%s|%s|%s|%s|%s|%s' % (fromdt.timestamp(), todt.timestamp(), window_seconds, settings.CONTACT_DISTANCE_METERS,
+                                    settings.CONTACT_SAMPLE_SECONDS, settings.CONTACT_GRAPH_BUCKET_SECONDS, assignment_version())
+    return 'contacts-%s' % hashlib.md5(key.encode('utf-8')).hexdigest()[:16]
+
+###########################
+# workers
+###########################
+def compute_window(start_ts, end_ts, margin_seconds):
+    #
+    # edges (see contact_graph.edges_for_frame) with a bucket in [start_ts, end_ts);
+    # runs in a worker process, times are epoch seconds
+    #
+    margin = datetime.timedelta(seconds=margin_seconds)
+    start = positions.epoch_to_datetime(start_ts)
+    end = positions.epoch_to_datetime(end_ts)
+    edges = contact_graph.compute_edges(start - margin, end + margin, reassign=True)
+    bucket_start = edges[2]
+    own = (bucket_start >= start_ts) & (bucket_start < end_ts)
+    return start_ts, end_ts, tuple(column[own] for column in edges)
+
+###########################
+# driver
+###########################
+def default_until():
+    #
+    # whole buckets the live graph has already passed; the bucket it is
+    # still folding readings into is left to advance()
+    #
+    state = contact_graph.get_state()
+    if state is not None:
+        return contact_graph._floor(state.processed_until, settings.CONTACT_GRAPH_BUCKET_SECONDS)
+    return contact_graph._floor(timezone.now() - datetime.timedelta(seconds=settings.CONTACT_GRAPH_LAG_SECONDS),
+                                settings.CONTACT_GRAPH_BUCKET_SECONDS)
+
+def _save(job, start_ts, end_ts, edges):
+    start = positions.epoch_to_datetime(start_ts)
+    end = positions.epoch_to_datetime(end_ts)
+    with transaction.atomic():
+        written = contact_graph.replace_edges(start, end, *edges, sample_seconds=settings.CONTACT_SAMPLE_SECONDS)
+        models.RecomputeCheckpoint.objects.create(job=job, window_start=start, window_end=end, edges=written)
+    return written
+
+def run(fromdt, todt=None, workers=None, window_seconds=None, margin_seconds=None, job=None, restart=False, progress=None):
+    #
+    # recompute the edges of [fromdt, todt) in parallel; progress(start, end, edges, done, total)
+    # is called as each window is saved
+    # returns (job, windows computed, windows skipped as already done, edges written)
+    #
+    # whole buckets only, and never the one the live graph is still writing to
+    todt = min(contact_graph._floor(todt, settings.CONTACT_GRAPH_BUCKET_SECONDS), default_until()) if todt else default_until()
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if window_seconds is None:
+        window_seconds = settings.RECOMPUTE_WINDOW_HOURS * 3600
+    if margin_seconds is None:
+        margin_seconds = settings.RECOMPUTE_MARGIN_SECONDS
+    windows = plan_windows(fromdt, todt, window_seconds)
+    if not windows:
+        return job, 0, 0, 0
+    if job is None:
+        job = job_name(windows[0][0], todt, window_seconds)
+    if restart:
+        models.RecomputeCheckpoint.objects.filter(job=job).delete()
+    done = set(dt.timestamp() for dt in models.RecomputeCheckpoint.objects.filter(job=job).values_list('window_start', flat=True))
+    pending = [(start.timestamp(), end.timestamp()) for start, end in windows if start.timestamp() not in done]
+
+    computed = 0
+    written = 0
+
+    def finished(start_ts, end_ts, edges):
+        nonlocal computed, written
+        n = _save(job, start_ts, end_ts, edges)
+        computed += 1
+        written += n
+        if progress is not None:
+            progress(positions.epoch_to_datetime(start_ts), positions.epoch_to_datetime(end_ts), n,
+                     len(windows) - len(pending) + computed, len(windows))
+
+    if workers <= 1:
+        for start_ts, end_ts in pending:
+            finished(*compute_window(start_ts, end_ts, margin_seconds))
+    else:
+        #
+        # at most two windows per worker in flight, so finished edges never pile up in the parent
+        #
+        # spawned rather than forked, so no database connection or lock is shared with the parent;
+        # django.setup runs in each worker before this module can be imported there
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=django.setup) as pool:
+            queue = list(reversed(pending))
+            running = set()
+            while queue or running:
+                while queue and len(running) < 2 * workers:
+                    start_ts, end_ts = queue.pop()
+                    running.add(pool.submit(compute_window, start_ts, end_ts, margin_seconds))
+                completed, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in completed:
+                    finished(*future.result())
+
+    #
+    # the graph now covers the recomputed range
+    #
+    state = contact_graph.get_state()
+    if state is None:
+        models.ContactGraphState.objects.create(covered_from=windows[0][0], processed_until=todt)
+    elif windows[0][0] < state.covered_from or todt > state.processed_until:
+        state.covered_from = min(state.covered_from, windows[0][0])
+        state.processed_until = max(state.processed_until, todt)
+        state.save()
+    logger.info("recompute %s: %d windows computed, %d skipped, %d edges", job, computed, len(windows) - len(pending), written)
+    return job, computed, len(windows) - len(pending), written
@@ -0,0 +1,126 @@
+#######################################################################
+# response_cache.py
+# Versioned response cache with ETags for the people endpoints
+#
+# Every write that can change a people listing bumps one version number
+# held in the 'versions' cache alias. Responses are cached under (version, full
+# path), and carry an ETag derived from the same pair, so:
+#   - a poll with a matching If-None-Match gets a 304 straight away,
+#   - an unchanged listing is served from the cache,
+#   - after a write every old entry simply stops being looked up.
+# The version has to be shared by every process that serves or writes
+# people (workers, management commands, the admin), so the alias must
+# point at a shared backend; a per-process cache such as LocMemCache would
+# keep answering 304 with stale data. It is read on every request and
+# bumped by concurrent writers, so the backend should also answer without
+# a database round trip and increment atomically: memcached, see CACHES
+# in settings.py. Response bodies go to the default cache. Saves and deletes of TrackablePerson bump
+# the version through signals; bulk paths that skip signals (bulk_update,
+# bulk_create) bump it themselves.
+#######################################################################
+import functools
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.db.models.signals import post_delete, post_save
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+
+PEOPLE_VERSION_KEY = 'inftrack:people:version'
+VERSIONS_CACHE = 'versions'
+
+def get_version(key):
+    #
+    # a shared version number in the versions cache; the people version below, and the
+    # assignment version that keeps the tag assignment index of every process current
+    #
+    versions = caches[VERSIONS_CACHE]
+    version = versions.get(key)
+    if version is None:
+        #
+        # start from the clock so a version lost to eviction or a restart is never handed out again
+        #
+        versions.add(key, int(time.time() * 1000), timeout=None)
+        version = versions.get(key)
+    return version
+
+def bump_version(key):
+    versions = caches[VERSIONS_CACHE]
+    try:
+        versions.incr(key)
+    except ValueError:
+        versions.add(key, int(time.time() * 1000), timeout=None)
+
+def get_people_version():
+    return get_version(PEOPLE_VERSION_KEY)
+
+def bump_people_version():
+    bump_version(PEOPLE_VERSION_KEY)
+
+def _person_changed(sender, **kwargs):
+    bump_people_version()
+
+def connect_signals():
+    # called from InftrackappConfig.ready()
+    import inftrackapp.models as models
+    post_save.connect(_person_changed, sender=models.TrackablePerson, dispatch_uid='response_cache.person_saved')
+    post_delete.connect(_person_changed, sender=models.TrackablePerson, dispatch_uid='response_cache.person_deleted')
+
+def _etag(version, path):
+    return '"%s-%s"' % (version, hashlib.md5(path.encode('utf-8')).hexdigest()[:16])
+
+def _not_modified(request, etag):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+    return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+
+def _finish(response, etag):
+    response['ETag'] = etag
+    # clients may keep the response but must revalidate it, which is cheap
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+def _store_when_complete(chunks, key):
+    #
+    # pass a streamed body through and cache it once it has been sent in full,
+    # unless it turns out to be too big to be worth keeping
+    #
+    parts = []
+    size = 0
+    for chunk in chunks:
+        if parts is not None:
+            size += len(chunk)
+            if size <= settings.RESPONSE_CACHE_MAX_BYTES:
+                parts.append(chunk)
+            else:
+                parts = None
+        yield chunk
+    if parts is not None:
+        cache.set(key, b''.join(parts), settings.RESPONSE_CACHE_TIMEOUT)
+
+def cached_people_response(view):
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+        version = get_people_version()
+        path = request.get_full_path()
+        etag = _etag(version, path)
+        if _not_modified(request, etag):
+            return _finish(HttpResponseNotModified(), etag)
+
+        key = 'inftrack:people:%s:%s' % (version, hashlib.md5(path.encode('utf-8')).hexdigest())
+        body = cache.get(key)
+        if body is not None:
+            return _finish(HttpResponse(body, content_type='application/json'), etag)
+
+        response = view(request, *args, **kwargs)
+        if response.status_code != 200:
+            return response
+        if response.streaming:
+            response.streaming_content = _store_when_complete(response.streaming_content, key)
+        elif len(response.content) <= settings.RESPONSE_CACHE_MAX_BYTES:
+            cache.set(key, response.content, settings.RESPONSE_CACHE_TIMEOUT)
+        return _finish(response, etag)
+    return wrapper
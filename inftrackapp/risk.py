@@ -0,0 +1,179 @@
+#######################################################################
+# risk.py
+# Batch risk scoring
+#
+# Every person's risk is a dose summed over their contact graph edges
+# in the lookback window:
+#
+#   dose = seconds in contact * exp(-distance / RISK_DISTANCE_SCALE_METERS)
+#          * RISK_STATUS_WEIGHTS[status of the other person at the time]
+#   score = 1 - exp(-dose / RISK_DOSE_SCALE_SECONDS)
+#
+# A person counts as infected from TRACE_INFECTIOUS_DAYS_BEFORE days
+# before they were marked infected, the same window tracing uses; every
+# other status, a recovery included, counts from when it was recorded.
+#
+# Scores for everyone are computed in one pass of numpy over the edges
+# and written to RiskScore, so the endpoints only read and sort. The
+# refresh_risk_scores command recomputes them on a schedule (deploy.sh
+# runs it with --interval); after a status change the contacts of the
+# people concerned are refreshed on a background thread, once the change
+# has been committed, so the request that made it does not wait.
+#######################################################################
+import concurrent.futures
+import logging
+import threading
+
+import numpy as np
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+import inftrackapp.contact_graph as contact_graph
+import inftrackapp.contacts as contacts
+import inftrackapp.models as models
+import inftrackapp.status_history as status_history
+
+logger = logging.getLogger(__name__)
+
+def status_weights():
+    # weight per index into models.STATUS_CHECK
+    return np.array([settings.RISK_STATUS_WEIGHTS.get(status, 0.0) for status in models.STATUS_CHECK])
+
+def status_at(person_ids, ts):
+    # index into models.STATUS_CHECK of each person's status at ts (epoch seconds), see status_history.py
+    return status_history.codes_at(person_ids, ts)
+
+def compute_doses(a, b, duration, distance, ts):
+    #
+    # directed doses for edges between a and b: every edge gives a dose to both ends
+    # returns target, source, dose arrays
+    #
+    target = np.concatenate([a, b])
+    source = np.concatenate([b, a])
+    duration = np.concatenate([duration, duration])
+    distance = np.concatenate([distance, distance])
+    lead = settings.TRACE_INFECTIOUS_DAYS_BEFORE * 86400.0
+    ts = np.concatenate([ts, ts])
+    #
+    # infectious from lead before being marked infected; any other status only from when it was set
+    #
+    infected = models.STATUS_CHECK.index(models.STATUS_INFECTED)
+    code = np.where(status_at(source, ts + lead) == infected, infected, status_at(source, ts))
+    weight = status_weights()[code]
+    dose = duration * np.exp(-distance / settings.RISK_DISTANCE_SCALE_METERS) * weight
+    return target, source, dose
+
+def refresh_scores(person_ids=None, now=None):
+    #
+    # recompute and store the scores of person_ids (everyone when None) over the lookback window
+    # returns the number of scores written
+    #
+    if now is None:
+        now = timezone.now()
+    fromdt, todt = contacts.contact_window(todt=now)
+    edges = models.ContactEdge.objects.filter(bucket_start__gte=contact_graph._floor(fromdt, settings.CONTACT_GRAPH_BUCKET_SECONDS),
+                                              bucket_start__lt=todt)
+    if person_ids is not None:
+        person_ids = list(set(person_ids))
+        edges = edges.filter(Q(person_a_id__in=person_ids) | Q(person_b_id__in=person_ids))
+    rows = list(edges.values_list('person_a_id', 'person_b_id', 'duration_seconds', 'min_distance', 'first_contact').iterator())
+
+    if rows:
+        a, b, duration, distance, first = zip(*rows)
+        target, source, dose = compute_doses(np.asarray(a, dtype=np.int64), np.asarray(b, dtype=np.int64),
+                                             np.asarray(duration, dtype=np.float64), np.asarray(distance, dtype=np.float64),
+                                             np.asarray([dt.timestamp() for dt in first]))
+        if person_ids is not None:
+            keep = np.isin(target, person_ids)
+            target, source, dose = target[keep], source[keep], dose[keep]
+    else:
+        target = source = np.zeros(0, dtype=np.int64)
+        dose = np.zeros(0)
+
+    #
+    # per target: total dose, number of sources that gave any, and the source that gave most
+    #
+    pairs, pair_inverse = np.unique(np.stack([target, source], axis=1), axis=0, return_inverse=True)
+    pair_dose = np.bincount(pair_inverse.reshape(-1), weights=dose, minlength=len(pairs))
+    targets, inverse = np.unique(pairs[:, 0], return_inverse=True)
+    inverse = inverse.reshape(-1)
+    total = np.bincount(inverse, weights=pair_dose, minlength=len(targets))
+    n_sources = np.bincount(inverse, weights=pair_dose > 0, minlength=len(targets)).astype(np.int64)
+    order = np.lexsort((-pair_dose, inverse))
+    firsts = order[np.r_[True, inverse[order][1:] != inverse[order][:-1]]] if len(order) else order
+    firsts = firsts[pair_dose[firsts] > 0]
+    top_source = np.full(len(targets), -1, dtype=np.int64)
+    top_source[inverse[firsts]] = pairs[firsts, 1]
+    score = 1.0 - np.exp(-total / settings.RISK_DOSE_SCALE_SECONDS)
+
+    scores = dict((int(pid), models.RiskScore(person_id=int(pid), score=float(s), dose=float(d), sources=int(n),
+                                              top_source_id=int(top) if top >= 0 else None, computed_at=now))
+                  for pid, s, d, n, top in zip(targets, score, total, n_sources, top_source))
+    if person_ids is not None:
+        for pid in person_ids:
+            if pid not in scores:
+                scores[pid] = models.RiskScore(person_id=pid, computed_at=now)
+    with transaction.atomic():
+        stale = models.RiskScore.objects.all()
+        if person_ids is not None:
+            stale = stale.filter(person_id__in=person_ids)
+        stale.delete()
+        models.RiskScore.objects.bulk_create(scores.values(), batch_size=1000)
+    return len(scores)
+
+def refresh_after_status_change(person_ids, now=None):
+    #
+    # a status change moves the scores of everyone who was in contact with the people concerned
+    #
+    if not settings.RISK_REFRESH_ON_STATUS_CHANGE or not person_ids:
+        return 0
+    if now is None:
+        now = timezone.now()
+    fromdt, todt = contacts.contact_window(todt=now)
+    edges = models.ContactEdge.objects.filter(Q(person_a_id__in=person_ids) | Q(person_b_id__in=person_ids),
+                                              bucket_start__gte=contact_graph._floor(fromdt, settings.CONTACT_GRAPH_BUCKET_SECONDS),
+                                              bucket_start__lt=todt).values_list('person_a_id', 'person_b_id')
+    affected = set()
+    for pa, pb in edges.iterator():
+        affected.add(pa)
+        affected.add(pb)
+    affected.difference_update(person_ids)
+    if not affected:
+        return 0
+    return refresh_scores(affected, now=now)
+
+###########################
+# background refresh
+###########################
+_executor_lock = threading.Lock()
+_executor = None
+
+def _get_executor():
+    # one worker thread per process, so refreshes run one at a time
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='risk-refresh')
+    return _executor
+
+def _refresh_in_background(person_ids):
+    try:
+        refresh_after_status_change(person_ids)
+    except Exception:
+        logger.exception("risk refresh after status change of %d people failed", len(person_ids))
+    finally:
+        # the worker thread has its own connection, close it like a request would
+        close_old_connections()
+
+def schedule_refresh_after_status_change(person_ids):
+    #
+    # refresh_after_status_change on the background thread once the current transaction
+    # commits (straight away outside one); returns without waiting for it
+    #
+    if not settings.RISK_REFRESH_ON_STATUS_CHANGE or not person_ids:
+        return
+    person_ids = list(person_ids)
+    transaction.on_commit(lambda: _get_executor().submit(_refresh_in_background, person_ids))
@@ -0,0 +1,189 @@
+#######################################################################
+# rollups.py
+# Dwell-segment compaction and raw position retention
+#
+# A stationary tag reports the same spot over and over. Once positions
+# are older than DWELL_COMPACT_AFTER_HOURS, compact() collapses each
+# person's consecutive positions in the same DWELL_CELL_METERS grid cell
+# (with no gap longer than DWELL_MAX_GAP_SECONDS) into one DwellSegment:
+# centroid, radius, start and end. It works an hour at a time and moves
+# the watermark in RollupState after each hour, so an interrupted run
+# just carries on.
+#
+# From then on readers (positions.load_positions, positions.iter_trace)
+# take everything before the watermark from segments, and ingestion
+# rejects readings older than it. compact_hour() always builds from the
+# raw positions, in the database and the segment store, which stay until
+# they are POSITION_RAW_RETENTION_DAYS old; purge() then deletes them.
+# A reading that still lands below the watermark (written while its hour
+# was being compacted) is picked up by the next compact(): hours holding
+# positions with an id above the highest one seen by the previous run
+# are compacted again.
+#######################################################################
+import datetime
+import logging
+
+import numpy as np
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+import inftrackapp.assignments as assignments
+import inftrackapp.models as models
+import inftrackapp.positions as positions
+import inftrackapp.segments as segments
+
+logger = logging.getLogger(__name__)
+
+def build_segments(frame, cell_meters, max_gap_seconds):
+    #
+    # dwell segments of a PositionFrame, as parallel arrays:
+    # person, centroid x, centroid y, radius, start, end (epoch seconds), samples
+    #
+    if not len(frame):
+        empty = np.zeros(0)
+        return np.zeros(0, dtype=np.int64), empty, empty, empty, empty, empty, np.zeros(0, dtype=np.int64)
+    order = np.lexsort((frame.t, frame.person))
+    person = frame.person[order]
+    x = frame.x[order]
+    y = frame.y[order]
+    t = frame.t[order]
+    cx = np.floor(x / cell_meters).astype(np.int64)
+    cy = np.floor(y / cell_meters).astype(np.int64)
+
+    breaks = np.r_[True, (person[1:] != person[:-1]) | (cx[1:] != cx[:-1]) | (cy[1:] != cy[:-1]) |
+                   (t[1:] - t[:-1] > max_gap_seconds)]
+    starts = np.flatnonzero(breaks)
+    run = np.cumsum(breaks) - 1
+    samples = np.bincount(run)
+    mean_x = np.bincount(run, weights=x) / samples
+    mean_y = np.bincount(run, weights=y) / samples
+    radius = np.zeros(len(starts))
+    np.maximum.at(radius, run, np.hypot(x - mean_x[run], y - mean_y[run]))
+    ends = np.r_[starts[1:], len(t)] - 1
+    return person[starts], mean_x, mean_y, radius, t[starts], t[ends], samples
+
+###########################
+# state
+###########################
+def get_state():
+    return models.RollupState.objects.order_by('id').first()
+
+def compact_until_default():
+    return segments.floor_hour(timezone.now() - datetime.timedelta(hours=settings.DWELL_COMPACT_AFTER_HOURS))
+
+def purge_until_default():
+    return timezone.now() - datetime.timedelta(days=settings.POSITION_RAW_RETENTION_DAYS)
+
+def _first_position_time():
+    first = models.TagPosition.objects.order_by('timestamp').values_list('timestamp', flat=True).first()
+    store = segments.get_segment_store()
+    if store is not None and store.sealed_until() is not None:
+        # sealed history is older than anything left in the database
+        first = store.first_hour() or first
+    return first
+
+###########################
+# compaction
+###########################
+def compact_hour(hour):
+    #
+    # replace any segments already written for hour with fresh ones built from the raw positions
+    # returns (segments written, positions read)
+    #
+    end = hour + segments.HOUR
+    frame = positions.load_raw_positions(hour, end)
+    person, x, y, radius, start, stop, samples = build_segments(frame, settings.DWELL_CELL_METERS, settings.DWELL_MAX_GAP_SECONDS)
+    tags = assignments.get_assignment_index().tags_at(person, start)
+    to_dt = positions.epoch_to_datetime
+    rows = [models.DwellSegment(tag_id=tag if tag >= 0 else None, person_id=p, x=sx, y=sy, radius=r,
+                                start=to_dt(t0), end=to_dt(t1), samples=n)
+            for p, tag, sx, sy, r, t0, t1, n in zip(person.tolist(), tags.tolist(), x.tolist(), y.tolist(), radius.tolist(),
+                                                    start.tolist(), stop.tolist(), samples.tolist())]
+    with transaction.atomic():
+        models.DwellSegment.objects.filter(start__gte=hour, start__lt=end).delete()
+        models.DwellSegment.objects.bulk_create(rows, batch_size=settings.INGEST_BULK_CHUNK_SIZE)
+    return len(rows), len(frame)
+
+def late_hours(state):
+    #
+    # compacted hours that received positions after the previous run, skipping purged hours
+    # whose raw positions are gone
+    #
+    if state.compacted_position_id is None:
+        return []
+    qs = models.TagPosition.objects.filter(timestamp__lt=state.compacted_until, id__gt=state.compacted_position_id)
+    if state.purged_until is not None:
+        qs = qs.filter(timestamp__gte=state.purged_until)
+    return list(qs.datetimes('timestamp', 'hour', tzinfo=datetime.timezone.utc))
+
+def compact(until=None):
+    #
+    # compact every whole hour before until; returns (hours, positions read, segments written)
+    #
+    if until is None:
+        until = compact_until_default()
+    # never the hour still being written to
+    until = min(segments.floor_hour(until), segments.floor_hour(timezone.now()))
+    # taken before reading anything, rows written from here on are looked at by the next run
+    last_id = models.TagPosition.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+    state = get_state()
+    if state is None:
+        first = _first_position_time()
+        if first is None:
+            return 0, 0, 0
+        state = models.RollupState.objects.create(compacted_until=segments.floor_hour(first))
+    hours = 0
+    read = 0
+    written = 0
+    for hour in late_hours(state):
+        n_segments, n_positions = compact_hour(hour)
+        written += n_segments
+        read += n_positions
+        hours += 1
+    hour = state.compacted_until
+    while hour < until:
+        n_segments, n_positions = compact_hour(hour)
+        written += n_segments
+        read += n_positions
+        hour += segments.HOUR
+        # readers switch to the segments for this hour from here on
+        models.RollupState.objects.filter(pk=state.pk).update(compacted_until=hour, modified=timezone.now())
+        hours += 1
+    models.RollupState.objects.filter(pk=state.pk).update(compacted_position_id=last_id, modified=timezone.now())
+    if read:
+        logger.info("compacted %d positions into %d dwell segments", read, written)
+    return hours, read, written
+
+###########################
+# retention
+###########################
+def purge(until=None):
+    #
+    # delete raw positions before until that have been compacted, an hour at a time
+    # returns the number of database rows deleted
+    #
+    if until is None:
+        until = purge_until_default()
+    state = get_state()
+    if state is None:
+        return 0
+    until = min(segments.floor_hour(until), state.compacted_until)
+    hour = state.purged_until
+    if hour is None:
+        first = _first_position_time()
+        hour = segments.floor_hour(first) if first is not None else until
+    deleted = 0
+    if state.purged_until is not None:
+        # rows that arrived for hours already purged are past retention
+        deleted += models.TagPosition.objects.filter(timestamp__lt=state.purged_until).delete()[0]
+    while hour < until:
+        deleted += models.TagPosition.objects.filter(timestamp__gte=hour, timestamp__lt=hour + segments.HOUR).delete()[0]
+        hour += segments.HOUR
+        models.RollupState.objects.filter(pk=state.pk).update(purged_until=hour, modified=timezone.now())
+    store = segments.get_segment_store()
+    if store is not None:
+        store.drop_before(until)
+    return deleted
@@ -0,0 +1,273 @@
+#######################################################################
+# roster.py
+# Bulk import of people and tags
+#
+# Onboarding loads thousands of TrackablePerson and TrackingTag rows from
+# CSV (with a header row) or NDJSON (one object per line). Rows are read
+# from the stream as they arrive, validated one by one and upserted on
+# unique_id ROSTER_BATCH_SIZE at a time: one query finds which of the
+# batch already exist, then bulk_create and bulk_update write the rest in
+# one transaction. A bad row is reported with its index and skipped; it
+# never aborts the load.
+#
+# A person row has unique_id, firstname, lastname, phone, role and
+# optionally email and status (ok for new people when missing). Changing
+# an existing person's status records a StatusChangeEvent, as
+# dao.change_people_status does. A tag row only has unique_id.
+#######################################################################
+import csv
+import json
+import logging
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+
+import inftrackapp.models as models
+import inftrackapp.response_cache as response_cache
+import inftrackapp.risk as risk
+
+logger = logging.getLogger(__name__)
+
+PEOPLE = 'people'
+TAGS = 'tags'
+KINDS = (PEOPLE, TAGS)
+
+FORMAT_CSV = 'csv'
+FORMAT_NDJSON = 'ndjson'
+FORMATS = (FORMAT_CSV, FORMAT_NDJSON)
+
+PERSON_FIELDS = ('firstname', 'lastname', 'phone', 'email', 'role', 'status')
+
+class RosterError(ValueError):
+    # the file as a whole could not be read
+    pass
+
+class ImportResult(object):
+
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.errors = []
+        self.error_count = 0
+
+    def reject(self, index, message):
+        self.error_count += 1
+        if len(self.errors) < settings.INGEST_MAX_ERRORS:
+            self.errors.append({"index": index, "msg": message})
+
+    def as_dict(self):
+        return {
+            "rows": self.rows,
+            "created": self.created,
+            "updated": self.updated,
+            "unchanged": self.unchanged,
+            "rejected": self.error_count,
+            "errors": self.errors,
+            "errors_truncated": self.error_count > len(self.errors)
+        }
+
+###########################
+# reading
+###########################
+def read_rows(lines, fmt):
+    #
+    # (index, row dict, None) per data row of an iterable of text or UTF-8 lines, index counting
+    # data rows from 0; a row that cannot be parsed comes back as (index, None, message)
+    #
+    if fmt == FORMAT_CSV:
+        #
+        # lines that are not valid UTF-8 reach the reader as blank lines; their line
+        # numbers tell the loop below to report them instead of skipping them
+        #
+        undecodable = set()
+
+        def decoded(lines):
+            for number, line in enumerate(lines, 1):
+                if isinstance(line, bytes):
+                    try:
+                        line = line.decode('utf-8')
+                    except UnicodeDecodeError:
+                        undecodable.add(number)
+                        line = '\n'
+                yield line
+
+        reader = csv.reader(decoded(lines))
+        try:
+            header = [name.strip() for name in next(reader)]
+        except StopIteration:
+            return
+        except csv.Error as ex:
+            raise RosterError("malformed CSV header: %s" % ex)
+        if 'unique_id' not in header:
+            raise RosterError("CSV header must name a unique_id column")
+        index = -1
+        while True:
+            try:
+                values = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as ex:
+                index += 1
+                yield index, None, "malformed CSV row: %s" % ex
+                continue
+            if reader.line_num in undecodable:
+                index += 1
+                yield index, None, "invalid UTF-8"
+                continue
+            if not values:
+                continue
+            index += 1
+            if len(values) != len(header):
+                yield index, None, "expected %d columns, got %d" % (len(header), len(values))
+                continue
+            yield index, dict(zip(header, values)), None
+    else:
+        index = -1
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            index += 1
+            try:
+                row = json.loads(line.decode('utf-8') if isinstance(line, bytes) else line)
+            except UnicodeDecodeError:
+                yield index, None, "invalid UTF-8"
+                continue
+            except ValueError as ex:
+                yield index, None, "malformed JSON: %s" % ex
+                continue
+            if not isinstance(row, dict):
+                yield index, None, "each line must be a JSON object"
+                continue
+            yield index, row, None
+
+def _text(row, name, max_length, required=True):
+    value = row.get(name)
+    value = '' if value is None else str(value).strip()
+    if not value:
+        if required:
+            raise ValueError("%s is required" % name)
+        return None
+    if len(value) > max_length:
+        raise ValueError("%s is longer than %d characters" % (name, max_length))
+    return value
+
+def clean_person(row):
+    # the person fields of a row, raises ValueError naming the first problem
+    person = {
+        "unique_id": _text(row, 'unique_id', 50),
+        "firstname": _text(row, 'firstname', 50),
+        "lastname": _text(row, 'lastname', 50),
+        "phone": _text(row, 'phone', 50),
+        "email": _text(row, 'email', 100, required=False),
+        "role": _text(row, 'role', 12),
+        "status": _text(row, 'status', 12, required=False),
+    }
+    if person["role"] not in models.ROLE_CHECK:
+        raise ValueError("role must be one of %s" % ', '.join(models.ROLE_CHECK))
+    if person["status"] is not None and person["status"] not in models.STATUS_CHECK:
+        raise ValueError("status must be one of %s" % ', '.join(models.STATUS_CHECK))
+    return person
+
+def clean_tag(row):
+    return {"unique_id": _text(row, 'unique_id', 50)}
+
+###########################
+# writing
+###########################
+def upsert_people(rows, result, now):
+    #
+    # rows: (index, cleaned person) of one batch, the last row wins for a repeated unique_id
+    # returns the ids of existing people whose status changed
+    #
+    latest = dict((person["unique_id"], person) for index, person in rows)
+    existing = models.TrackablePerson.objects.in_bulk(list(latest), field_name='unique_id')
+    created = []
+    updated = []
+    events = []
+    for unique_id, person in latest.items():
+        current = existing.get(unique_id)
+        if current is None:
+            if person["status"] is None:
+                person["status"] = models.STATUS_OK
+            created.append(models.TrackablePerson(**person))
+            continue
+        if person["status"] is None:
+            person["status"] = current.status
+        if all(getattr(current, field) == person[field] for field in PERSON_FIELDS):
+            result.unchanged += 1
+            continue
+        if person["status"] != current.status:
+            events.append(models.StatusChangeEvent(person=current, prior_status=current.status,
+                                                   new_status=person["status"], timestamp=now))
+        for field in PERSON_FIELDS:
+            setattr(current, field, person[field])
+        current.modified = now
+        updated.append(current)
+    with transaction.atomic():
+        models.TrackablePerson.objects.bulk_create(created, batch_size=settings.ROSTER_BATCH_SIZE)
+        models.TrackablePerson.objects.bulk_update(updated, list(PERSON_FIELDS) + ['modified'], batch_size=settings.ROSTER_BATCH_SIZE)
+        models.StatusChangeEvent.objects.bulk_create(events, batch_size=settings.ROSTER_BATCH_SIZE)
+    result.created += len(created)
+    result.updated += len(updated)
+    return [event.person.id for event in events]
+
+def upsert_tags(rows, result, now):
+    unique_ids = set(tag["unique_id"] for index, tag in rows)
+    existing = set(models.TrackingTag.objects.filter(unique_id__in=list(unique_ids)).values_list('unique_id', flat=True))
+    created = [models.TrackingTag(unique_id=unique_id) for unique_id in unique_ids - existing]
+    models.TrackingTag.objects.bulk_create(created, batch_size=settings.ROSTER_BATCH_SIZE)
+    result.created += len(created)
+    result.unchanged += len(existing)
+    return []
+
+def import_rows(kind, rows, batch_size=None):
+    #
+    # rows as produced by read_rows; returns an ImportResult
+    #
+    if batch_size is None:
+        batch_size = settings.ROSTER_BATCH_SIZE
+    clean = clean_person if kind == PEOPLE else clean_tag
+    upsert = upsert_people if kind == PEOPLE else upsert_tags
+    result = ImportResult()
+    status_changed = []
+    now = timezone.now()
+
+    def flush(batch):
+        try:
+            status_changed.extend(upsert(batch, result, now))
+        except DatabaseError as ex:
+            # a row the checks above let through (or a concurrent insert) sank the batch; report every row in it
+            logger.warning("roster batch failed: %s", ex)
+            for index, row in batch:
+                result.reject(index, "batch not saved: %s" % ex)
+
+    batch = []
+    for index, row, error in rows:
+        result.rows += 1
+        if error is None:
+            try:
+                batch.append((index, clean(row)))
+            except ValueError as ex:
+                error = str(ex)
+        if error is not None:
+            result.reject(index, error)
+            continue
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+    if kind == PEOPLE and (result.created or result.updated):
+        response_cache.bump_people_version()
+    if status_changed:
+        risk.schedule_refresh_after_status_change(status_changed)
+    return result
+
+def import_stream(kind, lines, fmt):
+    # raises RosterError when the file as a whole cannot be read
+    return import_rows(kind, read_rows(lines, fmt))
@@ -0,0 +1,307 @@
+#######################################################################
+# segments.py
+# Columnar storage engine for sealed TagPosition history
+#
+# Completed hours of positions are moved out of the ethermed_tag_position
+# table into one file per hour per tag:
+#
+#     <POSITION_SEGMENT_DIR>/<YYYYMMDD>/<HH>/<tag id>.npy
+#
+# Each file is a numpy structured array sorted by time with columns
+# timestamp (int64 epoch microseconds), x, y (float32) and person
+# (int32 person id), and is read back memory-mapped. A watermark file
+# records the first hour that has not been sealed: everything before it
+# lives in segments, everything from it onwards is still in the database.
+# Ingestion rejects readings older than the watermark; a row that still
+# lands below it (written while its hour was being sealed) is merged into
+# the hour's segments by the next seal(). While an hour is being sealed
+# its directory also holds the merged files waiting to replace the live
+# ones (<tag id>.npy.pending) and a journal (SEALING) of the database rows
+# they take in.
+#
+# The engine is off unless POSITION_SEGMENT_DIR is set.
+#######################################################################
+import datetime
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from django.conf import settings
+from django.utils import timezone
+
+import inftrackapp.models as models
+
+SEGMENT_DTYPE = np.dtype([('timestamp', '<i8'), ('x', '<f4'), ('y', '<f4'), ('person', '<i4')])
+WATERMARK_FILE = 'SEALED'
+JOURNAL_FILE = 'SEALING'
+PENDING_SUFFIX = '.pending'
+HOUR = datetime.timedelta(hours=1)
+MICROS = 1000000
+
+def floor_hour(dt):
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+def _micros(dt):
+    return int(round(dt.timestamp() * MICROS))
+
+class SegmentStore(object):
+
+    def __init__(self, root):
+        self.root = root
+
+    ###########################
+    # layout
+    ###########################
+    def hour_dir(self, hour):
+        hour = hour.astimezone(datetime.timezone.utc)
+        return os.path.join(self.root, hour.strftime('%Y%m%d'), hour.strftime('%H'))
+
+    def segment_path(self, hour, tag_id):
+        return os.path.join(self.hour_dir(hour), '%d.npy' % tag_id)
+
+    def sealed_until(self):
+        #
+        # first hour still held in the database, or None when nothing has been sealed yet
+        #
+        try:
+            with open(os.path.join(self.root, WATERMARK_FILE)) as f:
+                return datetime.datetime.fromtimestamp(int(f.read().strip()), tz=datetime.timezone.utc)
+        except (IOError, ValueError):
+            return None
+
+    def _set_sealed_until(self, hour):
+        path = os.path.join(self.root, WATERMARK_FILE)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(int(hour.timestamp())))
+        os.replace(tmp, path)
+
+    ###########################
+    # sealing
+    ###########################
+    def seal_hour(self, hour):
+        #
+        # merge one hour of positions into its segments and drop the rows from the database
+        # only the rows that were read are deleted, so rows written meanwhile wait for the next
+        # run. Every row is kept, repeated readings included. The merged files are written
+        # beside the live ones, the ids of the rows they take in are journaled, then the files
+        # are swapped in and the rows deleted: a run interrupted before the journal is written
+        # leaves nothing behind and one interrupted after it is finished by the next run, so
+        # no row is ever added to a segment twice
+        #
+        self.finish_pending(hour)
+        self._discard_pending(hour)
+        rows = models.TagPosition.objects.filter(timestamp__gte=hour, timestamp__lt=hour + HOUR) \
+            .order_by('tag_id', 'timestamp') \
+            .values_list('id', 'tag_id', 'person_id', 'x', 'y', 'timestamp')
+        rows = list(rows.iterator())
+        if not rows:
+            return 0
+        row_id, tag, person, x, y, ts = zip(*rows)
+        tag = np.asarray(tag, dtype=np.int64)
+        data = np.empty(len(rows), dtype=SEGMENT_DTYPE)
+        data['timestamp'] = [_micros(dt) for dt in ts]
+        data['x'] = x
+        data['y'] = y
+        data['person'] = person
+
+        os.makedirs(self.hour_dir(hour), exist_ok=True)
+        starts = np.flatnonzero(np.r_[True, tag[1:] != tag[:-1]])
+        ends = np.r_[starts[1:], len(tag)]
+        for s, e in zip(starts, ends):
+            path = self.segment_path(hour, int(tag[s]))
+            part = data[s:e]
+            if os.path.exists(path):
+                part = np.concatenate([np.load(path), part])
+            part = part[np.argsort(part['timestamp'], kind='stable')]
+            with open(path + PENDING_SUFFIX, 'wb') as f:
+                np.save(f, part)
+
+        journal = os.path.join(self.hour_dir(hour), JOURNAL_FILE)
+        with open(journal + '.tmp', 'wb') as f:
+            np.save(f, np.asarray(row_id, dtype=np.int64))
+        os.replace(journal + '.tmp', journal)
+        self.finish_pending(hour)
+        return len(rows)
+
+    def finish_pending(self, hour):
+        #
+        # complete a seal_hour of hour that has written its journal: swap in the merged files
+        # still pending and delete the journaled rows. Readers may call this too, so every
+        # step tolerates another process having done it first
+        #
+        directory = self.hour_dir(hour)
+        journal = os.path.join(directory, JOURNAL_FILE)
+        try:
+            row_id = np.load(journal).tolist()
+        except (IOError, OSError):
+            return
+        for name in os.listdir(directory):
+            if name.endswith(PENDING_SUFFIX):
+                try:
+                    os.replace(os.path.join(directory, name), os.path.join(directory, name[:-len(PENDING_SUFFIX)]))
+                except FileNotFoundError:
+                    pass
+        for i in range(0, len(row_id), settings.INGEST_BULK_CHUNK_SIZE):
+            models.TagPosition.objects.filter(id__in=row_id[i:i + settings.INGEST_BULK_CHUNK_SIZE]).delete()
+        try:
+            os.remove(journal)
+        except FileNotFoundError:
+            pass
+
+    def _discard_pending(self, hour):
+        # merged files of a seal_hour interrupted before its journal was written
+        directory = self.hour_dir(hour)
+        try:
+            names = os.listdir(directory)
+        except (IOError, OSError):
+            return
+        for name in names:
+            if name.endswith(PENDING_SUFFIX):
+                os.remove(os.path.join(directory, name))
+
+    def late_hours(self, since=None):
+        # hours below the watermark (and from since, when given) that still have rows in the database
+        sealed = self.sealed_until()
+        if sealed is None:
+            return []
+        qs = models.TagPosition.objects.filter(timestamp__lt=sealed)
+        if since is not None:
+            qs = qs.filter(timestamp__gte=since)
+        return list(qs.datetimes('timestamp', 'hour', tzinfo=datetime.timezone.utc))
+
+    def seal(self, until):
+        #
+        # seal every complete hour before until, returns (hours sealed, rows moved)
+        #
+        until = floor_hour(until)
+        hours = 0
+        moved = 0
+        #
+        # rows below the compaction watermark are left to compaction, which
+        # finds them by id and reads the database and the segments alike
+        #
+        compacted = models.RollupState.objects.order_by('id').values_list('compacted_until', flat=True).first()
+        for hour in self.late_hours(since=compacted):
+            moved += self.seal_hour(hour)
+            hours += 1
+        start = self.sealed_until()
+        if start is None:
+            first = models.TagPosition.objects.order_by('timestamp').values_list('timestamp', flat=True).first()
+            if first is None:
+                return hours, moved
+            start = floor_hour(first)
+        hour = start
+        while hour < until:
+            moved += self.seal_hour(hour)
+            hour += HOUR
+            self._set_sealed_until(hour)
+            hours += 1
+        return hours, moved
+
+    def hours(self):
+        # every hour that has a directory, oldest first
+        result = []
+        try:
+            days = sorted(name for name in os.listdir(self.root) if len(name) == 8 and name.isdigit())
+        except (IOError, OSError):
+            return result
+        for day in days:
+            for hh in sorted(os.listdir(os.path.join(self.root, day))):
+                if len(hh) == 2 and hh.isdigit():
+                    result.append(datetime.datetime.strptime(day + hh, '%Y%m%d%H').replace(tzinfo=datetime.timezone.utc))
+        return result
+
+    def first_hour(self):
+        hours = self.hours()
+        return hours[0] if hours else None
+
+    def drop_before(self, until):
+        #
+        # delete the segment files of every hour before until (retention), returns the hours dropped
+        #
+        dropped = 0
+        for hour in self.hours():
+            if hour + HOUR > until:
+                break
+            shutil.rmtree(self.hour_dir(hour), ignore_errors=True)
+            day_dir = os.path.dirname(self.hour_dir(hour))
+            if not os.listdir(day_dir):
+                os.rmdir(day_dir)
+            dropped += 1
+        return dropped
+
+    ###########################
+    # reading
+    ###########################
+    def _segments(self, hour, tag_ids=None):
+        # (tag id, memory-mapped segment) for every segment of hour
+        directory = self.hour_dir(hour)
+        if tag_ids is None:
+            try:
+                tag_ids = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.npy'))
+            except (IOError, OSError):
+                return
+        for tag_id in tag_ids:
+            path = self.segment_path(hour, tag_id)
+            if os.path.exists(path):
+                yield tag_id, np.load(path, mmap_mode='r')
+
+    def load(self, fromdt, todt, person_ids=None, exclude_person_ids=None, tag_ids=None, holders=None):
+        #
+        # positions with fromdt <= timestamp < todt as one SEGMENT_DTYPE array
+        # each segment is memory-mapped and sliced by time without copying; only
+        # the rows that survive the filters are materialised
+        # holders(tag_id, epoch seconds) replaces the stored person ids, rows it maps
+        # to -1 are dropped; the person filters apply to the replaced ids
+        #
+        lo = _micros(fromdt)
+        hi = _micros(todt)
+        person_filter = np.asarray(list(person_ids), dtype=np.int64) if person_ids is not None else None
+        exclude_filter = np.asarray(list(exclude_person_ids), dtype=np.int64) if exclude_person_ids else None
+        parts = []
+        hour = floor_hour(fromdt)
+        while hour < todt:
+            for tag_id, segment in self._segments(hour, tag_ids):
+                ts = segment['timestamp']
+                s = np.searchsorted(ts, lo, side='left')
+                e = np.searchsorted(ts, hi, side='left')
+                if s >= e:
+                    continue
+                part = segment[s:e]
+                if holders is not None:
+                    part = np.array(part)
+                    part['person'] = holders(tag_id, part['timestamp'] / float(MICROS))
+                    part = part[part['person'] >= 0]
+                if person_filter is not None:
+                    part = part[np.isin(part['person'], person_filter)]
+                if exclude_filter is not None:
+                    part = part[~np.isin(part['person'], exclude_filter)]
+                if len(part):
+                    parts.append(part)
+            hour += HOUR
+        if not parts:
+            return np.empty(0, dtype=SEGMENT_DTYPE)
+        return np.concatenate(parts)
+
+###########################
+# configured store
+###########################
+_lock = threading.Lock()
+_store = None
+
+def get_segment_store():
+    # None when the segment engine is not enabled
+    global _store
+    root = settings.POSITION_SEGMENT_DIR
+    if not root:
+        return None
+    with _lock:
+        if _store is None or _store.root != root:
+            _store = SegmentStore(root)
+        return _store
+
+def seal_until_default():
+    return floor_hour(timezone.now()) - datetime.timedelta(hours=settings.POSITION_SEGMENT_SEAL_DELAY_HOURS)
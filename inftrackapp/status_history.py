@@ -0,0 +1,152 @@
+#######################################################################
+# status_history.py
+# In-memory index of status changes
+#
+# TrackablePerson.status only holds the latest status; risk scoring and
+# analysis need it as of the moment of an exposure. The index keeps each
+# person's StatusChangeEvents as a timeline sorted by time and answers
+# "status of P at t" by binary search: the new_status of the last change
+# at or before t, else the prior_status of the first change after it.
+# People who never changed status have their current status throughout.
+#
+# Like the assignment index it is built once per process and refresh()
+# picks up events written since (by any worker) with one query for ids
+# it has not seen. Events with a status that is not in STATUS_CHECK
+# (older rows left new_status blank until migration 0011 filled it in)
+# are skipped with a warning rather than failing every lookup.
+#######################################################################
+import bisect
+import logging
+import threading
+
+import numpy as np
+
+import inftrackapp.models as models
+
+logger = logging.getLogger(__name__)
+
+# statuses are held as indexes into models.STATUS_CHECK
+CODES = dict((status, i) for i, status in enumerate(models.STATUS_CHECK))
+
+class StatusTimeline(object):
+    #
+    # new_codes[i] holds from times[i] until times[i + 1]; before times[0] it is first_prior
+    #
+    __slots__ = ('times', 'new_codes', 'prior_codes')
+
+    def __init__(self):
+        self.times = []
+        self.new_codes = []
+        self.prior_codes = []
+
+    def add(self, t, prior_code, new_code):
+        i = bisect.bisect_right(self.times, t)
+        self.times.insert(i, t)
+        self.new_codes.insert(i, new_code)
+        self.prior_codes.insert(i, prior_code)
+
+    def at(self, t):
+        i = bisect.bisect_right(self.times, t) - 1
+        if i < 0:
+            return self.prior_codes[0]
+        return self.new_codes[i]
+
+    def at_many(self, ts):
+        # vectorised at() for a numpy array of times
+        idx = np.searchsorted(np.asarray(self.times), ts, side='right') - 1
+        new_codes = np.asarray(self.new_codes, dtype=np.int64)
+        return np.where(idx >= 0, new_codes[np.maximum(idx, 0)], self.prior_codes[0])
+
+class StatusIndex(object):
+
+    def __init__(self):
+        self.by_person = {}
+        self.last_event_id = 0
+        self.lock = threading.RLock()
+
+    def refresh(self):
+        with self.lock:
+            events = models.StatusChangeEvent.objects.filter(id__gt=self.last_event_id).order_by('id') \
+                .values_list('id', 'person_id', 'timestamp', 'prior_status', 'new_status')
+            for event_id, person_id, ts, prior_status, new_status in events.iterator():
+                self.last_event_id = event_id
+                if prior_status not in CODES or new_status not in CODES:
+                    logger.warning("skipping status change event %d with unknown status %r -> %r", event_id, prior_status, new_status)
+                    continue
+                self.by_person.setdefault(person_id, StatusTimeline()).add(ts.timestamp(), CODES[prior_status], CODES[new_status])
+
+    ###########################
+    # lookups, t in epoch seconds
+    ###########################
+    def code_at(self, person_id, t):
+        # index into models.STATUS_CHECK, None when the person never changed status
+        with self.lock:
+            timeline = self.by_person.get(person_id)
+            return timeline.at(t) if timeline is not None else None
+
+    def codes_at(self, person_ids, ts):
+        #
+        # code_at for every (person_ids[i], ts[i]), -1 for people who never changed status
+        # one binary search per query, grouped by person
+        #
+        person_ids = np.asarray(person_ids, dtype=np.int64)
+        ts = np.asarray(ts, dtype=np.float64)
+        result = np.full(len(person_ids), -1, dtype=np.int64)
+        if not len(person_ids):
+            return result
+        order = np.argsort(person_ids, kind='stable')
+        sorted_ids = person_ids[order]
+        starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+        with self.lock:
+            for s, e in zip(starts, ends):
+                timeline = self.by_person.get(int(sorted_ids[s]))
+                if timeline is None:
+                    continue
+                idx = order[s:e]
+                result[idx] = timeline.at_many(ts[idx])
+        return result
+
+###########################
+# process wide index
+###########################
+_lock = threading.Lock()
+_index = None
+
+def get_status_index(refresh=True):
+    #
+    # built on first use; refresh pulls in events written since
+    #
+    global _index
+    with _lock:
+        if _index is None:
+            _index = StatusIndex()
+            _index.refresh()
+            return _index
+    if refresh:
+        _index.refresh()
+    return _index
+
+def codes_at(person_ids, ts):
+    #
+    # index into models.STATUS_CHECK of the status of person_ids[i] at ts[i] (epoch seconds);
+    # people who never changed status are looked up in one query for their current status
+    #
+    person_ids = np.asarray(person_ids, dtype=np.int64)
+    result = get_status_index().codes_at(person_ids, ts)
+    unchanged = result < 0
+    if unchanged.any():
+        ids = np.unique(person_ids[unchanged])
+        current = dict((pid, CODES[status]) for pid, status in
+                       models.TrackablePerson.objects.filter(id__in=ids.tolist()).values_list('id', 'status').iterator())
+        result[unchanged] = [current.get(pid, 0) for pid in person_ids[unchanged].tolist()]
+    return result
+
+def statuses_at(person_ids, ts):
+    # the status of person_ids[i] at ts[i], as names
+    return [models.STATUS_CHECK[code] for code in codes_at(person_ids, ts).tolist()]
+
+def status_at(person, dt):
+    # the status person had at dt (aware)
+    code = get_status_index().code_at(person.id, dt.timestamp())
+    return person.status if code is None else models.STATUS_CHECK[code]
@@ -0,0 +1,201 @@
+#######################################################################
+# streaming.py
+# Websocket position ingestion for long-lived gateway connections
+#
+# Gateways connect to /v1/ws/positions and send readings as text frames
+# (one or more NDJSON lines) or binary frames (the packed format described
+# in ingest.py). Readings from every connection are buffered in memory
+# and written together by a single flusher, either when enough readings
+# have arrived or when the flush interval expires.
+#
+# Backpressure: while too many readings are waiting to be written, the
+# connections stop reading from their sockets, so slow database writes
+# push back on the gateways through TCP flow control instead of growing
+# the buffer without bound.
+#
+# Each connection receives {"accepted": n, "rejected": m, "errors": [...]}
+# once its buffered readings have gone through ingest: accepted readings
+# were written, rejected ones (unknown tag, tag not assigned) were dropped,
+# and errors itemises them by their index in the frame they came in.
+# Frames, or readings within a frame, that cannot be parsed are answered
+# straight away with {"rejected": n, "errors": [...]}.
+#######################################################################
+import asyncio
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.db import close_old_connections
+
+import inftrackapp.ingest as ingest
+
+logger = logging.getLogger(__name__)
+
+WS_PATH_POSITIONS = '/v1/ws/positions'
+
+# close code sent for websocket paths we don't serve
+WS_CLOSE_NOT_FOUND = 4404
+
+def _write(batch):
+    #
+    # runs in a worker thread; mirror the connection housekeeping Django does around requests
+    #
+    close_old_connections()
+    try:
+        return ingest.ingest(batch)
+    finally:
+        close_old_connections()
+
+###########################
+# shared buffer
+###########################
+class PositionBuffer(object):
+
+    def __init__(self, flush_readings, flush_seconds, max_buffered):
+        self.flush_readings = flush_readings
+        self.flush_seconds = flush_seconds
+        self.max_buffered = max_buffered
+        self.pending = []
+        #
+        # readings pending or being written; only drops once they are in the database
+        #
+        self.buffered = 0
+        self.condition = None
+        self.wakeup = None
+        self.flusher = None
+
+    def _start(self):
+        if self.flusher is None or self.flusher.done():
+            self.condition = asyncio.Condition()
+            self.wakeup = asyncio.Event()
+            self.flusher = asyncio.ensure_future(self._run())
+
+    async def put(self, connection, batch):
+        self._start()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.buffered < self.max_buffered)
+            self.pending.append((connection, batch))
+            self.buffered += len(batch)
+            if self.buffered >= self.flush_readings:
+                self.wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self.condition:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return
+        batches = [batch for connection, batch in pending]
+        count = sum(len(batch) for batch in batches)
+        try:
+            #
+            # not thread sensitive: the write gets an executor thread of its own instead of
+            # queueing behind whatever else runs on the process' single sync thread
+            #
+            result = await sync_to_async(_write, thread_sensitive=False)(ingest.ReadingBatch.concat(batches))
+            if result.rejected:
+                logger.warning("streaming flush rejected %d of %d readings: %s", result.rejected, count, result.errors[:5])
+        except Exception:
+            logger.exception("streaming flush of %d readings failed", count)
+            result = None
+        async with self.condition:
+            self.buffered -= count
+            self.condition.notify_all()
+
+        #
+        # the concatenated batch indexes readings 0..count-1 in pending order,
+        # split the outcome back into each connection's frames
+        #
+        per_connection = {}
+        offset = 0
+        for connection, batch in pending:
+            report = per_connection.setdefault(connection, {"accepted": 0, "rejected": 0, "errors": []})
+            end = offset + len(batch)
+            if result is None:
+                report["rejected"] += len(batch)
+            else:
+                accepted = int(result.accepted_mask[offset:end].sum()) if result.accepted_mask is not None else 0
+                report["accepted"] += accepted
+                report["rejected"] += len(batch) - accepted
+                for error in result.errors:
+                    if offset <= error["index"] < end:
+                        report["errors"].append({"index": int(batch.index[error["index"] - offset]), "msg": error["msg"]})
+            offset = end
+        for connection, report in per_connection.items():
+            if result is None:
+                await connection.send_json({"error": "write failed", "dropped": report["rejected"]})
+            else:
+                await connection.send_json(report)
+
+_buffer = None
+
+def get_position_buffer():
+    global _buffer
+    if _buffer is None:
+        _buffer = PositionBuffer(settings.STREAM_FLUSH_READINGS, settings.STREAM_FLUSH_SECONDS,
+                                 settings.STREAM_MAX_BUFFERED_READINGS)
+    return _buffer
+
+###########################
+# connections
+###########################
+class GatewayConnection(object):
+
+    def __init__(self, send):
+        self.send = send
+        self.open = True
+
+    async def send_json(self, dict_in):
+        if not self.open:
+            return
+        try:
+            await self.send({'type': 'websocket.send', 'text': json.dumps(dict_in)})
+        except Exception:
+            self.open = False
+
+def _parse_frame(message):
+    if message.get('bytes') is not None:
+        return ingest.parse_binary(message['bytes'])
+    return ingest.parse_ndjson((message.get('text') or '').splitlines())
+
+async def positions_websocket(scope, receive, send):
+    connection = GatewayConnection(send)
+    buffer = get_position_buffer()
+    while True:
+        message = await receive()
+        if message['type'] == 'websocket.connect':
+            await send({'type': 'websocket.accept'})
+        elif message['type'] == 'websocket.receive':
+            try:
+                batch = _parse_frame(message)
+            except ingest.IngestError as ex:
+                await connection.send_json({"error": str(ex)})
+                continue
+            if batch.errors:
+                result = ingest.IngestResult(len(batch.errors))
+                for index, msg in batch.errors:
+                    result.reject(index, msg)
+                await connection.send_json({"rejected": result.rejected, "errors": result.errors})
+            if len(batch):
+                await buffer.put(connection, batch)
+        elif message['type'] == 'websocket.disconnect':
+            connection.open = False
+            return
+
+async def websocket_application(scope, receive, send):
+    if scope['path'] == WS_PATH_POSITIONS:
+        await positions_websocket(scope, receive, send)
+        return
+    message = await receive()
+    if message['type'] == 'websocket.connect':
+        await send({'type': 'websocket.close', 'code': WS_CLOSE_NOT_FOUND})
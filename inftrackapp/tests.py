@@ -1,3 +1,612 @@
-from django.test import TestCase
+import datetime
+import io
+import itertools
+import json
+import os
+import shutil
+import tempfile
 
-# Create your tests here.
+import numpy as np
+
+from django.core.cache import caches
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+import inftrackapp.assignments as assignments
+import inftrackapp.clusters as clusters
+import inftrackapp.compression as compression
+import inftrackapp.contact_graph as contact_graph
+import inftrackapp.contacts as contacts
+import inftrackapp.dao as dao
+import inftrackapp.export as export
+import inftrackapp.heatmap as heatmap
+import inftrackapp.ingest as ingest
+import inftrackapp.models as models
+import inftrackapp.positions as positions
+import inftrackapp.response_cache as response_cache
+import inftrackapp.risk as risk
+import inftrackapp.segments as segments
+import inftrackapp.status_history as status_history
+import inftrackapp.workload as workload
+
+UTC = datetime.timezone.utc
+T0 = datetime.datetime(2020, 3, 28, 10, 0, tzinfo=UTC)
+
+def make_person(unique_id, status=models.STATUS_OK):
+    return dao.add_person(firstname=unique_id, lastname='Test', unique_id=unique_id, phone='555-0100',
+                          email='%s@example.org' % unique_id, role=models.ROLE_STAFF, status=status)
+
+def reset_indexes():
+    # the process wide indexes outlive the test database between tests
+    assignments._index = None
+    status_history._index = None
+
+###########################
+# contact detection
+###########################
+class GridJoinTests(SimpleTestCase):
+
+    def brute_force(self, person, bucket, x, y, distance):
+        pairs = set()
+        for i in range(len(person)):
+            for j in range(i + 1, len(person)):
+                if bucket[i] == bucket[j] and person[i] != person[j] and np.hypot(x[i] - x[j], y[i] - y[j]) <= distance:
+                    pairs.add((i, j))
+        return pairs
+
+    def test_matches_brute_force(self):
+        rng = np.random.RandomState(7)
+        n = 400
+        person = rng.randint(0, 60, n)
+        bucket = rng.randint(0, 4, n)
+        x = rng.uniform(-20, 20, n)
+        y = rng.uniform(-20, 20, n)
+        i, j, dist = contacts.grid_join(person, bucket, x, y, 2.0)
+        found = set((min(a, b), max(a, b)) for a, b in zip(i.tolist(), j.tolist()))
+        self.assertEqual(len(found), len(i), "every unordered pair is returned once")
+        self.assertEqual(found, self.brute_force(person, bucket, x, y, 2.0))
+        np.testing.assert_allclose(dist, np.hypot(x[i] - x[j], y[i] - y[j]))
+
+    def test_left_only_returns_pairs_of_left_points(self):
+        person = np.array([1, 2, 3, 2])
+        bucket = np.array([0, 0, 0, 1])
+        x = np.array([0.0, 1.9, 2.5, 0.5])
+        y = np.zeros(4)
+        i, j, dist = contacts.grid_join(person, bucket, x, y, 2.0, left=[0])
+        self.assertEqual(i.tolist(), [0])
+        self.assertEqual(j.tolist(), [1])
+
+    def test_empty(self):
+        i, j, dist = contacts.grid_join(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0), 2.0)
+        self.assertEqual(len(i), 0)
+
+@override_settings(POSITION_COMPRESSION_ENABLED=False, POSITION_SEGMENT_DIR=None)
+class FindContactsTests(TestCase):
+
+    def setUp(self):
+        reset_indexes()
+        self.tag = dao.add_tag(unique_id='T-1')
+
+    def add_track(self, person, x, y, seconds):
+        models.TagPosition.objects.bulk_create([
+            models.TagPosition(tag=self.tag, person=person, x=x, y=y, timestamp=T0 + datetime.timedelta(seconds=s))
+            for s in range(0, seconds, 10)])
+
+    def test_only_people_close_for_long_enough(self):
+        index = make_person('P-1')
+        near = make_person('P-2')
+        brief = make_person('P-3')
+        far = make_person('P-4')
+        self.add_track(index, 0.0, 0.0, 1200)
+        self.add_track(near, 1.0, 0.0, 1200)
+        self.add_track(brief, 0.5, 0.5, 300)
+        self.add_track(far, 10.0, 0.0, 1200)
+
+        found = contacts.find_contacts(index, T0, T0 + datetime.timedelta(hours=1), distance=2.0,
+                                       min_dwell_seconds=15 * 60, sample_seconds=10)
+        self.assertEqual([c.other_id for c in found], [near.id])
+        self.assertEqual(found[0].duration_seconds, 1200)
+        self.assertAlmostEqual(found[0].min_distance, 1.0)
+
+    def test_same_contacts_as_joining_everyone(self):
+        workload.generate(workload.WorkloadSpec(people=30, hours=2.5, interval_seconds=10, start=T0, rooms=3,
+                                                move_probability=0.01, seed=5))
+        fromdt, todt = T0, T0 + datetime.timedelta(hours=2.5)
+        for compressed in (False, True):
+            with override_settings(POSITION_COMPRESSION_ENABLED=compressed):
+                everyone = positions.load_positions(fromdt, todt)
+                for index in models.TrackablePerson.objects.order_by('id')[:5]:
+                    expected = contacts.contacts_from_frame(everyone, index.id, 2.0, 0, 10)
+                    found = contacts.find_contacts(index, fromdt, todt, distance=2.0, min_dwell_seconds=0, sample_seconds=10)
+                    self.assertTrue(expected)
+                    self.assertEqual(dict((c.other_id, c.duration_seconds) for c in found),
+                                     dict((c.other_id, c.duration_seconds) for c in expected))
+
+@override_settings(POSITION_COMPRESSION_ENABLED=False, POSITION_SEGMENT_DIR=None, CONTACT_GRAPH_ENABLED=True)
+class ContactGraphTests(TestCase):
+
+    def setUp(self):
+        reset_indexes()
+        self.tag = dao.add_tag(unique_id='T-1')
+        self.index = make_person('P-1')
+        self.other = make_person('P-2')
+
+    def add_track(self, person, x, start, seconds):
+        models.TagPosition.objects.bulk_create([
+            models.TagPosition(tag=self.tag, person=person, x=x, y=0.0, timestamp=start + datetime.timedelta(seconds=s))
+            for s in range(0, seconds, 10)])
+
+    def test_late_readings_are_joined_into_their_bucket(self):
+        self.add_track(self.index, 0.0, T0, 1200)
+        contact_graph.advance(now=T0)
+        contact_graph.advance(now=T0 + datetime.timedelta(hours=1))
+        self.assertEqual(contact_graph.contacts_of(self.index, T0, T0 + datetime.timedelta(hours=1), min_dwell_seconds=0), [])
+
+        # an hour late, well below the watermark
+        self.add_track(self.other, 1.0, T0, 1200)
+        contact_graph.advance(now=T0 + datetime.timedelta(hours=1, seconds=20))
+        found = contact_graph.contacts_of(self.index, T0, T0 + datetime.timedelta(hours=1), min_dwell_seconds=0)
+        self.assertEqual([(c.other_id, c.duration_seconds) for c in found], [(self.other.id, 1200)])
+
+        # recomputing replaces the bucket, the next step does not count it twice
+        contact_graph.advance(now=T0 + datetime.timedelta(hours=1, seconds=40))
+        self.assertEqual(models.ContactEdge.objects.get().duration_seconds, 1200)
+
+    def test_window_cuts_through_a_bucket(self):
+        self.add_track(self.index, 0.0, T0, 1200)
+        self.add_track(self.other, 1.0, T0, 1200)
+        contact_graph.rebuild(T0, T0 + datetime.timedelta(hours=2))
+        until = T0 + datetime.timedelta(hours=2)
+        found = contact_graph.contacts_of(self.index, T0 + datetime.timedelta(minutes=10), until, min_dwell_seconds=0)
+        self.assertEqual([(c.other_id, c.duration_seconds) for c in found], [(self.other.id, 600)])
+        self.assertEqual(contact_graph.contacts_of(self.index, T0 + datetime.timedelta(minutes=30), until, min_dwell_seconds=0), [])
+        found = contact_graph.contacts_of(self.index, T0 - datetime.timedelta(hours=1), T0 + datetime.timedelta(minutes=5), min_dwell_seconds=0)
+        self.assertEqual([(c.other_id, c.duration_seconds) for c in found], [(self.other.id, 300)])
+
+###########################
+# trajectory compression
+###########################
+class FillGapsTests(SimpleTestCase):
+
+    def test_holds_position_between_readings(self):
+        person, x, y, t = compression.fill_gaps([1, 1], [0.0, 5.0], [0.0, 5.0], [0.0, 35.0], 10, 60)
+        self.assertEqual(t.tolist(), [0.0, 10.0, 20.0, 30.0, 35.0, 45.0, 55.0, 65.0, 75.0, 85.0])
+        self.assertEqual(x.tolist()[:4], [0.0] * 4)
+        self.assertEqual(x.tolist()[4:], [5.0] * 6)
+        self.assertEqual(set(person.tolist()), {1})
+
+    def test_gap_longer_than_max_interval_stays_empty(self):
+        person, x, y, t = compression.fill_gaps([1, 1], [0.0, 0.0], [0.0, 0.0], [0.0, 200.0], 10, 60, until=230.0)
+        self.assertEqual(t.tolist(), [0.0, 10.0, 20.0, 30.0, 40.0, 50.0, 200.0, 210.0, 220.0])
+
+    def test_people_are_filled_separately(self):
+        person, x, y, t = compression.fill_gaps([2, 1, 2], [2.0, 1.0, 2.0], [0.0, 0.0, 0.0], [0.0, 0.0, 15.0], 10, 20, until=20.0)
+        self.assertEqual(list(zip(person.tolist(), t.tolist())), [(1, 0.0), (1, 10.0), (2, 0.0), (2, 10.0), (2, 15.0)])
+
+    def test_empty(self):
+        person, x, y, t = compression.fill_gaps([], [], [], [], 10, 60)
+        self.assertEqual(len(t), 0)
+
+###########################
+# clusters
+###########################
+class ComponentsTests(SimpleTestCase):
+
+    def test_labels_each_component_with_its_smallest_node(self):
+        labels = clusters.components(6, [0, 1, 4], [1, 2, 5])
+        self.assertEqual(labels.tolist(), [0, 0, 0, 3, 4, 4])
+
+    def test_long_chain_in_reverse_order(self):
+        n = 50
+        a = np.arange(n - 1)[::-1]
+        labels = clusters.components(n, a + 1, a)
+        self.assertEqual(labels.tolist(), [0] * n)
+
+    def test_no_links(self):
+        self.assertEqual(clusters.components(3, [], []).tolist(), [0, 1, 2])
+
+###########################
+# tag assignments
+###########################
+class AssignmentIndexTests(TestCase):
+
+    def setUp(self):
+        reset_indexes()
+        self.person = make_person('P-1')
+        self.tag = dao.add_tag(unique_id='T-1')
+
+    def test_refreshes_only_when_the_version_moves(self):
+        index = assignments.get_assignment_index()
+        # written by another process, which bumps the version once it commits
+        models.TagAssignmentEvent.objects.create(tag=self.tag, person=self.person, event_type=models.ASSIGN_EVENT_ASSIGNED, timestamp=T0)
+        with self.assertNumQueries(0):
+            self.assertIs(assignments.get_assignment_index(), index)
+        self.assertIsNone(index.person_at(self.tag.id, T0.timestamp()))
+        response_cache.bump_version(assignments.ASSIGNMENTS_VERSION_KEY)
+        self.assertEqual(assignments.get_assignment_index().person_at(self.tag.id, T0.timestamp()), self.person.id)
+        with self.assertNumQueries(0):
+            assignments.get_assignment_index()
+
+    def test_current_assignment_comes_from_the_index(self):
+        now = datetime.datetime.now(UTC)
+        dao.assign_tag(self.tag, self.person, now - datetime.timedelta(hours=1))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.person.current_tag, self.tag)
+        self.assertEqual(self.tag.current_person, self.person)
+        dao.unassign_tag(self.tag, now - datetime.timedelta(minutes=1))
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.person.current_tag)
+            self.assertIsNone(self.tag.current_person)
+
+###########################
+# status history
+###########################
+class StatusTimelineTests(SimpleTestCase):
+
+    def test_at(self):
+        ok, at_risk, infected = (status_history.CODES[s] for s in (models.STATUS_OK, models.STATUS_AT_RISK, models.STATUS_INFECTED))
+        timeline = status_history.StatusTimeline()
+        timeline.add(200.0, at_risk, infected)
+        timeline.add(100.0, ok, at_risk)
+        self.assertEqual(timeline.at(50.0), ok)
+        self.assertEqual(timeline.at(100.0), at_risk)
+        self.assertEqual(timeline.at(150.0), at_risk)
+        self.assertEqual(timeline.at(250.0), infected)
+        self.assertEqual(timeline.at_many(np.array([50.0, 150.0, 250.0])).tolist(), [ok, at_risk, infected])
+
+class StatusIndexTests(TestCase):
+
+    def setUp(self):
+        reset_indexes()
+
+    def test_blank_new_status_is_skipped(self):
+        person = make_person('P-1', status=models.STATUS_INFECTED)
+        models.StatusChangeEvent.objects.create(person=person, prior_status=models.STATUS_OK, new_status='', timestamp=T0)
+        models.StatusChangeEvent.objects.create(person=person, prior_status=models.STATUS_AT_RISK, new_status=models.STATUS_INFECTED,
+                                                timestamp=T0 + datetime.timedelta(hours=1))
+        later = (T0 + datetime.timedelta(hours=2)).timestamp()
+        self.assertEqual(status_history.statuses_at([person.id], [later]), [models.STATUS_INFECTED])
+        self.assertEqual(status_history.status_at(person, T0 + datetime.timedelta(minutes=30)), models.STATUS_AT_RISK)
+
+###########################
+# risk scoring
+###########################
+@override_settings(TRACE_INFECTIOUS_DAYS_BEFORE=2)
+class ComputeDosesTests(TestCase):
+
+    def setUp(self):
+        reset_indexes()
+
+    def test_only_infection_is_back_dated(self):
+        target = make_person('P-1')
+        source = make_person('P-2')
+        day = datetime.timedelta(days=1)
+        models.StatusChangeEvent.objects.create(person=source, prior_status=models.STATUS_OK, new_status=models.STATUS_INFECTED,
+                                                timestamp=T0 + 5 * day)
+        models.StatusChangeEvent.objects.create(person=source, prior_status=models.STATUS_INFECTED, new_status=models.STATUS_OK,
+                                                timestamp=T0 + 10 * day)
+        ts = np.array([(T0 + d * day).timestamp() for d in (0, 4, 7, 9, 11)])
+        n = len(ts)
+        to, fro, dose = risk.compute_doses(np.full(n, target.id), np.full(n, source.id), np.ones(n), np.zeros(n), ts)
+        self.assertEqual(to[:n].tolist(), [target.id] * n)
+        # infectious two days before being marked infected, and until the recovery itself
+        self.assertEqual(dose[:n].tolist(), [0.0, 1.0, 1.0, 1.0, 0.0])
+
+###########################
+# person traces
+###########################
+class CursorTests(SimpleTestCase):
+
+    def test_round_trip(self):
+        self.assertEqual(positions.decode_cursor(positions.encode_cursor(1585389600000000, 42)), (1585389600000000, 42, 0))
+        self.assertEqual(positions.decode_cursor(positions.encode_cursor(1585389600000000, 0, 3)), (1585389600000000, 0, 3))
+
+    def test_rejects_garbage(self):
+        with self.assertRaises(ValueError):
+            positions.decode_cursor('abc')
+
+    def test_next_cursor_counts_id_less_rows_at_one_timestamp(self):
+        cursor = positions.next_cursor(None, 10, 0)
+        self.assertEqual(cursor, (10, 0, 1))
+        cursor = positions.next_cursor(cursor, 10, 0)
+        self.assertEqual(cursor, (10, 0, 2))
+        self.assertEqual(positions.next_cursor(cursor, 20, 0), (20, 0, 1))
+        self.assertEqual(positions.next_cursor(cursor, 20, 7), (20, 7, 0))
+
+@override_settings(POSITION_COMPRESSION_ENABLED=False)
+class TracePagingTests(TestCase):
+
+    def setUp(self):
+        reset_indexes()
+        self.person = make_person('P-1')
+        self.tag = dao.add_tag(unique_id='T-1')
+        dao.assign_tag(self.tag, self.person, T0 - datetime.timedelta(hours=1))
+        self.segment_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.segment_dir, True)
+
+    def add_positions(self, offsets):
+        models.TagPosition.objects.bulk_create([
+            models.TagPosition(tag=self.tag, person=self.person, x=float(i), y=0.0, timestamp=T0 + datetime.timedelta(seconds=s))
+            for i, s in enumerate(offsets)])
+
+    def page_all(self, limit):
+        # walk the trace limit rows at a time, through encoded cursors as the view does
+        fromdt = T0 - datetime.timedelta(hours=1)
+        todt = T0 + datetime.timedelta(hours=3)
+        rows = []
+        after = None
+        while True:
+            page = list(itertools.islice(positions.iter_trace(self.person, fromdt, todt, after=after), limit))
+            rows.extend(page)
+            if len(page) < limit:
+                return rows
+            for micros, row_id, x, y in page:
+                after = positions.next_cursor(after, micros, row_id)
+            after = positions.decode_cursor(positions.encode_cursor(*after))
+
+    def test_database_rows_with_equal_timestamps(self):
+        with override_settings(POSITION_SEGMENT_DIR=None):
+            self.add_positions([0, 5, 5, 5, 5, 9])
+            rows = self.page_all(2)
+        self.assertEqual([x for micros, row_id, x, y in rows], [0.0, 1.0, 2.0, 3.0, 4.0, 5.0])
+
+    def test_sealed_rows_with_equal_timestamps(self):
+        with override_settings(POSITION_SEGMENT_DIR=self.segment_dir):
+            self.add_positions([0, 5, 5, 5, 5, 9])
+            segments.get_segment_store().seal(T0 + datetime.timedelta(hours=2))
+            self.assertEqual(models.TagPosition.objects.count(), 0)
+            rows = self.page_all(2)
+        self.assertEqual(sorted(x for micros, row_id, x, y in rows), [0.0, 1.0, 2.0, 3.0, 4.0, 5.0])
+        self.assertEqual(set(row_id for micros, row_id, x, y in rows), {0})
+
+@override_settings(POSITION_COMPRESSION_ENABLED=False)
+class SegmentStoreTests(TestCase):
+
+    def setUp(self):
+        reset_indexes()
+        self.person = make_person('P-1')
+        self.tag = dao.add_tag(unique_id='T-1')
+        self.segment_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.segment_dir, True)
+        self.store = segments.SegmentStore(self.segment_dir)
+
+    def add_positions(self, offsets):
+        models.TagPosition.objects.bulk_create([
+            models.TagPosition(tag=self.tag, person=self.person, x=1.0, y=2.0, timestamp=T0 + datetime.timedelta(seconds=s))
+            for s in offsets])
+
+    def test_repeated_readings_are_kept(self):
+        self.add_positions([0, 5, 5, 9])
+        self.assertEqual(self.store.seal_hour(T0), 4)
+        self.assertEqual(models.TagPosition.objects.count(), 0)
+        data = self.store.load(T0, T0 + segments.HOUR)
+        self.assertEqual((data['timestamp'] - segments._micros(T0)).tolist(), [0, 5000000, 5000000, 9000000])
+        with override_settings(POSITION_SEGMENT_DIR=self.segment_dir):
+            self.assertEqual(len(positions.load_raw_positions(T0, T0 + segments.HOUR)), 4)
+
+    def test_interrupted_seal_is_finished_once(self):
+        self.add_positions([0, 5, 5])
+        self.store.seal_hour(T0)
+        self.add_positions([7, 7])
+        # stop after the journal is written, before the files are swapped in
+        self.store.finish_pending = lambda hour: None
+        self.store.seal_hour(T0)
+        del self.store.finish_pending
+        self.assertEqual(len(self.store.load(T0, T0 + segments.HOUR)), 3)
+        with override_settings(POSITION_SEGMENT_DIR=self.segment_dir):
+            self.assertEqual(len(positions.load_raw_positions(T0, T0 + segments.HOUR)), 5)
+        self.assertEqual(models.TagPosition.objects.count(), 0)
+        self.assertEqual(self.store.seal_hour(T0), 0)
+        self.assertEqual(len(self.store.load(T0, T0 + segments.HOUR)), 5)
+
+    def test_seal_interrupted_before_its_journal_is_discarded(self):
+        self.add_positions([0, 5])
+        os.makedirs(self.store.hour_dir(T0))
+        with open(self.store.segment_path(T0, self.tag.id) + segments.PENDING_SUFFIX, 'wb') as f:
+            f.write(b'partial')
+        self.assertEqual(self.store.seal_hour(T0), 2)
+        self.assertEqual(len(self.store.load(T0, T0 + segments.HOUR)), 2)
+        self.assertEqual(os.listdir(self.store.hour_dir(T0)), ['%d.npy' % self.tag.id])
+
+###########################
+# wire formats
+###########################
+class ParseBinaryTests(SimpleTestCase):
+
+    def test_round_trip(self):
+        body = ingest.encode_binary(['T-1', 'T-2'], [0, 1, 0], [1.5, 2.5, 3.5], [0.5, 0.25, 0.0], [1585389600.0, 1585389601.0, 1585389602.5])
+        batch = ingest.parse_binary(body)
+        self.assertEqual(batch.tags, ['T-1', 'T-2'])
+        self.assertEqual(batch.tag_index.tolist(), [0, 1, 0])
+        self.assertEqual(batch.x.tolist(), [1.5, 2.5, 3.5])
+        self.assertEqual(batch.t.tolist(), [1585389600.0, 1585389601.0, 1585389602.5])
+        self.assertEqual(batch.errors, [])
+
+    def test_bad_readings_are_rejected_by_index(self):
+        body = ingest.encode_binary(['T-1'], [0, 3, 0, 0, 0, 0], [1.0, 1.0, np.nan, 1.0, 1.0, 1.0], [0.0] * 6,
+                                    [1585389600.0, 1585389600.0, 1585389600.0, np.inf, 1585389600000.0, 1585389601.0])
+        batch = ingest.parse_binary(body)
+        self.assertEqual(batch.index.tolist(), [0, 5])
+        self.assertEqual([index for index, message in batch.errors], [1, 2, 3, 4])
+        self.assertEqual(batch.size, 6)
+
+    def test_malformed_body(self):
+        with self.assertRaises(ingest.IngestError):
+            ingest.parse_binary(b'NOPE')
+        body = ingest.encode_binary(['T-1'], [0], [1.0], [1.0], [1585389600.0])
+        with self.assertRaises(ingest.IngestError):
+            ingest.parse_binary(body[:-3])
+
+class ParseNdjsonTests(SimpleTestCase):
+
+    def test_bad_readings_are_rejected_by_index(self):
+        lines = [
+            json.dumps({"tag": "T-1", "x": 1, "y": 2, "timestamp": 1585389600.5}),
+            '["T-1", 1, 2, NaN]',
+            json.dumps(["T-1", 1, 2, 1585389600000]),
+            '{"tag": "T-1"}',
+            json.dumps(["T-2", 3, 4, "2020-03-28T10:00:00Z"]),
+        ]
+        batch = ingest.parse_ndjson(lines)
+        self.assertEqual(batch.index.tolist(), [0, 4])
+        self.assertEqual([index for index, message in batch.errors], [1, 2, 3])
+        self.assertEqual(batch.t.tolist(), [1585389600.5, T0.timestamp()])
+
+class ExportBinaryTests(TestCase):
+
+    def test_round_trip(self):
+        a = make_person('P-1')
+        b = make_person('P-2')
+        first = {'timestamp': np.array([1, 2], dtype=np.int64), 'person': np.array([a.id, b.id]),
+                 'x': np.array([1.0, 2.0]), 'y': np.array([3.0, 4.0])}
+        second = {'timestamp': np.array([3], dtype=np.int64), 'person': np.array([a.id]),
+                  'x': np.array([5.0]), 'y': np.array([6.0])}
+        data = b''.join(export.iter_binary(export.POSITIONS, [first, second]))
+        kind, people, columns = export.decode_binary(data)
+        self.assertEqual(kind, export.POSITIONS)
+        self.assertEqual(people, {a.id: 'P-1', b.id: 'P-2'})
+        self.assertEqual(columns['timestamp'].tolist(), [1, 2, 3])
+        self.assertEqual(columns['person'].tolist(), [a.id, b.id, a.id])
+        self.assertEqual(columns['x'].tolist(), [1.0, 2.0, 5.0])
+        self.assertEqual(columns['y'].tolist(), [3.0, 4.0, 6.0])
+
+    def test_truncated_export(self):
+        a = make_person('P-1')
+        chunk = {'timestamp': np.array([1], dtype=np.int64), 'person': np.array([a.id]), 'x': np.array([1.0]), 'y': np.array([2.0])}
+        data = b''.join(export.iter_binary(export.POSITIONS, [chunk]))
+        with self.assertRaises(ValueError):
+            export.decode_binary(data[:-8])
+        with self.assertRaises(ValueError):
+            export.decode_binary(b'XXXX')
+
+###########################
+# heatmaps
+###########################
+@override_settings(POSITION_COMPRESSION_ENABLED=False, HEATMAP_BUCKET_SECONDS=900)
+class HeatmapTileTests(TestCase):
+
+    def setUp(self):
+        reset_indexes()
+        caches[heatmap.TILE_CACHE].clear()
+        self.person = make_person('P-1')
+        self.tag = dao.add_tag(unique_id='T-1')
+        models.TagPosition.objects.bulk_create([
+            models.TagPosition(tag=self.tag, person=self.person, x=1.5, y=2.5, timestamp=T0 + datetime.timedelta(seconds=s))
+            for s in range(0, 3 * 3600, 10)])
+        self.segment_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.segment_dir, True)
+
+    def cached_starts(self, members=None):
+        starts = heatmap.bucket_starts(T0, T0 + datetime.timedelta(hours=3), 900)
+        keys = dict((heatmap._cache_key(start, 900, 1.0, members), start) for start in starts)
+        return sorted(keys[key] for key in caches[heatmap.TILE_CACHE].get_many(list(keys)))
+
+    def test_only_tiles_before_the_sealed_history_are_cached(self):
+        with override_settings(POSITION_SEGMENT_DIR=self.segment_dir):
+            tiles = heatmap.get_tiles(T0, T0 + datetime.timedelta(hours=3), cell_meters=1.0)
+            self.assertEqual(self.cached_starts(), [], "nothing is final before anything is sealed")
+
+            segments.get_segment_store().seal(T0 + datetime.timedelta(hours=2))
+            again = heatmap.get_tiles(T0, T0 + datetime.timedelta(hours=3), cell_meters=1.0)
+        self.assertEqual(self.cached_starts(), [T0 + datetime.timedelta(minutes=15 * i) for i in range(8)])
+        self.assertEqual(tiles[0].cells()[2].tolist(), [1.0])
+        for tile, other in zip(tiles, again):
+            self.assertEqual(tile.start, other.start)
+            np.testing.assert_array_equal(tile.counts, other.counts)
+
+    def test_filter_key_follows_only_its_own_members(self):
+        other = make_person('P-2')
+        staff = heatmap._members_digest(heatmap.filtered_people(role=models.ROLE_STAFF))
+        infected = heatmap._members_digest(heatmap.filtered_people(status=models.STATUS_INFECTED))
+        dao.change_person_status(other, models.STATUS_INFECTED, T0)
+        self.assertEqual(heatmap._members_digest(heatmap.filtered_people(role=models.ROLE_STAFF)), staff)
+        self.assertNotEqual(heatmap._members_digest(heatmap.filtered_people(status=models.STATUS_INFECTED)), infected)
+
+###########################
+# response cache
+###########################
+class ResponseCacheTests(TestCase):
+
+    def setUp(self):
+        caches[response_cache.VERSIONS_CACHE].clear()
+        self.view = response_cache.cached_people_response(lambda request: HttpResponse(b'[]', content_type='application/json'))
+
+    def get(self, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.view(RequestFactory().get('/v1/people', **headers))
+
+    def test_unchanged_poll_is_answered_without_queries(self):
+        etag = self.get()['ETag']
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get(etag).status_code, 304)
+
+    def test_person_write_changes_the_etag(self):
+        etag = self.get()['ETag']
+        make_person('P-1')
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+###########################
+# roster import
+###########################
+class ImportRosterCommandTests(TestCase):
+
+    def setUp(self):
+        reset_indexes()
+
+    def write(self, suffix, data):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_bad_bytes_reject_only_their_row(self):
+        path = self.write('.csv', b'unique_id,firstname,lastname,phone,role\n'
+                                  b'P-1,Ann,Lee,555-0101,nurse\n'
+                                  b'P-2,Jos\xe9,Diaz,555-0102,nurse\n'
+                                  b'P-3,Bo,Kim,555-0103,doctor\n')
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_roster', 'people', path, stdout=out, stderr=err)
+        self.assertIn('row 1: invalid UTF-8', err.getvalue())
+        self.assertIn('3 rows: 2 created', out.getvalue())
+        self.assertEqual(sorted(models.TrackablePerson.objects.values_list('unique_id', flat=True)), ['P-1', 'P-3'])
+
+    def test_bad_bytes_in_ndjson(self):
+        path = self.write('.ndjson', b'{"unique_id": "T-1"}\n{"unique_id": "T-\xff"}\n{"unique_id": "T-3"}\n')
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_roster', 'tags', path, stdout=out, stderr=err)
+        self.assertIn('row 1: invalid UTF-8', err.getvalue())
+        self.assertEqual(sorted(models.TrackingTag.objects.values_list('unique_id', flat=True)), ['T-1', 'T-3'])
+
+###########################
+# synthetic workload
+###########################
+class WorkloadTests(TestCase):
+
+    def setUp(self):
+        reset_indexes()
+
+    def test_positions_follow_tag_swaps(self):
+        spec = workload.WorkloadSpec(people=20, hours=0.5, interval_seconds=10, start=T0, reassignments_per_day=100, seed=3)
+        summary = workload.generate(spec)
+        self.assertEqual(summary['people'], 20)
+        self.assertEqual(summary['positions'], 20 * 180)
+        self.assertEqual(models.TagPosition.objects.count(), summary['positions'])
+        self.assertGreater(summary['assignment_events'], 20, "some tags were swapped")
+        self.assertEqual(set(models.TrackablePerson.objects.values_list('role', flat=True)),
+                         set(role for role, share in workload.ROLE_SHARES))
+
+        # every reading belongs to whoever wore the tag at the time
+        index = assignments.get_assignment_index()
+        rows = list(models.TagPosition.objects.values_list('tag_id', 'person_id', 'timestamp'))
+        holders = index.persons_at([tag_id for tag_id, person_id, ts in rows], [ts.timestamp() for tag_id, person_id, ts in rows])
+        self.assertEqual(list(holders), [person_id for tag_id, person_id, ts in rows])
+
+    def test_delete(self):
+        workload.generate(workload.WorkloadSpec(people=5, hours=0.1, start=T0, prefix='gone'))
+        self.assertGreater(workload.delete('gone'), 0)
+        self.assertEqual(models.TrackablePerson.objects.count(), 0)
+        self.assertEqual(models.TagPosition.objects.count(), 0)
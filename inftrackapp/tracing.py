@@ -0,0 +1,163 @@
+#######################################################################
+# tracing.py
+# Time-respecting multi-hop exposure tracing
+#
+# Starting from an infected person, exposure spreads hop by hop over the
+# contact graph, but only forwards in time: a contact can pass exposure
+# on only if it happened after the upstream person was exposed
+# themselves. The edges for the whole horizon are loaded with one query
+# into a CSR adjacency (numpy arrays sorted by source person), and the
+# search is an earliest-arrival relaxation, one vectorised pass per hop.
+#######################################################################
+import datetime
+
+import numpy as np
+
+from django.conf import settings
+
+import inftrackapp.contact_graph as contact_graph
+import inftrackapp.contacts as contacts
+import inftrackapp.models as models
+
+class ContactAdjacency(object):
+    #
+    # directed copy of every edge, grouped by source: the edges leaving node n are
+    # indptr[n]:indptr[n + 1]; node numbers index into person_ids
+    #
+    def __init__(self, a, b, first, last):
+        self.person_ids, inverse = np.unique(np.concatenate([a, b]), return_inverse=True)
+        n_edges = len(a)
+        src = np.concatenate([inverse[:n_edges], inverse[n_edges:]])
+        dst = np.concatenate([inverse[n_edges:], inverse[:n_edges]])
+        first = np.concatenate([first, first])
+        last = np.concatenate([last, last])
+        order = np.lexsort((first, src))
+        self.dst = dst[order]
+        self.first = first[order]
+        self.last = last[order]
+        counts = np.bincount(src, minlength=len(self.person_ids))
+        self.indptr = np.r_[0, np.cumsum(counts)]
+
+    def node(self, person_id):
+        i = np.searchsorted(self.person_ids, person_id)
+        if i < len(self.person_ids) and self.person_ids[i] == person_id:
+            return int(i)
+        return None
+
+def load_adjacency(fromdt, todt, min_dwell_seconds):
+    #
+    # edges in [fromdt, todt) between pairs whose contact over the whole window adds
+    # up to at least min_dwell_seconds; times are epoch seconds
+    #
+    rows = models.ContactEdge.objects.filter(bucket_start__gte=fromdt, bucket_start__lt=todt) \
+        .values_list('person_a_id', 'person_b_id', 'duration_seconds', 'first_contact', 'last_contact')
+    rows = list(rows.iterator())
+    if not rows:
+        return None
+    a, b, duration, first, last = zip(*rows)
+    a = np.asarray(a, dtype=np.int64)
+    b = np.asarray(b, dtype=np.int64)
+    duration = np.asarray(duration, dtype=np.float64)
+    first = np.asarray([dt.timestamp() for dt in first])
+    last = np.asarray([dt.timestamp() for dt in last])
+
+    pairs, inverse = np.unique(np.stack([a, b], axis=1), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    keep = np.bincount(inverse, weights=duration)[inverse] >= min_dwell_seconds
+    if not keep.any():
+        return None
+    return ContactAdjacency(a[keep], b[keep], first[keep], last[keep])
+
+class Exposure(object):
+    __slots__ = ('person_id', 'hop', 'exposed_at', 'via_id')
+
+    def __init__(self, person_id, hop, exposed_at, via_id):
+        self.person_id = person_id
+        self.hop = hop
+        self.exposed_at = exposed_at
+        self.via_id = via_id
+
+def trace_exposures(adjacency, source_id, start, max_depth, horizon_end):
+    #
+    # earliest time every person could have been exposed, starting from source_id exposed
+    # at start (epoch seconds), over at most max_depth hops, ignoring contacts after horizon_end
+    # returns Exposure objects in order of exposure time
+    #
+    source = adjacency.node(source_id)
+    if source is None:
+        return []
+    n = len(adjacency.person_ids)
+    best = np.full(n, np.inf)
+    hop = np.full(n, -1, dtype=np.int64)
+    parent = np.full(n, -1, dtype=np.int64)
+    best[source] = start
+    hop[source] = 0
+
+    frontier = np.array([source], dtype=np.int64)
+    for depth in range(1, max_depth + 1):
+        lo = adjacency.indptr[frontier]
+        hi = adjacency.indptr[frontier + 1]
+        owner, pos = contacts._expand_ranges(lo, hi)
+        if not len(pos):
+            break
+        src = frontier[owner]
+        upstream = best[src]
+        #
+        # a contact only counts if it was still going on after the upstream person was exposed
+        #
+        usable = (adjacency.last[pos] > upstream) & (adjacency.first[pos] <= horizon_end)
+        src = src[usable]
+        pos = pos[usable]
+        dst = adjacency.dst[pos]
+        arrival = np.maximum(adjacency.first[pos], best[src])
+
+        order = np.lexsort((arrival, dst))
+        dst = dst[order]
+        arrival = arrival[order]
+        src = src[order]
+        firsts = np.r_[True, dst[1:] != dst[:-1]] if len(dst) else np.zeros(0, dtype=bool)
+        dst = dst[firsts]
+        arrival = arrival[firsts]
+        src = src[firsts]
+
+        improved = arrival < best[dst]
+        dst = dst[improved]
+        best[dst] = arrival[improved]
+        parent[dst] = src[improved]
+        hop[dst] = depth
+        if not len(dst):
+            break
+        frontier = dst
+
+    reached = np.flatnonzero((hop > 0) & np.isfinite(best))
+    reached = reached[np.argsort(best[reached], kind='stable')]
+    return [Exposure(int(adjacency.person_ids[i]), int(hop[i]), float(best[i]), int(adjacency.person_ids[parent[i]]))
+            for i in reached]
+
+def infection_start(person):
+    #
+    # when person became infectious: the time they were marked infected, less the
+    # pre-symptomatic window; None if they have never been marked infected
+    #
+    evt = models.StatusChangeEvent.objects.filter(person=person, new_status=models.STATUS_INFECTED).order_by('-timestamp').first()
+    if evt is None:
+        return None
+    return evt.timestamp - datetime.timedelta(days=settings.TRACE_INFECTIOUS_DAYS_BEFORE)
+
+def trace_from(person, start, depth=None, horizon_days=None, min_dwell_seconds=None):
+    #
+    # everyone reachable from person within depth hops and horizon_days of start,
+    # read from the contact graph built by contact_graph.py
+    #
+    if depth is None:
+        depth = settings.TRACE_MAX_DEPTH
+    if horizon_days is None:
+        horizon_days = settings.TRACE_HORIZON_DAYS
+    if min_dwell_seconds is None:
+        min_dwell_seconds = settings.CONTACT_MIN_DWELL_SECONDS
+    end = start + datetime.timedelta(days=horizon_days)
+    bucket_from = contact_graph._floor(start, settings.CONTACT_GRAPH_BUCKET_SECONDS)
+    adjacency = load_adjacency(bucket_from, end, min_dwell_seconds)
+    if adjacency is None:
+        return []
+    return trace_exposures(adjacency, person.id, start.timestamp(), depth, end.timestamp())
@@ -5,41 +5,121 @@ import datetime
 import json
 import os
 import logging
-import random
 
 from operator import or_
 
-from django.http import HttpResponse
+import numpy as np
+
+from django.http import HttpResponse, StreamingHttpResponse
 from django.conf import settings
 from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_aware, make_aware
 
 from django.core.exceptions import ObjectDoesNotExist
 from django.views import View
 from django.utils.decorators import method_decorator
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
 import inftrackapp.models as models
 import inftrackapp.api_json as api_json
+import inftrackapp.clusters as clusters
+import inftrackapp.contact_graph as contact_graph
+import inftrackapp.contacts as contacts
+import inftrackapp.dao as dao
+import inftrackapp.export as export
+import inftrackapp.heatmap as heatmap
+import inftrackapp.ingest as ingest
+import inftrackapp.live as live
+import inftrackapp.metrics as metrics
+import inftrackapp.positions as positions
+import inftrackapp.response_cache as response_cache
+import inftrackapp.risk as risk
+import inftrackapp.roster as roster
+import inftrackapp.status_history as status_history
+import inftrackapp.tracing as tracing
+import inftrackapp.zones as zones
+
+#
+# people listings only read the columns they return, and stream rows as they come off the cursor
+#
+PERSON_VALUES = ('id', 'unique_id', 'firstname', 'lastname', 'role', 'status', 'phone', 'email')
+
+def person_row(row):
+    return {
+        "firstname": row['firstname'],
+        "lastname": row['lastname'],
+        "id": row['unique_id'],
+        "role": row['role'],
+        "status": row['status'],
+        "phone": row['phone'],
+        "email": row['email']
+    }
+
+def response_people_page(request, trackable_people):
+    #
+    # ?limit=&offset= for page numbers, or ?limit=&cursor=<next_cursor> to walk the
+    # whole list without the cost of large offsets; no limit streams everyone
+    #
+    try:
+        limit = limit_param(request, None, settings.PEOPLE_MAX_PAGE_SIZE) if request.GET.get('limit') else None
+    except ValueError as ex:
+        return api_json.response_error_unprocessable_entity(str(ex))
+    try:
+        offset = int(request.GET.get('offset', 0))
+        cursor = int(request.GET['cursor']) if request.GET.get('cursor') else None
+    except ValueError:
+        return api_json.response_error_unprocessable_entity("offset and cursor must be integers")
+    if offset < 0:
+        return api_json.response_error_unprocessable_entity("offset must not be negative")
+
+    total = trackable_people.count()
+    page_qs = trackable_people.order_by('id')
+    if cursor is not None:
+        page_qs = page_qs.filter(id__gt=cursor)
+    if limit is not None:
+        # one row past the page tells us whether there is more
+        page_qs = page_qs[offset:offset + limit + 1]
+    elif offset:
+        page_qs = page_qs[offset:]
+    rows = page_qs.values(*PERSON_VALUES).iterator(chunk_size=2000)
+    page = {"count": 0, "has_more": False, "last_id": None}
+
+    def items():
+        for row in rows:
+            if limit is not None and page["count"] == limit:
+                page["has_more"] = True
+                return
+            page["count"] += 1
+            page["last_id"] = row['id']
+            yield person_row(row)
+
+    def trailer():
+        return {
+            "count": page["count"],
+            "has_more": page["has_more"],
+            "limit": limit or 0,
+            "offset": offset,
+            "total": total,
+            "next_cursor": str(page["last_id"]) if page["has_more"] else None
+        }
+
+    return api_json.response_streaming_list(items(), trailer=trailer)
 
 # v1/people
+# v1/people?limit=100&offset=200
+# v1/people?limit=100&cursor=<next_cursor>
+@response_cache.cached_people_response
 def show_all_people(request):
     trackable_people = models.TrackablePerson.objects.all()
-    people_list = []
-    for person in trackable_people:
-        person_dict = {
-            "firstname": person.firstname,
-            "lastname": person.lastname,
-            "id": person.unique_id,
-            "role": person.role,
-            "status": person.status,
-            "phone": person.phone,
-            "email": person.email
-        }
-        people_list.append(person_dict)
-    return api_json.response_success_with_list(people_list)
+    return response_people_page(request, trackable_people)
 
 # v1/people?role=doctor
 # v1/people?role=doctor,nurse,patient
+@response_cache.cached_people_response
 def show_people_by_role(request, role):
     #comma delimited roles or one role
     role_value = role
@@ -54,22 +134,11 @@ def show_people_by_role(request, role):
         roles = role_value.split(",")
         trackable_people = models.TrackablePerson.objects.filter(role__in=roles)
 
-    people_list = []
-    for person in trackable_people:
-        person_dict = {
-            "firstname": person.firstname,
-            "lastname": person.lastname,
-            "id": person.unique_id,
-            "role": person.role,
-            "status": person.status,
-            "phone": person.phone,
-            "email": person.email
-        }
-        people_list.append(person_dict)
-    return api_json.response_success_with_list(people_list)
+    return response_people_page(request, trackable_people)
 
 # v1/people?status=ok
 # v1/people?status=at-risk,being-tested
+@response_cache.cached_people_response
 def show_people_by_status(request, status):
     #comma delimited statuses or one statuses
     status_value = status
@@ -84,21 +153,10 @@ def show_people_by_status(request, status):
         statuses = status_value.split(",")
         trackable_people = models.TrackablePerson.objects.filter(status__in=statuses)
 
-    people_list = []
-    for person in trackable_people:
-        person_dict = {
-            "firstname": person.firstname,
-            "lastname": person.lastname,
-            "id": person.unique_id,
-            "role": person.role,
-            "status": person.status,
-            "phone": person.phone,
-            "email": person.email
-        }
-        people_list.append(person_dict)
-    return api_json.response_success_with_list(people_list)
+    return response_people_page(request, trackable_people)
 
 # v1/status?id=123
+@response_cache.cached_people_response
 def show_person_by_id(request, identifier):
     try:
         trackable_people = models.TrackablePerson.objects.filter(unique_id=identifier)
@@ -117,11 +175,128 @@ def show_person_by_id(request, identifier):
     except:
         return api_json.response_error_not_found("no person with specified id")
 
+def datetime_param(request, name, default):
+    # ISO 8601 query parameter; raises ValueError with a message suitable for the client
+    value = request.GET.get(name)
+    if not value:
+        return default
+    dt = parse_datetime(value)
+    if dt is None:
+        raise ValueError("%s must be an ISO 8601 datetime" % name)
+    if not is_aware(dt):
+        dt = make_aware(dt)
+    return dt
+
+def limit_param(request, default, maximum):
+    try:
+        limit = int(request.GET.get('limit', default))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if limit < 1 or limit > maximum:
+        raise ValueError("limit must be between 1 and %d" % maximum)
+    return limit
+
+# v1/people/id/123/trace
+# v1/people/id/123/trace?from=2020-03-28T00:00:00Z&to=2020-03-29T00:00:00Z&limit=5000&cursor=<next_cursor>
+# v1/people/id/123/trace?interpolate=10 (held positions every 10 s between the stored ones)
+def show_person_trace(request, identifier):
+    person = models.TrackablePerson.objects.get_or_none(unique_id=identifier)
+    if person is None:
+        return api_json.response_error_not_found("no person with specified id")
+
+    try:
+        todt = datetime_param(request, 'to', timezone.now())
+        fromdt = datetime_param(request, 'from', todt - datetime.timedelta(days=settings.CONTACT_LOOKBACK_DAYS))
+        limit = limit_param(request, settings.TRACE_PAGE_SIZE, settings.TRACE_MAX_PAGE_SIZE)
+    except ValueError as ex:
+        return api_json.response_error_unprocessable_entity(str(ex))
+    try:
+        interpolate = float(request.GET['interpolate']) if request.GET.get('interpolate') else None
+    except ValueError:
+        return api_json.response_error_unprocessable_entity("interpolate must be a number of seconds")
+    if interpolate is not None and interpolate <= 0:
+        return api_json.response_error_unprocessable_entity("interpolate must be positive")
+    cursor = request.GET.get('cursor')
+    try:
+        after = positions.decode_cursor(cursor) if cursor else None
+    except ValueError:
+        return api_json.response_error_unprocessable_entity("cursor is not valid")
+
+    #
+    # one row past the page tells us whether there is more without a count query
+    #
+    if interpolate is not None:
+        rows = positions.iter_filled_trace(person, fromdt, todt, interpolate, after=after)
+    else:
+        rows = positions.iter_trace(person, fromdt, todt, after=after)
+    page = {"count": 0, "next_cursor": None, "has_more": False, "after": after}
+
+    def items():
+        for micros, row_id, x, y in rows:
+            if page["count"] == limit:
+                page["has_more"] = True
+                return
+            page["count"] += 1
+            page["after"] = positions.next_cursor(page["after"], micros, row_id)
+            page["next_cursor"] = positions.encode_cursor(*page["after"])
+            yield {
+                "timestamp": positions.micros_to_datetime(micros),
+                "x": x,
+                "y": y
+            }
+
+    def trailer():
+        if not page["has_more"]:
+            page["next_cursor"] = None
+        return {"id": person.unique_id, "from": fromdt, "to": todt, "limit": limit,
+                "count": page["count"], "has_more": page["has_more"], "next_cursor": page["next_cursor"]}
+
+    return api_json.response_streaming_list(items(), trailer=trailer)
+
+# v1/people/id/123/nearby
+# v1/people/id/123/nearby?distance=2
+def show_people_nearby(request, identifier):
+    person = models.TrackablePerson.objects.get_or_none(unique_id=identifier)
+    if person is None:
+        return api_json.response_error_not_found("no person with specified id")
+    try:
+        distance = float(request.GET.get('distance', settings.CONTACT_DISTANCE_METERS))
+    except ValueError:
+        return api_json.response_error_unprocessable_entity("distance must be a number")
+    if not 0 < distance <= settings.LIVE_MAX_DISTANCE_METERS:
+        return api_json.response_error_unprocessable_entity("distance must be positive and at most %s" % settings.LIVE_MAX_DISTANCE_METERS)
+    table = live.get_live_positions()
+    if table is None:
+        return api_json.response_error_not_found("live positions are not enabled")
+
+    found = table.near(person.id, distance)
+    if found is None:
+        return api_json.response_json({"id": person.unique_id, "position": None, "results": []})
+    centre, neighbours = found
+    people = models.TrackablePerson.objects.in_bulk([n.person_id for n in neighbours])
+    result_list = []
+    for neighbour in neighbours:
+        other = people.get(neighbour.person_id)
+        if other is None:
+            continue
+        result_list.append({
+            "firstname": other.firstname,
+            "lastname": other.lastname,
+            "id": other.unique_id,
+            "status": other.status,
+            "distance": round(neighbour.distance, 2),
+            "x": neighbour.position.x,
+            "y": neighbour.position.y,
+            "seen_at": neighbour.position.seen_at
+        })
+    return api_json.response_json({"id": person.unique_id, "distance": distance,
+                                   "position": {"x": centre.x, "y": centre.y, "seen_at": centre.seen_at},
+                                   "results": result_list})
+
 # v1/status?id=123&status=ok
 def update_status(request, status, identifier):
     #get the user with id
-    updated_persons = models.TrackablePerson.objects.filter(unique_id=identifier)
-    updated_person = updated_persons[0]
+    updated_person = models.TrackablePerson.objects.get_or_none(unique_id=identifier)
 
     if updated_person is None:
         return api_json.response_error_not_found("no person with specified id in our system")
@@ -131,8 +306,9 @@ def update_status(request, status, identifier):
 
     #checking to see if the new status value is a valid status
     if status_update in models.STATUS_CHECK:
-        setattr(updated_person,"status",status_update)
-        updated_person.save()
+        if updated_person.status != status_update:
+            dao.change_person_status(updated_person,status_update,timezone.now())
+            risk.schedule_refresh_after_status_change([updated_person.id])
         response_dict = {
             "firstname": updated_person.firstname,
             "lastname": updated_person.lastname,
@@ -145,58 +321,443 @@ def update_status(request, status, identifier):
     else:
         return api_json.response_error_not_found("status value is not a valid status")
 
+# v1/people/id/123/status
+# v1/people/id/123/status?at=2020-03-28T18:00:00Z
+# the status the person had at a moment, rebuilt from their status changes
+def show_person_status_at(request, identifier):
+    person = models.TrackablePerson.objects.get_or_none(unique_id=identifier)
+    if person is None:
+        return api_json.response_error_not_found("no person with specified id")
+    try:
+        at = datetime_param(request, 'at', timezone.now())
+    except ValueError as ex:
+        return api_json.response_error_unprocessable_entity(str(ex))
+    return api_json.response_success_with_dict({"id": person.unique_id, "at": at, "status": status_history.status_at(person, at),
+                                                "current_status": person.status})
+
+# v1/people/status-at
+# POST {"queries": [{"id": "123", "timestamp": "2020-03-28T18:00:00Z"}, ...]}
+@csrf_exempt
+@require_POST
+def show_people_status_at(request):
+    try:
+        body = json.loads(request.body)
+        queries = [(str(q['id']), parse_datetime(q['timestamp'])) for q in body['queries']]
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return api_json.response_error_unprocessable_entity('body must be {"queries": [{"id": ..., "timestamp": ...}]}')
+    if any(dt is None for unique_id, dt in queries):
+        return api_json.response_error_unprocessable_entity("timestamp must be an ISO 8601 datetime")
+    if len(queries) > settings.STATUS_AT_MAX_QUERIES:
+        return api_json.response_error_unprocessable_entity("at most %d queries per request" % settings.STATUS_AT_MAX_QUERIES)
+
+    queries = [(unique_id, dao.to_aware(dt)) for unique_id, dt in queries]
+    ids = dict(models.TrackablePerson.objects.filter(unique_id__in=list(set(u for u, dt in queries))).values_list('unique_id', 'id'))
+    found = [(unique_id, dt) for unique_id, dt in queries if unique_id in ids]
+    statuses = iter(status_history.statuses_at([ids[unique_id] for unique_id, dt in found], [dt.timestamp() for unique_id, dt in found]))
+    results = []
+    for unique_id, dt in queries:
+        if unique_id in ids:
+            results.append({"id": unique_id, "at": dt, "status": next(statuses)})
+        else:
+            results.append({"id": unique_id, "at": dt, "status": None, "result": "not_found"})
+    return api_json.response_success_with_list(results)
+
+# v1/status/bulk
+# POST {"status": "infected", "ids": ["123", "456"]}
+# POST {"updates": [{"id": "123", "status": "infected"}, {"id": "456", "status": "at_risk"}], "timestamp": "2020-03-28T18:00:00Z"}
+@csrf_exempt
+@require_POST
+def update_status_bulk(request):
+    try:
+        body = json.loads(request.body)
+        if 'updates' in body:
+            updates = [(str(u['id']), u['status']) for u in body['updates']]
+        else:
+            updates = [(str(unique_id), body['status']) for unique_id in body['ids']]
+        timestamp = parse_datetime(body['timestamp']) if body.get('timestamp') else timezone.now()
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return api_json.response_error_unprocessable_entity('body must be {"status": ..., "ids": [...]} or {"updates": [{"id": ..., "status": ...}]}')
+    if timestamp is None:
+        return api_json.response_error_unprocessable_entity("timestamp must be an ISO 8601 datetime")
+    if len(updates) > settings.STATUS_BULK_MAX_UPDATES:
+        return api_json.response_error_unprocessable_entity("at most %d updates per request" % settings.STATUS_BULK_MAX_UPDATES)
+
+    results = dao.change_people_status(updates, timestamp)
+    changed = [r["id"] for r in results if r["result"] == dao.STATUS_RESULT_UPDATED]
+    if changed:
+        risk.schedule_refresh_after_status_change(list(models.TrackablePerson.objects.filter(unique_id__in=changed).values_list('id', flat=True)))
+    return api_json.response_success_with_list(results)
+
+# v1/tags/assign
+# POST {"assignments": [{"tag": "t1", "person": "123", "timestamp": "2020-03-28T07:00:00Z"}, ...]}
+# shift change: every tag is taken from whoever holds it at its timestamp and given to person
+@csrf_exempt
+@require_POST
+def assign_tags_bulk(request):
+    try:
+        body = json.loads(request.body)
+        now = timezone.now()
+        requested = [(str(a['tag']), str(a['person']), parse_datetime(a['timestamp']) if a.get('timestamp') else now)
+                     for a in body['assignments']]
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return api_json.response_error_unprocessable_entity('body must be {"assignments": [{"tag": ..., "person": ..., "timestamp": ...}]}')
+    if any(dt is None for tag_id, person_id, dt in requested):
+        return api_json.response_error_unprocessable_entity("timestamp must be an ISO 8601 datetime")
+    if len(requested) > settings.TAG_ASSIGN_BULK_MAX_ASSIGNMENTS:
+        return api_json.response_error_unprocessable_entity("at most %d assignments per request" % settings.TAG_ASSIGN_BULK_MAX_ASSIGNMENTS)
+
+    tags = models.TrackingTag.objects.in_bulk(set(tag_id for tag_id, person_id, dt in requested), field_name='unique_id')
+    people = models.TrackablePerson.objects.in_bulk(set(person_id for tag_id, person_id, dt in requested), field_name='unique_id')
+    results = []
+    valid = []
+    for tag_id, person_id, dt in requested:
+        result = {"tag": tag_id, "person": person_id, "timestamp": dt}
+        if tag_id not in tags:
+            result["result"] = "tag_not_found"
+        elif person_id not in people:
+            result["result"] = "person_not_found"
+        else:
+            result["result"] = "assigned"
+            valid.append((result, (tags[tag_id], people[person_id], dt)))
+        results.append(result)
 
+    holders = dao.assign_tags([assignment for result, assignment in valid])
+    prior = models.TrackablePerson.objects.in_bulk(set(h for h in holders if h is not None))
+    for (result, assignment), holder in zip(valid, holders):
+        result["prior_person"] = prior[holder].unique_id if holder in prior else None
+    return api_json.response_success_with_list(results)
+
+def contact_params(request):
+    #
+    # lookback days, distance and dwell time for contact analysis, overridable per request
+    # raises ValueError with a message suitable for the client
+    #
+    try:
+        days = float(request.GET.get('days', settings.CONTACT_LOOKBACK_DAYS))
+        distance = float(request.GET.get('distance', settings.CONTACT_DISTANCE_METERS))
+        dwell = float(request.GET.get('dwell', settings.CONTACT_MIN_DWELL_SECONDS))
+    except ValueError:
+        raise ValueError("days, distance and dwell must be numbers")
+    if days <= 0 or distance <= 0 or dwell < 0:
+        raise ValueError("days and distance must be positive, dwell must not be negative")
+    return days, distance, dwell
+
+# v1/analyze-at-risk/id/123/
+# v1/analyze-at-risk/id/123/?days=14&distance=2&dwell=900
 def analyze_at_risk(request, identifier):
-    trackable_people = models.TrackablePerson.objects.all()
-    increment = random.randrange(10)+1 #random value from 1-10
+    person = models.TrackablePerson.objects.get_or_none(unique_id=identifier)
+    if person is None:
+        return api_json.response_error_not_found("no person with specified id")
+
+    try:
+        days, distance, dwell = contact_params(request)
+    except ValueError as ex:
+        return api_json.response_error_unprocessable_entity(str(ex))
+
+    fromdt, todt = contacts.contact_window(days=days)
+    if distance == settings.CONTACT_DISTANCE_METERS and contact_graph.covers(fromdt):
+        # the graph is built at the configured distance
+        found = contact_graph.contacts_of(person, fromdt, todt, min_dwell_seconds=dwell)
+    else:
+        found = contacts.find_contacts(person, fromdt, todt, distance=distance, min_dwell_seconds=dwell)
+    people = models.TrackablePerson.objects.in_bulk([c.other_id for c in found])
+    #
+    # risk is read from the precomputed scores (see risk.py), highest first
+    #
+    scores = dict(models.RiskScore.objects.filter(person_id__in=[c.other_id for c in found]).values_list('person_id', 'score'))
+    found.sort(key=lambda c: scores.get(c.other_id, 0.0), reverse=True)
 
     people_list = []
-    count = 0
-    index = 0
-    for person in trackable_people:
-        risk = round(random.random(), 2) #random float with 2 decimal places from 0.0 to 1.0
-        if count < 10 and person.unique_id != identifier and index % increment == 0:
-            person_dict = {
-                "firstname": person.firstname,
-                "lastname": person.lastname,
-                "id": person.unique_id,
-                "risk": risk,
-                "status": person.status
-            }
-            people_list.append(person_dict)
-            count += 1
-        index += 1
+    for contact in found:
+        other = people[contact.other_id]
+        person_dict = {
+            "firstname": other.firstname,
+            "lastname": other.lastname,
+            "id": other.unique_id,
+            "risk": round(scores.get(contact.other_id, 0.0), 2),
+            "status": other.status,
+            "duration": contact.duration_seconds,
+            "min_distance": round(contact.min_distance, 2),
+            "first_seen": contact.first_seen,
+            "last_seen": contact.last_seen
+        }
+        people_list.append(person_dict)
 
     return api_json.response_success_with_list(people_list)
 
-def analyze_at_risk_details(request):
-    amount = random.randrange(10)+1 #how many results
-    zone = "break room"
+# v1/risk-scores
+# v1/risk-scores?limit=100&offset=0&min_score=0.5
+def show_risk_scores(request):
+    try:
+        limit = limit_param(request, settings.PEOPLE_MAX_PAGE_SIZE, settings.PEOPLE_MAX_PAGE_SIZE)
+    except ValueError as ex:
+        return api_json.response_error_unprocessable_entity(str(ex))
+    try:
+        offset = int(request.GET.get('offset', 0))
+        min_score = float(request.GET.get('min_score', 0.0))
+    except ValueError:
+        return api_json.response_error_unprocessable_entity("offset and min_score must be numbers")
+    if offset < 0:
+        return api_json.response_error_unprocessable_entity("offset must not be negative")
 
-    result_list = []
-    for i in range(amount):
-        month = random.randrange(3,12)
-        day = random.randrange(1,29)
-        hour = random.randrange(0,23)
-        min = random.randrange(0,59)
+    scores = models.RiskScore.objects.filter(score__gte=min_score)
+    total = scores.count()
+    rows = scores.order_by('-score', 'person_id')[offset:offset + limit] \
+        .values('score', 'dose', 'sources', 'computed_at', 'person__unique_id', 'person__firstname', 'person__lastname',
+                'person__status', 'top_source__unique_id')
+
+    people_list = []
+    for row in rows:
+        person_dict = {
+            "firstname": row['person__firstname'],
+            "lastname": row['person__lastname'],
+            "id": row['person__unique_id'],
+            "status": row['person__status'],
+            "risk": round(row['score'], 2),
+            "dose": round(row['dose'], 1),
+            "sources": row['sources'],
+            "top_source": row['top_source__unique_id'],
+            "computed_at": row['computed_at']
+        }
+        people_list.append(person_dict)
 
-        starttime = "2020-"+str(month)+"-"+str(day)+" "+str(hour)+":"+str(min)+":00.000000"
+    return api_json.response_success_with_list(people_list, limit=limit, offset=offset, total=total)
 
-        increment = random.randrange(1,15)
+# v1/analyze-at-risk-details?id=123
+# v1/analyze-at-risk-details?id=123&contact=456&days=14&distance=2&dwell=900
+def analyze_at_risk_details(request):
+    identifier = request.GET.get('id')
+    if not identifier:
+        return api_json.response_error_unprocessable_entity("id is required")
+    person = models.TrackablePerson.objects.get_or_none(unique_id=identifier)
+    if person is None:
+        return api_json.response_error_not_found("no person with specified id")
 
-        if min + increment >= 60:
-            min = min + increment - 60
-            hour += 1
-        else:
-            min = min + increment
+    try:
+        days, distance, dwell = contact_params(request)
+    except ValueError as ex:
+        return api_json.response_error_unprocessable_entity(str(ex))
+
+    fromdt, todt = contacts.contact_window(days=days)
+    found = contacts.find_contacts(person, fromdt, todt, distance=distance, min_dwell_seconds=dwell)
 
-        endtime = "2020-"+str(month)+"-"+str(day)+" "+str(hour)+":"+str(min)+":00.000000"
+    contact_identifier = request.GET.get('contact')
+    if contact_identifier:
+        other = models.TrackablePerson.objects.get_or_none(unique_id=contact_identifier)
+        if other is None:
+            return api_json.response_error_not_found("no person with specified contact id")
+        found = [c for c in found if c.other_id == other.id]
 
+    zone_index = zones.get_zone_index()
+    intervals = []
+    for contact in found:
+        intervals.extend(contacts.exposure_intervals(contact, zone_index))
+    intervals.sort(key=lambda interval: interval.start)
+    unique_ids = dict(models.TrackablePerson.objects.filter(id__in=[c.other_id for c in found]).values_list('id', 'unique_id'))
+
+    result_list = []
+    for interval in intervals:
         result_dict = {
-            "starttime": starttime,
-            "endtime": endtime,
-            "zone": zone
+            "id": unique_ids[interval.other_id],
+            "starttime": interval.start,
+            "endtime": interval.end,
+            "duration": interval.duration_seconds,
+            "zone": interval.zone
         }
         result_list.append(result_dict)
 
     return api_json.response_success_with_list(result_list)
+
+# v1/export/positions?id=123&format=csv
+# v1/export/contacts?from=2020-03-28T00:00:00Z&to=2020-03-29T00:00:00Z&format=binary
+def export_data(request, kind):
+    if kind not in export.KINDS:
+        return api_json.response_error_not_found("can only export %s" % ', '.join(export.KINDS))
+    fmt = request.GET.get('format', export.FORMAT_CSV)
+    if fmt not in export.FORMATS:
+        return api_json.response_error_unprocessable_entity("format must be one of %s" % ', '.join(export.FORMATS))
+    person = None
+    identifier = request.GET.get('id')
+    if identifier:
+        person = models.TrackablePerson.objects.get_or_none(unique_id=identifier)
+        if person is None:
+            return api_json.response_error_not_found("no person with specified id")
+    try:
+        todt = datetime_param(request, 'to', timezone.now())
+        fromdt = datetime_param(request, 'from', todt - datetime.timedelta(days=settings.CONTACT_LOOKBACK_DAYS))
+    except ValueError as ex:
+        return api_json.response_error_unprocessable_entity(str(ex))
+
+    body = export.encode(kind, fmt, export.chunks(kind, fromdt, todt, person=person))
+    response = StreamingHttpResponse(body, content_type=export.CONTENT_TYPES[fmt])
+    filename = 'inftrack-%s-%s%s.%s' % (kind, (person.unique_id + '-') if person else '', fromdt.strftime('%Y%m%dT%H%M%S'),
+                                        export.EXTENSIONS[fmt])
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
+# v1/heatmap
+# v1/heatmap?from=2020-03-28T00:00:00Z&to=2020-03-29T00:00:00Z&bucket=900&cell=1&role=nurse&x0=10&y0=0&x1=20&y1=8
+def show_heatmap(request):
+    try:
+        todt = datetime_param(request, 'to', timezone.now())
+        fromdt = datetime_param(request, 'from', todt - datetime.timedelta(days=1))
+    except ValueError as ex:
+        return api_json.response_error_unprocessable_entity(str(ex))
+    try:
+        seconds = int(request.GET.get('bucket', settings.HEATMAP_BUCKET_SECONDS))
+        cell = float(request.GET.get('cell', settings.HEATMAP_CELL_METERS))
+        bounds = [float(request.GET[name]) if request.GET.get(name) else None for name in ('x0', 'y0', 'x1', 'y1')]
+    except ValueError:
+        return api_json.response_error_unprocessable_entity("bucket, cell, x0, y0, x1 and y1 must be numbers")
+    if seconds < settings.CONTACT_SAMPLE_SECONDS or cell <= 0:
+        return api_json.response_error_unprocessable_entity("bucket must be at least %d seconds and cell must be positive" % settings.CONTACT_SAMPLE_SECONDS)
+    if fromdt >= todt or (todt - fromdt).total_seconds() / seconds > settings.HEATMAP_MAX_BUCKETS:
+        return api_json.response_error_unprocessable_entity("from must be before to, and cover at most %d buckets" % settings.HEATMAP_MAX_BUCKETS)
+    role = request.GET.get('role')
+    if role and role not in models.ROLE_CHECK:
+        return api_json.response_error_unprocessable_entity("role must be one of %s" % ', '.join(models.ROLE_CHECK))
+    status = request.GET.get('status')
+    if status and status not in models.STATUS_CHECK:
+        return api_json.response_error_unprocessable_entity("status must be one of %s" % ', '.join(models.STATUS_CHECK))
+
+    cell_bounds = None
+    if any(value is not None for value in bounds):
+        limits = (-float('inf'), -float('inf'), float('inf'), float('inf'))
+        cell_bounds = [limit if value is None else value // cell for value, limit in zip(bounds, limits)]
+
+    result_list = []
+    for tile in heatmap.get_tiles(fromdt, todt, seconds=seconds, cell_meters=cell, role=role, status=status):
+        cx, cy, occupancy = tile.cells(cell_bounds)
+        peak = int(np.argmax(occupancy)) if len(occupancy) else None
+        result_list.append({
+            "start": tile.start,
+            "end": tile.end,
+            "people": round(float(occupancy.sum()), 3),
+            "peak": None if peak is None else {"x": float(cx[peak] * cell), "y": float(cy[peak] * cell),
+                                               "occupancy": round(float(occupancy[peak]), 3)},
+            # [x, y, mean people present] per occupied cell, x and y being the cell's lower corner
+            "cells": [[x * cell, y * cell, round(value, 3)] for x, y, value in zip(cx.tolist(), cy.tolist(), occupancy.tolist())]
+        })
+    return api_json.response_json({"from": fromdt, "to": todt, "bucket_seconds": seconds, "cell_meters": cell,
+                                   "role": role, "status": status, "results": result_list})
+
+# v1/trace-exposure/id/123/
+# v1/trace-exposure/id/123/?depth=2&horizon_days=7&from=2020-03-20T00:00:00Z
+def trace_exposure(request, identifier):
+    person = models.TrackablePerson.objects.get_or_none(unique_id=identifier)
+    if person is None:
+        return api_json.response_error_not_found("no person with specified id")
+
+    try:
+        start = datetime_param(request, 'from', None)
+    except ValueError as ex:
+        return api_json.response_error_unprocessable_entity(str(ex))
+    if start is None:
+        start = tracing.infection_start(person)
+        if start is None:
+            return api_json.response_error_unprocessable_entity("person has never been infected, give a from time to trace from")
+    try:
+        depth = int(request.GET.get('depth', settings.TRACE_MAX_DEPTH))
+        horizon_days = float(request.GET.get('horizon_days', settings.TRACE_HORIZON_DAYS))
+    except ValueError:
+        return api_json.response_error_unprocessable_entity("depth and horizon_days must be numbers")
+    if depth < 1 or depth > settings.TRACE_DEPTH_LIMIT or horizon_days <= 0:
+        return api_json.response_error_unprocessable_entity("depth must be between 1 and %d, horizon_days must be positive" % settings.TRACE_DEPTH_LIMIT)
+    #
+    # contacts from before the graph's covered_from are not seen; run rebuild_contact_graph to reach further back
+    #
+    exposures = tracing.trace_from(person, start, depth=depth, horizon_days=horizon_days)
+    people = models.TrackablePerson.objects.in_bulk(set([e.person_id for e in exposures] + [e.via_id for e in exposures]))
+
+    people_list = []
+    for exposure in exposures:
+        exposed = people[exposure.person_id]
+        person_dict = {
+            "firstname": exposed.firstname,
+            "lastname": exposed.lastname,
+            "id": exposed.unique_id,
+            "status": exposed.status,
+            "hop": exposure.hop,
+            "exposed_at": positions.epoch_to_datetime(exposure.exposed_at),
+            "via": people[exposure.via_id].unique_id
+        }
+        people_list.append(person_dict)
+
+    return api_json.response_success_with_list(people_list)
+
+# v1/clusters
+# v1/clusters?days=14&statuses=infected,at_risk&min_size=3
+def show_clusters(request):
+    statuses = request.GET.get('statuses')
+    statuses = statuses.split(',') if statuses else settings.CLUSTER_STATUSES
+    if any(status not in models.STATUS_CHECK for status in statuses):
+        return api_json.response_error_unprocessable_entity("statuses must be a comma separated list of %s" % ', '.join(models.STATUS_CHECK))
+    try:
+        days = float(request.GET.get('days', settings.CONTACT_LOOKBACK_DAYS))
+        dwell = float(request.GET.get('dwell', settings.CONTACT_MIN_DWELL_SECONDS))
+        min_size = int(request.GET.get('min_size', 2))
+    except ValueError:
+        return api_json.response_error_unprocessable_entity("days, dwell and min_size must be numbers")
+    if days <= 0 or dwell < 0 or min_size < 2:
+        return api_json.response_error_unprocessable_entity("days must be positive, dwell not negative and min_size at least 2")
+
+    fromdt, todt = contacts.contact_window(days=days)
+    found = clusters.detect(fromdt, todt, statuses=statuses, min_dwell_seconds=dwell, min_size=min_size)
+    return api_json.response_success_with_list(clusters.as_dicts(found))
+
+# v1/positions
+# POST a batch of readings as NDJSON (application/x-ndjson) or packed binary (application/octet-stream)
+@csrf_exempt
+@require_POST
+def ingest_positions(request):
+    try:
+        if request.content_type == ingest.CONTENT_TYPE_BINARY:
+            batch = ingest.parse_binary(request.read())
+        elif request.content_type in (ingest.CONTENT_TYPE_NDJSON, 'application/json', 'text/plain'):
+            # NDJSON is parsed line by line straight off the request stream
+            batch = ingest.parse_ndjson(request)
+        else:
+            return api_json.response_error_unprocessable_entity("body must be %s or %s" % (ingest.CONTENT_TYPE_NDJSON, ingest.CONTENT_TYPE_BINARY))
+    except ingest.IngestError as ex:
+        return api_json.response_error_unprocessable_entity(str(ex))
+
+    result = ingest.ingest(batch)
+    return api_json.response_success_with_dict(result.as_dict())
+
+# v1/roster/<people|tags>
+# POST a roster as CSV with a header row (text/csv) or NDJSON (application/x-ndjson), read line by line
+# off the request and upserted on unique_id; bad rows are reported by index and skipped
+@csrf_exempt
+@require_POST
+def import_roster(request, kind):
+    if kind not in roster.KINDS:
+        return api_json.response_error_not_found("roster kind must be one of %s" % ', '.join(roster.KINDS))
+    if request.content_type == 'text/csv':
+        fmt = roster.FORMAT_CSV
+    elif request.content_type in (ingest.CONTENT_TYPE_NDJSON, 'application/json', 'text/plain'):
+        fmt = roster.FORMAT_NDJSON
+    else:
+        return api_json.response_error_unprocessable_entity("body must be text/csv or %s" % ingest.CONTENT_TYPE_NDJSON)
+    try:
+        result = roster.import_stream(kind, request, fmt)
+    except roster.RosterError as ex:
+        return api_json.response_error_unprocessable_entity(str(ex))
+    return api_json.response_success_with_dict(result.as_dict())
+
+def metrics_allowed(request):
+    allowed = settings.METRICS_ALLOWED_IPS
+    return allowed is None or request.META.get('REMOTE_ADDR') in allowed
+
+# v1/metrics
+# Prometheus text exposition of this worker's request metrics
+def show_metrics(request):
+    if not metrics_allowed(request):
+        return api_json.response_error_forbidden("metrics are not available from this address")
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# v1/metrics/traces
+# the most recent sampled requests slower than METRICS_SLOW_REQUEST_SECONDS, with their slowest queries
+def show_metrics_traces(request):
+    if not metrics_allowed(request):
+        return api_json.response_error_forbidden("metrics are not available from this address")
+    return api_json.response_success_with_list(metrics.recent_traces())
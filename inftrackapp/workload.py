@@ -0,0 +1,200 @@
+#######################################################################
+# workload.py
+# Synthetic hospital workload
+#
+# Generates a facility that behaves like a real one closely enough to
+# measure against:
+#   - people across every role, mostly patients,
+#   - one tag each plus spares, with tags swapped mid-stream through
+#     TagAssignmentEvent as they would be at shift changes,
+#   - positions every interval_seconds per person: a small random walk
+#     around the room a person is in, with occasional moves to another
+#     room, so people share rooms and contacts actually happen.
+#
+# Everything is driven by one seed, so two runs produce the same data.
+# Positions are written in chunks of at most CHUNK_ROWS and never held
+# in full, so 10^8 positions need no more memory than 10^5.
+#######################################################################
+import datetime
+
+import numpy as np
+
+from django.db import transaction
+from django.utils import timezone
+
+import inftrackapp.assignments as assignments
+import inftrackapp.dao as dao
+import inftrackapp.models as models
+import inftrackapp.response_cache as response_cache
+
+#
+# share of people per role, roughly a ward
+#
+ROLE_SHARES = (
+    (models.ROLE_PATIENT, 0.45),
+    (models.ROLE_NURSE, 0.25),
+    (models.ROLE_DOCTOR, 0.1),
+    (models.ROLE_STAFF, 0.15),
+    (models.ROLE_OTHER, 0.05),
+)
+CHUNK_ROWS = 200000
+
+FIRSTNAMES = ('Alex', 'Sam', 'Jo', 'Chris', 'Robin', 'Kim', 'Pat', 'Lee', 'Max', 'Dana', 'Noor', 'Ari')
+LASTNAMES = ('Smith', 'Jones', 'Garcia', 'Chen', 'Patel', 'Kowalski', 'Okafor', 'Silva', 'Novak', 'Haddad')
+
+class WorkloadSpec(object):
+
+    def __init__(self, people=1000, hours=1.0, interval_seconds=10, start=None, rooms=None, room_size=6.0,
+                 move_probability=0.002, step_meters=0.3, spare_tags=0.1, reassignments_per_day=0.5,
+                 prefix='syn', seed=0):
+        self.people = people
+        self.hours = hours
+        self.interval_seconds = interval_seconds
+        if start is None:
+            # end at now, so "last 14 days" style queries see the data
+            start = timezone.now() - datetime.timedelta(hours=hours)
+        self.start = start
+        # about eight people per room unless told otherwise
+        self.rooms = rooms or max(1, people // 8)
+        self.room_size = room_size
+        self.move_probability = move_probability
+        self.step_meters = step_meters
+        self.spare_tags = spare_tags
+        self.reassignments_per_day = reassignments_per_day
+        self.prefix = prefix
+        self.seed = seed
+
+    @property
+    def steps(self):
+        return int(self.hours * 3600 // self.interval_seconds)
+
+    @property
+    def positions(self):
+        return self.steps * self.people
+
+    def room_centres(self):
+        # rooms on a square grid, room_size apart with a corridor between them
+        side = int(np.ceil(np.sqrt(self.rooms)))
+        i = np.arange(self.rooms)
+        pitch = self.room_size * 1.5
+        return np.stack([(i % side) * pitch + self.room_size / 2, (i // side) * pitch + self.room_size / 2], axis=1)
+
+###########################
+# people, tags, assignments
+###########################
+def create_people(spec, rng):
+    roles = [role for role, share in ROLE_SHARES]
+    shares = np.array([share for role, share in ROLE_SHARES])
+    role_of = rng.choice(len(roles), size=spec.people, p=shares / shares.sum())
+    people = [models.TrackablePerson(unique_id='%s-p%07d' % (spec.prefix, i),
+                                     firstname=FIRSTNAMES[rng.integers(len(FIRSTNAMES))],
+                                     lastname=LASTNAMES[rng.integers(len(LASTNAMES))],
+                                     phone='555-%04d' % (i % 10000),
+                                     email='%s-p%07d@example.org' % (spec.prefix, i),
+                                     role=roles[role_of[i]],
+                                     status=models.STATUS_OK)
+              for i in range(spec.people)]
+    models.TrackablePerson.objects.bulk_create(people, batch_size=1000)
+    response_cache.bump_people_version()
+    return list(models.TrackablePerson.objects.filter(unique_id__startswith='%s-p' % spec.prefix).order_by('unique_id').values_list('id', flat=True))
+
+def create_tags(spec):
+    count = spec.people + int(np.ceil(spec.people * spec.spare_tags))
+    tags = [models.TrackingTag(unique_id='%s-t%07d' % (spec.prefix, i)) for i in range(count)]
+    models.TrackingTag.objects.bulk_create(tags, batch_size=1000)
+    return list(models.TrackingTag.objects.filter(unique_id__startswith='%s-t' % spec.prefix).order_by('unique_id').values_list('id', flat=True))
+
+def plan_assignments(spec, person_ids, tag_ids, rng):
+    #
+    # everyone starts on their own tag; reassignments move a person onto a spare tag and
+    # return the old one to the spare pool
+    # returns the TagAssignmentEvents and the swaps as (step, person index, tag id) sorted by step
+    #
+    start = spec.start
+    events = []
+    current = list(tag_ids[:len(person_ids)])
+    spares = list(tag_ids[len(person_ids):])
+    for p, tag_id in zip(person_ids, current):
+        events.append(models.TagAssignmentEvent(person_id=p, tag_id=tag_id, event_type=models.ASSIGN_EVENT_ASSIGNED, timestamp=start))
+
+    swaps = []
+    count = rng.poisson(spec.reassignments_per_day * len(person_ids) * spec.hours / 24.0) if spares else 0
+    for step in np.sort(rng.integers(1, max(spec.steps, 2), size=count)):
+        p = int(rng.integers(len(person_ids)))
+        k = int(rng.integers(len(spares)))
+        old_tag, new_tag = current[p], spares[k]
+        spares[k] = old_tag
+        current[p] = new_tag
+        t = start + datetime.timedelta(seconds=int(step) * spec.interval_seconds)
+        events.append(models.TagAssignmentEvent(person_id=person_ids[p], tag_id=old_tag, event_type=models.ASSIGN_EVENT_UNASSIGNED,
+                                                timestamp=t - datetime.timedelta(seconds=1)))
+        events.append(models.TagAssignmentEvent(person_id=person_ids[p], tag_id=new_tag, event_type=models.ASSIGN_EVENT_ASSIGNED, timestamp=t))
+        swaps.append((int(step), p, new_tag))
+    return events, swaps
+
+###########################
+# positions
+###########################
+def generate(spec, progress=None):
+    #
+    # create the facility and write its positions; progress(written, total) is called after every chunk
+    # returns a summary dict
+    #
+    rng = np.random.default_rng(spec.seed)
+    with transaction.atomic():
+        person_ids = create_people(spec, rng)
+        tag_ids = create_tags(spec)
+        events, swaps = plan_assignments(spec, person_ids, tag_ids, rng)
+        models.TagAssignmentEvent.objects.bulk_create(events, batch_size=1000)
+        assignments.bump_assignments_version()
+    assignments.get_assignment_index().refresh()
+
+    n = len(person_ids)
+    person_arr = np.asarray(person_ids, dtype=np.int64)
+    tag_arr = np.asarray(tag_ids[:n], dtype=np.int64)
+    centres = spec.room_centres()
+    room = rng.integers(spec.rooms, size=n)
+    offset = rng.uniform(-spec.room_size / 2, spec.room_size / 2, size=(n, 2))
+    half = spec.room_size / 2
+
+    start = spec.start.timestamp()
+    steps_per_chunk = max(1, CHUNK_ROWS // n)
+    swap_at = 0
+    written = 0
+    for chunk_start in range(0, spec.steps, steps_per_chunk):
+        chunk_steps = min(steps_per_chunk, spec.steps - chunk_start)
+        rows = []
+        for step in range(chunk_start, chunk_start + chunk_steps):
+            while swap_at < len(swaps) and swaps[swap_at][0] <= step:
+                tag_arr[swaps[swap_at][1]] = swaps[swap_at][2]
+                swap_at += 1
+            movers = rng.random(n) < spec.move_probability
+            room[movers] = rng.integers(spec.rooms, size=int(movers.sum()))
+            offset = np.clip(offset + rng.normal(0, spec.step_meters, size=(n, 2)), -half, half)
+            xy = centres[room] + offset
+            ts = datetime.datetime.fromtimestamp(start + step * spec.interval_seconds, datetime.timezone.utc)
+            rows.extend(models.TagPosition(None, tag_id, person_id, x, y, ts)
+                        for tag_id, person_id, x, y in zip(tag_arr.tolist(), person_arr.tolist(), xy[:, 0].tolist(), xy[:, 1].tolist()))
+        dao.save_positions(rows)
+        written += len(rows)
+        if progress is not None:
+            progress(written, spec.positions)
+
+    return {
+        "people": n,
+        "tags": len(tag_ids),
+        "rooms": spec.rooms,
+        "assignment_events": len(events),
+        "positions": written,
+        "from": spec.start,
+        "to": spec.start + datetime.timedelta(seconds=spec.steps * spec.interval_seconds)
+    }
+
+def delete(prefix):
+    # remove a generated facility; positions and events go with their people and tags
+    # returns the number of rows deleted
+    with transaction.atomic():
+        people = models.TrackablePerson.objects.filter(unique_id__startswith='%s-p' % prefix).delete()[0]
+        tags = models.TrackingTag.objects.filter(unique_id__startswith='%s-t' % prefix).delete()[0]
+    response_cache.bump_people_version()
+    return people + tags
@@ -0,0 +1,148 @@
+#######################################################################
+# zones.py
+# Point-in-zone lookups
+#
+# Zones are rasterised onto a uniform grid once. A grid cell either lies
+# wholly inside one zone (answered by an array lookup), touches no zone,
+# or is "mixed" and keeps a short candidate list that is resolved with a
+# ray-casting point-in-polygon test. Only points near a zone boundary
+# ever pay for the polygon test.
+#######################################################################
+import threading
+
+import numpy as np
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+import inftrackapp.models as models
+
+CELL_EMPTY = -1
+CELL_MIXED = -2
+
+def point_in_polygon(x, y, points):
+    inside = False
+    n = len(points)
+    j = n - 1
+    for i in range(n):
+        xi, yi = points[i]
+        xj, yj = points[j]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+def _polygon_area(points):
+    area = 0.0
+    n = len(points)
+    for i in range(n):
+        x1, y1 = points[i]
+        x2, y2 = points[(i + 1) % n]
+        area += x1 * y2 - x2 * y1
+    return abs(area) / 2.0
+
+class ZoneIndex(object):
+
+    def __init__(self, zones, cell_size):
+        #
+        # zones: (name, points) pairs. Where zones overlap the smaller one wins,
+        # so a room drawn inside a ward is reported as the room
+        #
+        self.cell_size = float(cell_size)
+        zones = sorted(zones, key=lambda z: _polygon_area(z[1]))
+        self.names = [name for name, points in zones]
+        self.polygons = [points for name, points in zones]
+        self.candidates = {}
+        if not zones:
+            self.origin = (0.0, 0.0)
+            self.raster = np.full((0, 0), CELL_EMPTY, dtype=np.int32)
+            return
+
+        min_x = min(x for points in self.polygons for x, y in points)
+        min_y = min(y for points in self.polygons for x, y in points)
+        max_x = max(x for points in self.polygons for x, y in points)
+        max_y = max(y for points in self.polygons for x, y in points)
+        self.origin = (min_x, min_y)
+        nx = int((max_x - min_x) // self.cell_size) + 1
+        ny = int((max_y - min_y) // self.cell_size) + 1
+        self.raster = np.full((nx, ny), CELL_EMPTY, dtype=np.int32)
+
+        cells = {}
+        for idx, points in enumerate(self.polygons):
+            x0, y0 = self._cell(min(x for x, y in points), min(y for x, y in points))
+            x1, y1 = self._cell(max(x for x, y in points), max(y for x, y in points))
+            for cx in range(x0, x1 + 1):
+                for cy in range(y0, y1 + 1):
+                    cells.setdefault((cx, cy), []).append(idx)
+
+        for (cx, cy), zone_ids in cells.items():
+            if len(zone_ids) == 1 and self._cell_inside(cx, cy, self.polygons[zone_ids[0]]):
+                self.raster[cx, cy] = zone_ids[0]
+            else:
+                self.raster[cx, cy] = CELL_MIXED
+                self.candidates[(cx, cy)] = zone_ids
+
+    def _cell(self, x, y):
+        return (int((x - self.origin[0]) // self.cell_size), int((y - self.origin[1]) // self.cell_size))
+
+    def _cell_inside(self, cx, cy, points):
+        #
+        # a cell is wholly inside a simple polygon when all four corners are inside
+        # and no polygon vertex falls within it
+        #
+        x0 = self.origin[0] + cx * self.cell_size
+        y0 = self.origin[1] + cy * self.cell_size
+        x1 = x0 + self.cell_size
+        y1 = y0 + self.cell_size
+        for x, y in points:
+            if x0 <= x <= x1 and y0 <= y <= y1:
+                return False
+        return all(point_in_polygon(x, y, points) for x, y in ((x0, y0), (x1, y0), (x0, y1), (x1, y1)))
+
+    def lookup(self, x, y):
+        idx = self.lookup_many(np.array([x]), np.array([y]))[0]
+        if idx < 0:
+            return None
+        return self.names[idx]
+
+    def lookup_many(self, xs, ys):
+        #
+        # zone index for every point, or -1 when it is in no zone
+        #
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        result = np.full(len(xs), CELL_EMPTY, dtype=np.int32)
+        if not self.raster.size or not len(xs):
+            return result
+        cx = np.floor((xs - self.origin[0]) / self.cell_size).astype(np.int64)
+        cy = np.floor((ys - self.origin[1]) / self.cell_size).astype(np.int64)
+        on_grid = (cx >= 0) & (cy >= 0) & (cx < self.raster.shape[0]) & (cy < self.raster.shape[1])
+        result[on_grid] = self.raster[cx[on_grid], cy[on_grid]]
+        for i in np.flatnonzero(result == CELL_MIXED):
+            result[i] = CELL_EMPTY
+            for idx in self.candidates[(int(cx[i]), int(cy[i]))]:
+                if point_in_polygon(xs[i], ys[i], self.polygons[idx]):
+                    result[i] = idx
+                    break
+        return result
+
+###########################
+# process wide index
+###########################
+_lock = threading.Lock()
+_index = None
+_index_stamp = None
+
+def get_zone_index():
+    #
+    # the index is rebuilt only when a zone has been added, removed or edited
+    #
+    global _index, _index_stamp
+    stamp = models.Zone.objects.aggregate(count=Count('id'), modified=Max('modified'))
+    stamp = (stamp['count'], stamp['modified'])
+    with _lock:
+        if _index is None or stamp != _index_stamp:
+            zones = [(zone.name, zone.points) for zone in models.Zone.objects.all()]
+            _index = ZoneIndex(zones, settings.ZONE_INDEX_CELL_METERS)
+            _index_stamp = stamp
+        return _index